@@ -1,214 +1,296 @@
-import re
-import csv
-import os
-import secrets
-import hashlib
-import smtplib
-import sqlite3
-from datetime import datetime, timedelta
-from email.message import EmailMessage
-from db import get_db, init_db
-from subscriptions import append_subscription, ensure_csv_has_header, update_send_in_csv
-from flask import Flask, render_template, request, redirect, url_for, flash
-from unsubscribe import unsubscribe_bp
-from email_utils import send_verification_email
-
-BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-
-app = Flask(
-    __name__,
-    template_folder=os.path.join(BASE_DIR, "webpages", "templates"),
-    static_folder=os.path.join(BASE_DIR, "webpages", "static"),
-)
-app.secret_key = "supersecretkey"  # required for flash messages
-init_db()
-# ensure CSV migrated/has header
-ensure_csv_has_header()
-# register unsubscribe blueprint
-app.register_blueprint(unsubscribe_bp)
-
-# Ensure DB is initialized before handling requests (compatible with Flask 2 and 3)
-def _ensure_db():
-    try:
-        init_db()
-    except Exception:
-        app.logger.exception("Database initialization failed during startup")
-
-# Register initializer depending on Flask version
-if hasattr(app, "before_first_request"):
-    # Older Flask versions provide this decorator
-    app.before_first_request(_ensure_db)
-else:
-    # Flask 3 removed before_first_request; run once on the first request via before_request
-    _db_init_done = {"done": False}
-
-    @app.before_request
-    def _ensure_db_once():
-        if not _db_init_done["done"]:
-            _db_init_done["done"] = True
-            _ensure_db()
-
-EMAIL_REGEX = r"^[^@]+@[^@]+\.[^@]+$"
-
-@app.route("/")
-def home():
-    return redirect(url_for("signup"))
-
-@app.route("/signup", methods=["GET", "POST"])
-def signup():
-    # use UTC ISO timestamp for database 'time' column
-    now = datetime.utcnow().isoformat()
-    if request.method == "POST":
-
-        email = request.form.get("email", "").strip().lower()
-
-        if not email:
-            flash("Email is required.", "error")
-            return redirect(url_for("signup"))
-
-        if not re.match(EMAIL_REGEX, email):
-            flash("Invalid email address.", "error")
-            return redirect(url_for("signup"))
-
-        code = generate_code()
-        hashed_code = hash_code(code)
-        expires_at = (datetime.utcnow() + timedelta(minutes=10)).isoformat()
-
-        db = get_db()
-        # Check whether the email already exists and inspect the 'send' and 'verified' flags
-        row = db.execute("SELECT id, send, verified FROM subscribers WHERE email = ?", (email,)).fetchone()
-        if row:
-            # If already fully verified, tell the user it's registered
-            if row["send"] == 1 and row["verified"] == 1:
-                db.close()
-                flash("This email is already registered.", "error")
-                return redirect(url_for("signup"))
-
-            # For existing but not verified emails, (re)issue a verification code, re-enable sending, and redirect to verify
-            db.execute("""
-                UPDATE subscribers
-                SET send = 1,
-                    time = ?,
-                    verification_code = ?,
-                    code_expires_at = ?
-                WHERE email = ?
-            """, (now, hashed_code, expires_at, email))
-            db.commit()
-            update_send_in_csv(email, True)
-            db.close()
-            try:
-                send_verification_email(email, code)
-            except Exception:
-                app.logger.exception("Failed to send verification email for existing subscriber")
-                flash("We couldn't send the verification email. Please try again later.", "error")
-                return redirect(url_for("signup"))
-
-            flash("Check your email for the verification code.", "info")
-            return redirect(url_for("verify", email=email))
-
-        # Not present: insert a new subscriber and send verification code
-        try:
-            db.execute("""
-                INSERT INTO subscribers (
-                    email,
-                    time,
-                    verification_code,
-                    code_expires_at,
-                    verified
-                ) VALUES (?, ?, ?, ?, 0)
-            """, (email, now, hashed_code, expires_at))
-            db.commit()
-            # Add to CSV
-            append_subscription(datetime.utcnow().isoformat(), email, True)
-            db.close()
-            app.logger.info("Reached checkpoint")
-            try:
-                send_verification_email(email, code)
-            except Exception:
-                app.logger.exception("Failed to send verification email for new subscriber")
-                flash("We couldn't send the verification email. Please try again later.", "error")
-                return redirect(url_for("signup"))
-
-            flash("Check your email for the verification code.", "info")
-            return redirect(url_for("verify", email=email))
-
-        except sqlite3.IntegrityError as e:
-            # UNIQUE constraint failed (race or unexpected state)
-            app.logger.warning(f"Duplicate email attempt: {email} | {e}")
-            db.close()
-            flash("This email is already registered.", "error")
-            return redirect(url_for("signup"))
-
-        except sqlite3.OperationalError as e:
-            # database is locked, disk I/O errors, etc.
-            app.logger.error(f"Database operational error: {e}")
-            db.close()
-            flash("Our system is busy. Please try again in a moment.", "error")
-            return redirect(url_for("signup"))
-
-        except Exception as e:
-            app.logger.error(f"SIGNUP ERROR [{email}]: {e}")
-            db.close()
-            flash("An unexpected error occurred. Please try again.", "error")
-            return redirect(url_for("signup"))
-
-    return render_template("signup.html")
-
-@app.route("/verify", methods=["GET", "POST"])
-def verify():
-    if request.method == "POST":
-        email = request.form.get("email", "").strip().lower()
-        code = request.form.get("code", "").strip()
-
-        if not email or not code:
-            flash("Email and code are required.", "error")
-            return redirect(url_for("verify"))
-
-        hashed = hash_code(code)
-        now = datetime.utcnow().isoformat()
-
-        db = get_db()
-        row = db.execute("""
-            SELECT verification_code, code_expires_at
-            FROM subscribers
-            WHERE email = ?
-        """, (email,)).fetchone()
-
-        if not row:
-            flash("Invalid verification attempt.", "error")
-            return redirect(url_for("verify"))
-
-        if now > row["code_expires_at"]:
-            flash("Verification code expired.", "error")
-            return redirect(url_for("verify"))
-
-        if hashed != row["verification_code"]:
-            flash("Invalid verification code.", "error")
-            return redirect(url_for("verify"))
-
-        db.execute("""
-            UPDATE subscribers
-            SET verified = 1,
-                verification_code = NULL,
-                code_expires_at = NULL
-            WHERE email = ?
-        """, (email,))
-        db.commit()
-        db.close()
-
-        flash("Email verified successfully!", "success")
-        return redirect(url_for("signup"))
-
-    # If redirected from signup, include the email in the form via query string
-    email = request.args.get("email", "")
-    return render_template("verify.html", email=email)
-
-
-def generate_code():
-    return f"{secrets.randbelow(1_000_000):06d}"
-
-def hash_code(code: str) -> str:
-    return hashlib.sha256(code.encode()).hexdigest()
-
-if __name__ == "__main__":
+import csv
+import os
+import smtplib
+import sqlite3
+import time
+from datetime import datetime
+from email.message import EmailMessage
+from db import DB_PATHS, shard_for_email
+from migrations import check_schema
+from subscriptions import append_subscription, start_compactor, update_send_in_csv
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from unsubscribe import unsubscribe_bp
+from export import export_bp
+from email_utils import CODE_TTL_MINUTES, SMTP_BREAKER, generate_code, hash_code
+from stats import get_stats
+from sweeper import start_sweeper
+from maintenance import start_maintenance, wal_size
+from ratelimit import rate_limited
+import assets
+import journal
+import membership
+import metrics
+from breaker import STATE_VALUES
+from outbox import enqueue_verification_email, queue_depth
+from validation import canonicalize, normalize, validate
+from writebehind import run_write
+from storage import all_shards
+from tokens import read_token
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+app = Flask(
+    __name__,
+    template_folder=os.path.join(BASE_DIR, "webpages", "templates"),
+    static_folder=os.path.join(BASE_DIR, "webpages", "static"),
+)
+app.secret_key = "supersecretkey"  # required for flash messages
+# refuse to start on a database that `python migrations.py migrate` has not upgraded yet
+check_schema()
+# fold the CSV change log into emails.csv in the background (CSV_COMPACT_INTERVAL=0 disables)
+start_compactor()
+# clear expired verification codes periodically (SWEEP_INTERVAL=0 disables)
+start_sweeper()
+# checkpoint, optimize and vacuum the database periodically (MAINTENANCE_INTERVAL, off by default)
+start_maintenance()
+# per-worker Bloom filter of list addresses, built in the background (MEMBERSHIP_FILTER=0 disables)
+membership.start()
+# register unsubscribe blueprint
+app.register_blueprint(unsubscribe_bp)
+# streaming CSV/JSONL export, only answered when EXPORT_TOKEN is set
+app.register_blueprint(export_bp)
+# per-route and per-phase latency histograms, served at /metrics
+metrics.init_app(app)
+# fingerprinted, precompressed static files with far-future caching
+assets.init_app(app)
+
+@app.route("/")
+def home():
+    return redirect(url_for("signup"))
+
+@app.route("/signup", methods=["GET", "POST"])
+@rate_limited("signup")
+def signup():
+    # use UTC ISO timestamp for database 'time' column
+    now = datetime.utcnow().isoformat()
+    if request.method == "POST":
+
+        email, canonical, reason = validate(request.form.get("email", ""))
+
+        if reason == "empty":
+            flash("Email is required.", "error")
+            return redirect(url_for("signup"))
+
+        if reason == "invalid":
+            flash("Invalid email address.", "error")
+            return redirect(url_for("signup"))
+
+        if reason == "disposable":
+            flash("Please use a permanent email address.", "error")
+            return redirect(url_for("signup"))
+
+        code = generate_code()
+        hashed_code = hash_code(code)
+        expires_at = int(time.time()) + CODE_TTL_MINUTES * 60
+        absent = membership.definitely_absent(canonical, email)
+
+        def write(db):
+            if absent:
+                # Not on the list as of the filter's last catch-up, so skip the lookup. If a signup from
+                # another worker got in first the insert does nothing and we carry on as usual
+                if db.execute("""
+                    INSERT INTO subscribers (
+                        email,
+                        canonical_email,
+                        time,
+                        verification_code,
+                        code_expires_epoch,
+                        verified
+                    ) VALUES (?, ?, ?, ?, ?, 0)
+                    ON CONFLICT DO NOTHING
+                """, (email, canonical, now, hashed_code, expires_at)).rowcount:
+                    enqueue_verification_email(db, email, code)
+                    return "inserted", email
+
+            # Look the address up by canonical form, so Gmail dot/plus variants are the same subscriber
+            row = db.execute(
+                "SELECT id, email, send, verified FROM subscribers WHERE canonical_email = ?", (canonical,)
+            ).fetchone()
+            if row:
+                # If already fully verified, tell the user it's registered
+                if row["send"] == 1 and row["verified"] == 1:
+                    return "registered", row["email"]
+
+                # For existing but not verified emails, (re)issue a verification code and re-enable sending
+                db.execute("""
+                    UPDATE subscribers
+                    SET send = 1,
+                        time = ?,
+                        verification_code = ?,
+                        code_expires_epoch = ?
+                    WHERE id = ?
+                """, (now, hashed_code, expires_at, row["id"]))
+                # Queued in the same transaction; outbox.py delivers it so this request never waits on SMTP
+                enqueue_verification_email(db, email, code)
+                return "reissued", row["email"]
+
+            # Not present: insert a new subscriber and send verification code
+            db.execute("""
+                INSERT INTO subscribers (
+                    email,
+                    canonical_email,
+                    time,
+                    verification_code,
+                    code_expires_epoch,
+                    verified
+                ) VALUES (?, ?, ?, ?, ?, 0)
+            """, (email, canonical, now, hashed_code, expires_at))
+            enqueue_verification_email(db, email, code)
+            return "inserted", email
+
+        try:
+            outcome, stored_email = run_write(write, shard_for_email(canonical))
+
+        except sqlite3.IntegrityError as e:
+            # UNIQUE constraint failed (race or unexpected state)
+            app.logger.warning(f"Duplicate email attempt: {email} | {e}")
+            flash("This email is already registered.", "error")
+            return redirect(url_for("signup"))
+
+        except sqlite3.OperationalError as e:
+            # database is locked, disk I/O errors, etc.
+            app.logger.error(f"Database operational error: {e}")
+            flash("Our system is busy. Please try again in a moment.", "error")
+            return redirect(url_for("signup"))
+
+        except Exception as e:
+            app.logger.error(f"SIGNUP ERROR [{email}]: {e}")
+            flash("An unexpected error occurred. Please try again.", "error")
+            return redirect(url_for("signup"))
+
+        if outcome == "registered":
+            flash("This email is already registered.", "error")
+            return redirect(url_for("signup"))
+
+        journal.record("subscribe", email=stored_email, canonical=canonical, time=now)
+        if outcome == "reissued":
+            update_send_in_csv(stored_email, True)
+        else:
+            membership.add(canonical, email)
+            # Add to CSV
+            append_subscription(datetime.utcnow().isoformat(), email, True)
+
+        flash("Check your email for the verification code.", "info")
+        return redirect(url_for("verify", email=email))
+
+    return assets.render_page("signup.html")
+
+@app.route("/verify", methods=["GET", "POST"])
+@rate_limited("verify")
+def verify():
+    if request.method == "POST":
+        email = normalize(request.form.get("email", ""))
+        code = request.form.get("code", "").strip()
+
+        if not email or not code:
+            flash("Email and code are required.", "error")
+            return redirect(url_for("verify"))
+
+        hashed = hash_code(code)
+        now = int(time.time())
+        canonical = canonicalize(email)
+
+        def write(db):
+            # Canonical match covers dot/plus variants; the exact match covers older rows the canonical_email
+            # backfill left without one, because another row already had their canonical form
+            row = db.execute("""
+                SELECT id, verification_code, code_expires_epoch
+                FROM subscribers
+                WHERE canonical_email = ? OR email = ?
+                ORDER BY email = ? DESC
+            """, (canonical, email, email)).fetchone()
+
+            if not row:
+                return "unknown"
+
+            # No expiry means the code was already used or cleared by the sweeper
+            if row["code_expires_epoch"] is None or now > row["code_expires_epoch"]:
+                return "expired"
+
+            if hashed != row["verification_code"]:
+                return "wrong_code"
+
+            db.execute("""
+                UPDATE subscribers
+                SET verified = 1,
+                    verification_code = NULL,
+                    code_expires_epoch = NULL
+                WHERE id = ?
+            """, (row["id"],))
+            return "verified"
+
+        outcome = run_write(write, shard_for_email(canonical))
+        if outcome == "unknown":
+            flash("Invalid verification attempt.", "error")
+            return redirect(url_for("verify"))
+        if outcome == "expired":
+            flash("Verification code expired.", "error")
+            return redirect(url_for("verify"))
+        if outcome == "wrong_code":
+            flash("Invalid verification code.", "error")
+            return redirect(url_for("verify"))
+
+        journal.record("verify", canonical=canonical)
+        flash("Email verified successfully!", "success")
+        return redirect(url_for("signup"))
+
+    # If redirected from signup, include the email in the form via query string
+    email = request.args.get("email", "")
+    return assets.render_page("verify.html", email=email)
+
+
+@app.route("/verify/<token>", methods=["GET", "POST"])
+def verify_link(token):
+    """Verification link from the email. GET asks for confirmation (link scanners and prefetchers follow
+    GETs); the signature is checked without touching the database, then POST marks the address verified
+    with a single conditional UPDATE."""
+    email = read_token("verify", token)
+    if email is None:
+        flash("This verification link is invalid or has expired.", "error")
+        return redirect(url_for("verify"))
+    canonical = canonicalize(email)
+
+    if request.method == "GET":
+        return render_template("verify.html", email=email, token=token)
+
+    def write(db):
+        return db.execute("""
+            UPDATE subscribers
+            SET verified = 1,
+                verification_code = NULL,
+                code_expires_epoch = NULL
+            WHERE (canonical_email = ? OR email = ?) AND verified = 0
+        """, (canonical, email)).rowcount
+
+    if run_write(write, shard_for_email(canonical)):
+        journal.record("verify", canonical=canonical)
+        flash("Email verified successfully!", "success")
+    else:
+        flash("This email is already verified or is no longer on our list.", "info")
+    return redirect(url_for("signup"))
+
+
+@app.route("/stats")
+def stats():
+    """Subscriber counters as JSON; reads a handful of rows kept current by triggers."""
+    with all_shards() as conns:
+        return jsonify(get_stats(*conns))
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus text format, summed over every worker process."""
+    with all_shards() as conns:
+        depth = sum(queue_depth(conn) for conn in conns)
+    breaker = SMTP_BREAKER.snapshot()
+    body = metrics.render({
+        "email_list_outbox_queue_depth": depth,
+        "email_list_smtp_breaker_state": STATE_VALUES[breaker["state"]],
+        "email_list_smtp_breaker_failures": breaker["failures"],
+        "email_list_wal_bytes": sum(wal_size(path) for path in DB_PATHS),
+    })
+    return body, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
\ No newline at end of file
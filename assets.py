@@ -0,0 +1,142 @@
+"""HTTP caching for the public pages and their static files.
+
+Static files are read once at startup, fingerprinted with a hash of their contents and
+compressed with gzip (and brotli, if the ``brotli`` package is installed). ``url_for('static', ...)``
+then yields ``/static/style.<hash>.css``, which is served from memory with a one-year immutable
+Cache-Control: a changed file gets a new URL, so browsers never need to revalidate. The plain name
+still works (for ``url()`` references inside CSS) with an ETag instead.
+
+render_page() is render_template() for GET pages. Unless the visitor has flash messages waiting,
+the rendered bytes (and their compressed forms) are kept per template and arguments, so repeat
+views skip Jinja entirely and a matching If-None-Match gets a 304.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+
+from flask import Response, render_template, request, session
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+FINGERPRINT_LENGTH = 12
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+# Bodies smaller than this are sent as they are; compression would not save a packet
+MIN_COMPRESS_BYTES = 256
+# Upper bound on cached renders per process (/verify?email=... makes one per address); the least
+# recently used one is dropped to make room
+PAGE_CACHE_MAX = int(os.getenv("PAGE_CACHE_MAX", "256"))
+PAGE_CACHE = os.getenv("PAGE_CACHE", "1") == "1"
+
+_assets = {}  # filename -> _Encoded
+_fingerprinted = {}  # fingerprinted filename -> _Encoded
+_urls = {}  # filename -> fingerprinted filename
+_pages = OrderedDict()  # (template, context) -> _Encoded, least recently used first
+_pages_lock = threading.Lock()
+
+
+class _Encoded:
+    """One body in every encoding worth sending, plus a strong ETag derived from its contents."""
+
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        self.digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        self.bodies = {None: data}
+        if len(data) >= MIN_COMPRESS_BYTES:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                self.bodies["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.bodies["br"] = compressed
+
+    def response(self, cache_control):
+        accepted = request.accept_encodings
+        encoding = None
+        for candidate in ("br", "gzip"):
+            if candidate in self.bodies and accepted[candidate]:
+                encoding = candidate
+                break
+        response = Response(self.bodies[encoding], mimetype=self.mimetype)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if len(self.bodies) > 1:
+            response.vary.add("Accept-Encoding")
+        response.headers["Cache-Control"] = cache_control
+        # Each encoding is a different representation, so it needs its own ETag
+        response.set_etag(f"{self.digest}-{encoding}" if encoding else self.digest)
+        return response.make_conditional(request)
+
+
+def _fingerprint_name(filename, digest):
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{digest[:FINGERPRINT_LENGTH]}{ext}"
+
+
+def load_static(folder):
+    """Read, fingerprint and compress every file under ``folder``."""
+    _assets.clear()
+    _fingerprinted.clear()
+    _urls.clear()
+    for dirpath, _, filenames in os.walk(folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            filename = os.path.relpath(path, folder).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                data = f.read()
+            mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            asset = _assets[filename] = _Encoded(data, mimetype)
+            url_name = _urls[filename] = _fingerprint_name(filename, asset.digest)
+            _fingerprinted[url_name] = asset
+
+
+def render_page(template, **context):
+    """render_template() for GET pages, served from a per-process cache when no flashes are pending."""
+    if not PAGE_CACHE or request.method != "GET" or session.get("_flashes"):
+        return render_template(template, **context)
+    key = (template, tuple(sorted(context.items())))
+    with _pages_lock:
+        page = _pages.get(key)
+        if page is not None:
+            _pages.move_to_end(key)
+    if page is None:
+        page = _Encoded(render_template(template, **context).encode("utf-8"), "text/html")
+        with _pages_lock:
+            _pages[key] = page
+            if len(_pages) > PAGE_CACHE_MAX:
+                _pages.popitem(last=False)
+    return page.response(REVALIDATE)
+
+
+def init_app(app):
+    """Serve app's static folder from memory and fingerprint the URLs url_for() builds for it."""
+    load_static(app.static_folder)
+    # Templates are re-read on every render in debug mode, so never hold on to their output there
+    if app.debug:
+        global PAGE_CACHE
+        PAGE_CACHE = False
+    send_static_file = app.view_functions["static"]
+
+    @app.url_defaults
+    def _fingerprint_static(endpoint, values):
+        if endpoint == "static" and values.get("filename") in _urls:
+            values["filename"] = _urls[values["filename"]]
+
+    def static(filename):
+        asset = _fingerprinted.get(filename)
+        if asset is not None:
+            return asset.response(IMMUTABLE)
+        asset = _assets.get(filename)
+        if asset is not None:
+            return asset.response(REVALIDATE)
+        # Added after startup: let Flask serve it from disk
+        return send_static_file(filename=filename)
+
+    app.view_functions["static"] = static
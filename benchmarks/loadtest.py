@@ -0,0 +1,188 @@
+"""End-to-end load test: gunicorn + outbox worker + local SMTP sink.
+
+Boots app.py under gunicorn in a scratch directory (fresh emails.db/emails.csv), points the
+mail transport at benchmarks/smtp_sink.py, and runs concurrent clients that each go through
+/signup -> /verify (with the code read from the sink) -> /unsubscribe. Prints throughput and
+p50/p95/p99 latency per route.
+
+    python benchmarks/loadtest.py --workers 4 --clients 16 --users 2000
+"""
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from smtp_sink import SMTPSink  # noqa: E402
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, route, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def _post(base, path, fields, recorder, route, expect_location=None):
+    """POST a form; success is a 302, optionally to ``expect_location`` (the routes flash and redirect)."""
+    data = urllib.parse.urlencode(fields).encode()
+    started = time.perf_counter()
+    status, location = None, ""
+    try:
+        with _opener.open(base + path, data=data, timeout=30) as resp:
+            status = resp.status
+            resp.read()
+    except urllib.error.HTTPError as e:
+        status = e.code
+        location = e.headers.get("Location", "")
+    except OSError:
+        status = None
+    ok = status == 302 and (expect_location is None or urllib.parse.urlsplit(location).path == expect_location)
+    recorder.add(route, time.perf_counter() - started, ok)
+    return status
+
+
+def _user_flow(base, sink, recorder, n, code_timeout):
+    email = f"bench{n}@example.com"
+    _post(base, "/signup", {"email": email}, recorder, "signup")
+    code = sink.wait_for_code(email, timeout=code_timeout)
+    if code is None:
+        recorder.add("verify", 0.0, False)
+    else:
+        # A correct code redirects back to /signup; a rejected one to /verify
+        _post(base, "/verify", {"email": email, "code": code}, recorder, "verify", expect_location="/signup")
+    _post(base, "/unsubscribe", {"email": email}, recorder, "unsubscribe")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_http(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def run(workers=2, threads=1, clients=8, users=500, outbox_threads=2, code_timeout=30.0, keep=False):
+    workdir = tempfile.mkdtemp(prefix="email_list_bench_")
+    sink = SMTPSink().start()
+    port = _free_port()
+    env = dict(
+        os.environ,
+        SMTP_HOST=sink.host,
+        SMTP_PORT=str(sink.port),
+        SMTP_SSL="0",
+        GMAIL_USER="bench@example.com",
+        GMAIL_APP_PASSWORD="bench",
+        # Measure the app, not the limiter shedding a single client IP
+        RATE_LIMIT_ENABLED="0",
+        OUTBOX_POLL_INTERVAL="0.05",
+        PYTHONPATH=REPO,
+    )
+    subprocess.run([sys.executable, os.path.join(REPO, "migrations.py"), "migrate"],
+                   cwd=workdir, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = subprocess.Popen([
+        sys.executable, "-m", "gunicorn",
+        "--chdir", workdir, "--pythonpath", REPO,
+        "-w", str(workers), "--threads", str(threads),
+        "-b", f"127.0.0.1:{port}", "--log-level", "warning",
+        "app:app",
+    ], cwd=workdir, env=env)
+    worker = None
+    try:
+        base = f"http://127.0.0.1:{port}"
+        if not _wait_for_http(base + "/signup"):
+            raise RuntimeError("gunicorn did not come up")
+        worker = subprocess.Popen(
+            [sys.executable, os.path.join(REPO, "outbox.py"), "--threads", str(outbox_threads)],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+        recorder = Recorder()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            list(pool.map(lambda n: _user_flow(base, sink, recorder, n, code_timeout), range(users)))
+        elapsed = time.perf_counter() - started
+    finally:
+        for proc in (worker, server):
+            if proc is not None:
+                proc.terminate()
+                try:
+                    proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        sink.stop()
+        if keep:
+            print(f"Scratch directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{users} user flows, {clients} clients, {workers} gunicorn workers x {threads} threads, "
+          f"{elapsed:.2f}s ({users / elapsed:.1f} flows/s)")
+    print(f"{'route':<12}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route in ("signup", "verify", "unsubscribe"):
+        samples = sorted(recorder.samples.get(route, []))
+        print(f"{route:<12}{len(samples):>10}{recorder.errors.get(route, 0):>8}"
+              f"{len(samples) / elapsed:>10.1f}"
+              f"{percentile(samples, 50) * 1000:>10.1f}"
+              f"{percentile(samples, 95) * 1000:>10.1f}"
+              f"{percentile(samples, 99) * 1000:>10.1f}")
+    return recorder
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test signup/verify/unsubscribe under gunicorn.")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=1, help="threads per gunicorn worker")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent simulated users")
+    parser.add_argument("--users", type=int, default=500, help="total signup/verify/unsubscribe flows")
+    parser.add_argument("--outbox-threads", type=int, default=2, help="outbox worker threads delivering codes")
+    parser.add_argument("--code-timeout", type=float, default=30.0, help="seconds to wait for a code in the sink")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory with the database")
+    args = parser.parse_args(argv)
+    run(args.workers, args.threads, args.clients, args.users, args.outbox_threads, args.code_timeout, args.keep)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Microbenchmarks for the hot paths at different list sizes.
+
+Each size gets a scratch directory with a populated emails.db and emails.csv, then times:
+update_send_in_csv, append_subscription, ensure_csv_has_header, compact_csv, get_db (cold connect
+and pooled), and the viewer's fetch_page (plain and substring search) and populate_tree (these three
+are skipped when no display is available).
+
+    python benchmarks/microbench.py --sizes 1000,100000,1000000
+"""
+import argparse
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+
+def timeit(fn, repeat):
+    """Best-of and mean wall time in milliseconds over ``repeat`` calls."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return min(times), sum(times) / len(times)
+
+
+def populate(size):
+    import db
+    import migrations
+
+    migrations.migrate()
+    conn = db.get_db()
+    try:
+        conn.executemany(
+            "INSERT INTO subscribers (email, time, send, verified) VALUES (?, ?, 1, 1)",
+            ((f"user{i}@example.com", "2024-01-01T00:00:00") for i in range(size)),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    with open("emails.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["time", "email", "send"])
+        writer.writerows(("2024-01-01T00:00:00", f"user{i}@example.com", "Yes") for i in range(size))
+
+
+def bench_size(size, repeat):
+    import db
+    import subscriptions
+
+    results = {}
+    target = f"user{size // 2}@example.com"
+    results["update_send_in_csv"] = timeit(lambda: subscriptions.update_send_in_csv(target, False), repeat)
+    results["append_subscription"] = timeit(
+        lambda: subscriptions.append_subscription("2024-01-01T00:00:00", "new@example.com", True), repeat
+    )
+    results["ensure_csv_has_header"] = timeit(subscriptions.ensure_csv_has_header, repeat)
+    # Each compaction folds in the events appended just before it
+    def compact():
+        subscriptions.update_send_in_csv(target, True)
+        subscriptions.compact_csv()
+    results["compact_csv (1 event)"] = timeit(compact, max(1, min(repeat, 5)))
+
+    results["get_db (cold connect)"] = timeit(lambda: db._connect().close_for_real(), repeat)
+    db.get_db().close()
+    results["get_db (pooled)"] = timeit(lambda: db.get_db().close(), repeat)
+
+    try:
+        import tkinter
+        tkinter.Tk().destroy()
+    except Exception:
+        results["fetch_page"] = results["fetch_page (contains)"] = results["populate_tree"] = None
+    else:
+        import main
+        import search
+        conn = db.get_db()
+        try:
+            rows = search.fetch_page(conn)
+            results["fetch_page"] = timeit(lambda: search.fetch_page(conn), repeat)
+            results["fetch_page (contains)"] = timeit(
+                lambda: search.fetch_page(conn, search.NO_FILTERS._replace(text=f"user{size // 2}@")), repeat
+            )
+        finally:
+            conn.close()
+        results["populate_tree"] = timeit(lambda: main.populate_tree(rows), 1)
+        main.window.destroy()
+        sys.modules.pop("main", None)
+    return results
+
+
+def run(sizes, repeat):
+    if REPO not in sys.path:
+        sys.path.insert(0, REPO)
+    original_cwd = os.getcwd()
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix="email_list_micro_")
+        # db.py and subscriptions.py resolve their files from the working directory at import time
+        os.chdir(workdir)
+        for name in ("db", "migrations", "subscriptions", "stats", "storage", "search", "main"):
+            sys.modules.pop(name, None)
+        try:
+            started = time.perf_counter()
+            populate(size)
+            print(f"\n{size:,} rows (setup {time.perf_counter() - started:.1f}s)")
+            print(f"  {'operation':<26}{'best ms':>12}{'mean ms':>12}")
+            for name, value in bench_size(size, repeat).items():
+                if value is None:
+                    print(f"  {name:<26}{'skipped (no display)':>24}")
+                else:
+                    print(f"  {name:<26}{value[0]:>12.3f}{value[1]:>12.3f}")
+        finally:
+            sys.modules["db"].close_pool()
+            os.chdir(original_cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the CSV mirror, connection setup and GUI refresh.")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="comma-separated row counts")
+    parser.add_argument("--repeat", type=int, default=20, help="calls per measurement")
+    args = parser.parse_args(argv)
+    run([int(s) for s in args.sizes.split(",")], args.repeat)
+
+
+if __name__ == "__main__":
+    main()
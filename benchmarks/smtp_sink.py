@@ -0,0 +1,138 @@
+"""A minimal in-process SMTP server that accepts and keeps every message.
+
+Good enough for smtplib clients (EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA) so the app and the
+outbox worker can be benchmarked without a real mail provider.
+
+    python benchmarks/smtp_sink.py --port 2525
+"""
+import argparse
+import email
+import re
+import socketserver
+import threading
+import time
+from email import policy
+
+CODE_RE = re.compile(r"\b(\d{6})\b")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        sink = self.server.sink
+        self._reply("220 sink ESMTP ready")
+        recipients = []
+        while True:
+            raw = self.rfile.readline()
+            if not raw:
+                return
+            line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            verb = line.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250-sink\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif verb == "AUTH":
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].upper() == "LOGIN":
+                    # Username and password prompts; any credentials are accepted
+                    if len(parts) == 2:
+                        self._reply("334 VXNlcm5hbWU6")
+                        self.rfile.readline()
+                    self._reply("334 UGFzc3dvcmQ6")
+                    self.rfile.readline()
+                elif len(parts) == 2:
+                    self._reply("334 ")
+                    self.rfile.readline()
+                self._reply("235 2.7.0 Authentication successful")
+            elif verb == "MAIL":
+                recipients = []
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                match = re.search(r"<([^>]*)>", line)
+                recipients.append(match.group(1) if match else "")
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                chunks = []
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b".\r\n":
+                        break
+                    if data.startswith(b".."):
+                        data = data[1:]
+                    chunks.append(data)
+                sink.store(recipients, b"".join(chunks))
+                self._reply("250 OK queued")
+            elif verb in ("RSET", "NOOP"):
+                recipients = []
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink:
+    """Collects messages by recipient; ``wait_for_code`` returns the verification code sent to an address."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = _Server((host, port), _Handler)
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+        self.lock = threading.Condition()
+        self.by_recipient = {}
+        self.count = 0
+
+    def store(self, recipients, data):
+        msg = email.message_from_bytes(data, policy=policy.default)
+        body = msg.get_body(preferencelist=("plain",))
+        text = body.get_content() if body is not None else ""
+        with self.lock:
+            self.count += 1
+            for rcpt in recipients:
+                self.by_recipient.setdefault(rcpt.lower(), []).append(text)
+            self.lock.notify_all()
+
+    def wait_for_code(self, address, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        address = address.lower()
+        with self.lock:
+            while True:
+                for text in reversed(self.by_recipient.get(address, [])):
+                    match = CODE_RE.search(text)
+                    if match:
+                        return match.group(1)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="smtp-sink", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local SMTP sink.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    args = parser.parse_args()
+    sink = SMTPSink(args.host, args.port).start()
+    print(f"SMTP sink listening on {sink.host}:{sink.port}; set SMTP_HOST/SMTP_PORT and SMTP_SSL=0")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"{sink.count} messages received")
+    except KeyboardInterrupt:
+        sink.stop()
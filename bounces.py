@@ -0,0 +1,328 @@
+"""Bounces, complaints and the suppression list that every send path checks.
+
+    python bounces.py ingest /var/mail/bounces          # an mbox file, or a Maildir folder
+    python bounces.py check someone@example.com
+    python bounces.py remove someone@example.com
+
+``ingest`` reads delivery status notifications (RFC 3464) and abuse reports (ARF) one message at
+a time. An mbox is read from where the last run stopped; Maildir messages are moved from ``new``
+to ``cur`` once recorded. The outbox worker and campaign senders also record the refusals their
+SMTP server returns while sending.
+
+Hard bounces and complaints suppress the address right away. Soft bounces (mailbox full,
+greylisting, policy blocks) are counted, and SOFT_BOUNCE_LIMIT of them within
+SOFT_BOUNCE_WINDOW_DAYS suppress it too. Suppression is keyed on the canonical address and stored on
+that address's shard. The senders look it up by primary key before every send.
+"""
+import argparse
+import email
+import logging
+import os
+import re
+import smtplib
+import sys
+from datetime import datetime, timedelta
+from email.utils import parseaddr
+
+import metrics
+from db import get_db, shard_for_email
+from migrations import check_schema
+from validation import canonicalize, normalize
+
+log = logging.getLogger(__name__)
+
+SOFT_BOUNCE_LIMIT = int(os.getenv("SOFT_BOUNCE_LIMIT", "3"))
+SOFT_BOUNCE_WINDOW_DAYS = int(os.getenv("SOFT_BOUNCE_WINDOW_DAYS", "30"))
+# Commit (and remember the mbox position) after this many messages
+COMMIT_EVERY = 500
+
+HARD, SOFT, COMPLAINT = "hard", "soft", "complaint"
+REASONS = {HARD: "hard_bounce", SOFT: "soft_bounce", COMPLAINT: "complaint"}
+# Permanent (5.x.x) codes that describe the mailbox or message at the moment, not a dead address:
+# mailbox full, message too big, and policy/spam blocks
+_SOFT_PERMANENT = ("5.2.2", "5.3.4", "5.7.")
+_STATUS_RE = re.compile(r"\b([245]\.\d{1,3}\.\d{1,3})\b")
+
+
+def _canonical(address):
+    return canonicalize(normalize(address))
+
+
+def classify_status(status):
+    """HARD or SOFT for an enhanced status code like "5.1.1"; None for success or garbage."""
+    if status.startswith("5."):
+        return SOFT if status.startswith(_SOFT_PERMANENT) else HARD
+    if status.startswith("4."):
+        return SOFT
+    return None
+
+
+def classify_smtp(code, message):
+    """HARD or SOFT for an SMTP reply, preferring the enhanced status code in its text."""
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", "replace")
+    match = _STATUS_RE.search(message or "")
+    if match:
+        return classify_status(match.group(1))
+    if 500 <= code < 600:
+        # 552: mailbox over quota
+        return SOFT if code == 552 else HARD
+    if 400 <= code < 500:
+        return SOFT
+    return None
+
+
+def is_suppressed(conn, address):
+    """The suppression reason for ``address`` ("hard_bounce", "soft_bounce", "complaint") or None.
+
+    ``conn`` must be on the address's shard, which is where its outbox rows and deliveries live too.
+    """
+    row = conn.execute(
+        "SELECT reason FROM suppressions WHERE canonical_email = ?", (_canonical(address),)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def suppress(conn, canonical, reason, detail=None):
+    """Add ``canonical`` to the suppression list; the first reason recorded is kept."""
+    conn.execute("""
+        INSERT INTO suppressions (canonical_email, reason, detail, created_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (canonical_email) DO NOTHING
+    """, (canonical, reason, detail, datetime.utcnow().isoformat()))
+
+
+def record(conn, address, kind, detail=None, now=None):
+    """Record one bounce or complaint in the caller's transaction. Returns True if ``address`` is now suppressed."""
+    canonical = _canonical(address)
+    metrics.inc("email_list_bounces_total", kind=kind)
+    if kind != SOFT:
+        suppress(conn, canonical, REASONS[kind], detail)
+        return True
+    now = now or datetime.utcnow()
+    window_start = (now - timedelta(days=SOFT_BOUNCE_WINDOW_DAYS)).isoformat()
+    # A streak older than the window starts over
+    count = conn.execute("""
+        INSERT INTO soft_bounces (canonical_email, count, first_at, last_at) VALUES (?, 1, ?, ?)
+        ON CONFLICT (canonical_email) DO UPDATE SET
+            count = CASE WHEN first_at < ? THEN 1 ELSE count + 1 END,
+            first_at = CASE WHEN first_at < ? THEN excluded.first_at ELSE first_at END,
+            last_at = excluded.last_at
+        RETURNING count
+    """, (canonical, now.isoformat(), now.isoformat(), window_start, window_start)).fetchone()[0]
+    if count >= SOFT_BOUNCE_LIMIT:
+        suppress(conn, canonical, REASONS[SOFT], detail)
+        return True
+    return False
+
+
+def record_smtp_failure(conn, address, error):
+    """Record a refusal the SMTP server gave while sending to ``address``. Returns HARD, SOFT or None.
+
+    Only recipient and message refusals count; connection and login errors say nothing about the address.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        code, message = next(iter(error.recipients.values()), (0, b""))
+    elif isinstance(error, smtplib.SMTPDataError):
+        code, message = error.smtp_code, error.smtp_error
+    else:
+        return None
+    kind = classify_smtp(code, message)
+    if kind is not None:
+        if isinstance(message, bytes):
+            message = message.decode("utf-8", "replace")
+        record(conn, address, kind, f"{code} {message}"[:500])
+    return kind
+
+
+def parse_report(data):
+    """Return [(address, kind, detail)] for the failed recipients or complaint in one raw message."""
+    msg = email.message_from_bytes(data)
+    events = []
+    feedback = None
+    original_to = None
+    for part in msg.walk():
+        ctype = part.get_content_type()
+        if ctype == "message/delivery-status":
+            # The first block describes the message, the rest one recipient each
+            for block in part.get_payload():
+                recipient = block.get("Final-Recipient") or block.get("Original-Recipient")
+                if not recipient or (block.get("Action") or "").strip().lower() != "failed":
+                    continue
+                address = recipient.split(";", 1)[-1].strip().strip("<>")
+                status = (block.get("Status") or "").strip()
+                diagnostic = block.get("Diagnostic-Code") or ""
+                kind = classify_status(status) if status else classify_smtp(0, diagnostic)
+                if address and kind:
+                    events.append((address, kind, (f"{status} {diagnostic}".strip())[:500]))
+        elif ctype == "message/feedback-report":
+            payload = part.get_payload()
+            # Parsed as a message of header fields, or left as text by some generators
+            feedback = payload[0] if isinstance(payload, list) else email.message_from_string(payload)
+        elif ctype in ("message/rfc822", "text/rfc822-headers") and original_to is None:
+            payload = part.get_payload()
+            original = payload[0] if isinstance(payload, list) else email.message_from_string(payload)
+            original_to = original.get("To")
+    if feedback is not None and (feedback.get("Feedback-Type") or "abuse").strip().lower() != "not-spam":
+        address = parseaddr(feedback.get("Original-Rcpt-To") or original_to or "")[1]
+        if address:
+            events.append((address, COMPLAINT, f"feedback-type {feedback.get('Feedback-Type', 'abuse')}"))
+    return events
+
+
+def iter_mbox(path, offset=0):
+    """Yield (raw message, offset just past it) for each message after byte ``offset`` of an mbox."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        lines = []
+        pos = offset
+        prev_blank = True
+        for line in f:
+            if line.startswith(b"From ") and prev_blank and lines:
+                yield b"".join(lines), pos
+                lines = []
+            lines.append(line)
+            pos += len(line)
+            prev_blank = line in (b"\n", b"\r\n")
+        if lines:
+            yield b"".join(lines), pos
+
+
+def iter_maildir(path):
+    """Yield (raw message, file path) for each unread message in a Maildir."""
+    new = os.path.join(path, "new")
+    for name in sorted(os.listdir(new)):
+        src = os.path.join(new, name)
+        with open(src, "rb") as f:
+            yield f.read(), src
+
+
+class _Ingest:
+    """Routes each event to its address's shard and commits every COMMIT_EVERY messages."""
+
+    def __init__(self):
+        self.conns = {}
+        self.pending = 0
+        self.summary = {"messages": 0, HARD: 0, SOFT: 0, COMPLAINT: 0, "suppressed": 0, "unrecognized": 0}
+
+    def conn(self, shard):
+        if shard not in self.conns:
+            self.conns[shard] = get_db(shard)
+        return self.conns[shard]
+
+    def add(self, data):
+        events = parse_report(data)
+        self.summary["messages"] += 1
+        if not events:
+            self.summary["unrecognized"] += 1
+        for address, kind, detail in events:
+            conn = self.conn(shard_for_email(_canonical(address)))
+            self.summary[kind] += 1
+            if record(conn, address, kind, detail):
+                self.summary["suppressed"] += 1
+        self.pending += 1
+        return self.pending >= COMMIT_EVERY
+
+    def commit(self, mbox_path=None, offset=None):
+        shard0 = self.conn(0)
+        if mbox_path is not None:
+            # Saved with shard 0's events, which commit last: a crash replays at most one batch
+            shard0.execute("""
+                INSERT INTO bounce_sources (path, offset) VALUES (?, ?)
+                ON CONFLICT (path) DO UPDATE SET offset = excluded.offset
+            """, (mbox_path, offset))
+        for shard in sorted(self.conns, reverse=True):
+            self.conns[shard].commit()
+        self.pending = 0
+
+    def close(self):
+        for conn in self.conns.values():
+            conn.close()
+
+
+def ingest(path):
+    """Process the new bounce messages in an mbox file or Maildir folder. Returns a summary of counts."""
+    run = _Ingest()
+    try:
+        if os.path.isdir(path):
+            cur = os.path.join(path, "cur")
+            done = []
+            for data, src in iter_maildir(path):
+                done.append(src)
+                if run.add(data):
+                    run.commit()
+                    _mark_read(done, cur)
+            run.commit()
+            _mark_read(done, cur)
+        else:
+            mbox_path = os.path.abspath(path)
+            row = run.conn(0).execute("SELECT offset FROM bounce_sources WHERE path = ?", (mbox_path,)).fetchone()
+            offset = row[0] if row else 0
+            if offset > os.path.getsize(mbox_path):
+                # Truncated or rotated since the last run
+                offset = 0
+            for data, offset in iter_mbox(mbox_path, offset):
+                if run.add(data):
+                    run.commit(mbox_path, offset)
+            run.commit(mbox_path, offset)
+    finally:
+        # close() rolls back anything left uncommitted by an exception
+        run.close()
+    return run.summary
+
+
+def _mark_read(paths, cur):
+    for src in paths:
+        os.rename(src, os.path.join(cur, os.path.basename(src) + ":2,S"))
+    paths.clear()
+
+
+def unsuppress(address):
+    """Take ``address`` off the suppression list and forget its soft bounces. Returns True if it was listed."""
+    canonical = _canonical(address)
+    db = get_db(shard_for_email(canonical))
+    try:
+        removed = db.execute("DELETE FROM suppressions WHERE canonical_email = ?", (canonical,)).rowcount
+        db.execute("DELETE FROM soft_bounces WHERE canonical_email = ?", (canonical,))
+        db.commit()
+        return bool(removed)
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process bounces and manage the suppression list.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("ingest", help="read DSN bounces and complaint reports from mbox files or Maildirs")
+    p.add_argument("paths", nargs="+")
+    p = sub.add_parser("check", help="show whether an address is suppressed")
+    p.add_argument("email")
+    p = sub.add_parser("remove", help="take an address off the suppression list")
+    p.add_argument("email")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    check_schema()
+
+    if args.command == "ingest":
+        for path in args.paths:
+            summary = ingest(path)
+            print(f"{path}: {summary['messages']} messages, {summary[HARD]} hard, {summary[SOFT]} soft, "
+                  f"{summary[COMPLAINT]} complaints, {summary['suppressed']} suppressed, "
+                  f"{summary['unrecognized']} not bounces")
+    elif args.command == "check":
+        db = get_db(shard_for_email(_canonical(args.email)))
+        try:
+            reason = is_suppressed(db, args.email)
+        finally:
+            db.close()
+        print(f"{args.email}: suppressed ({reason})" if reason else f"{args.email}: not suppressed")
+    else:
+        if not unsuppress(args.email):
+            print(f"{args.email} was not suppressed", file=sys.stderr)
+            return 1
+        print(f"{args.email} removed from the suppression list")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
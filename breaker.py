@@ -0,0 +1,216 @@
+"""Circuit breaker around the SMTP server, shared by every process on the host.
+
+After SMTP_BREAKER_FAILURES connection-level failures in a row (timeouts, refused connections,
+dropped sessions; not refused recipients) the breaker opens and senders get CircuitOpenError
+straight away instead of each waiting for its own timeout. After SMTP_BREAKER_OPEN_SECONDS one
+caller, in whichever process gets there first, is let through as a probe ("half-open"): if it
+succeeds the breaker closes, if it fails it opens again. State lives in a small separate database
+file (BREAKER_DB), like the shared rate limiter's.
+
+    python breaker.py            # show the state
+    python breaker.py reset      # close it by hand
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+BREAKER_ENABLED = os.getenv("SMTP_BREAKER", "1") != "0"
+BREAKER_DB_PATH = os.path.abspath(os.getenv("BREAKER_DB", "breaker.db"))
+FAILURE_THRESHOLD = int(os.getenv("SMTP_BREAKER_FAILURES", "5"))
+OPEN_SECONDS = float(os.getenv("SMTP_BREAKER_OPEN_SECONDS", "30"))
+# How long a probe may take before another caller is allowed to try (covers a prober that died)
+PROBE_SECONDS = float(os.getenv("SMTP_BREAKER_PROBE_SECONDS", "60"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+# Gauge values for /metrics
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """The breaker is open; ``retry_after`` is the number of seconds until it lets a probe through."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} circuit is open, not trying for another {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = max(retry_after, 0.0)
+
+
+class Breaker:
+    """One named breaker. ``is_failure(exc)`` says whether an exception means the service is down."""
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, open_seconds=OPEN_SECONDS,
+                 probe_seconds=PROBE_SECONDS, path=BREAKER_DB_PATH, is_failure=None, enabled=BREAKER_ENABLED):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.probe_seconds = probe_seconds
+        self.path = path
+        self.is_failure = is_failure or (lambda exc: True)
+        self.enabled = enabled
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None or getattr(self.local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            # A lost update only means a few extra probes or failures
+            conn.execute("PRAGMA synchronous=OFF;")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS breakers (
+                    name TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    failures INTEGER NOT NULL,
+                    opened_at REAL,
+                    probe_until REAL,
+                    changed_at REAL
+                ) WITHOUT ROWID
+            """)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def _read(self, conn):
+        row = conn.execute(
+            "SELECT state, failures, opened_at, probe_until FROM breakers WHERE name = ?", (self.name,)
+        ).fetchone()
+        return row or (CLOSED, 0, None, None)
+
+    @contextmanager
+    def _locked(self):
+        """The current row under a write lock; the body returns through ``box["row"]`` to save it."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            box = {"old": self._read(conn)}
+            box["row"] = box["old"]
+            yield box
+            if box["row"] != box["old"]:
+                state, failures, opened_at, probe_until = box["row"]
+                conn.execute(
+                    "INSERT OR REPLACE INTO breakers (name, state, failures, opened_at, probe_until, changed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (self.name, state, failures, opened_at, probe_until, time.time()),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if box["row"][0] != box["old"][0]:
+            self._transition(box["old"][0], box["row"][0], box.get("why"))
+
+    def _transition(self, old, new, why):
+        log_at = log.warning if new == OPEN else log.info
+        log_at("%s circuit %s -> %s%s", self.name, old, new, f" ({why})" if why else "")
+        metrics.inc("email_list_breaker_transitions_total", breaker=self.name, state=new)
+
+    def before(self):
+        """Raise CircuitOpenError unless a call may go ahead. While half-open only one probe is let through."""
+        if not self.enabled:
+            return
+        try:
+            # Closed is the common case and needs no write lock
+            if self._read(self._conn())[0] == CLOSED:
+                return
+            now = time.time()
+            with self._locked() as box:
+                state, failures, opened_at, probe_until = box["row"]
+                if state == CLOSED:
+                    return
+                if state == OPEN and now < opened_at + self.open_seconds:
+                    raise CircuitOpenError(self.name, opened_at + self.open_seconds - now)
+                if state == HALF_OPEN and probe_until and now < probe_until:
+                    raise CircuitOpenError(self.name, probe_until - now)
+                box["row"] = (HALF_OPEN, failures, opened_at, now + self.probe_seconds)
+                box["why"] = "probing"
+        except sqlite3.Error:
+            # Fail open: a broken breaker file must not stop mail
+            log.exception("%s circuit breaker state unavailable", self.name)
+
+    def success(self):
+        if not self.enabled:
+            return
+        try:
+            if self._read(self._conn())[:2] == (CLOSED, 0):
+                return
+            with self._locked() as box:
+                box["row"] = (CLOSED, 0, None, None)
+                box["why"] = "call succeeded"
+        except sqlite3.Error:
+            log.exception("%s circuit breaker state unavailable", self.name)
+
+    def failure(self, exc=None):
+        if not self.enabled:
+            return
+        try:
+            now = time.time()
+            with self._locked() as box:
+                state, failures, opened_at, probe_until = box["row"]
+                failures += 1
+                if state == HALF_OPEN or (state == CLOSED and failures >= self.failure_threshold):
+                    box["row"] = (OPEN, failures, now, None)
+                    box["why"] = f"{failures} failures in a row, last: {exc}" if exc else f"{failures} failures in a row"
+                else:
+                    box["row"] = (state, failures, opened_at, probe_until)
+        except sqlite3.Error:
+            log.exception("%s circuit breaker state unavailable", self.name)
+
+    @contextmanager
+    def guard(self):
+        """Run the body through the breaker: fail fast while open, and record how the call went."""
+        self.before()
+        try:
+            yield
+        except Exception as e:
+            if self.is_failure(e):
+                self.failure(e)
+            else:
+                # The service answered, it just didn't like this call
+                self.success()
+            raise
+        self.success()
+
+    def snapshot(self):
+        """{"state", "failures", "opened_at"} as currently stored."""
+        try:
+            state, failures, opened_at, _ = self._read(self._conn())
+        except sqlite3.Error:
+            log.exception("%s circuit breaker state unavailable", self.name)
+            state, failures, opened_at = CLOSED, 0, None
+        return {"state": state, "failures": failures, "opened_at": opened_at}
+
+    def reset(self):
+        with self._locked() as box:
+            box["row"] = (CLOSED, 0, None, None)
+            box["why"] = "reset by hand"
+
+
+def main(argv=None):
+    from email_utils import SMTP_BREAKER
+
+    parser = argparse.ArgumentParser(description="Show or reset the SMTP circuit breaker.")
+    parser.add_argument("command", nargs="?", choices=["status", "reset"], default="status")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "reset":
+        SMTP_BREAKER.reset()
+    info = SMTP_BREAKER.snapshot()
+    line = f"{SMTP_BREAKER.name}: {info['state']}, {info['failures']} failure(s) in a row"
+    if info["state"] == OPEN:
+        line += f", opened {time.time() - info['opened_at']:.0f}s ago"
+    print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
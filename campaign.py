@@ -0,0 +1,379 @@
+"""Bulk campaign sender.
+
+Streams eligible subscribers (``send = 1 AND verified = 1``) in id order, fans them out across
+several persistent SMTP connections and records every recipient in ``campaign_deliveries``
+before and after the send, so an interrupted campaign resumes without double-sending.
+
+    python campaign.py create --subject "News" --body-file news.txt
+    python campaign.py send 1 --connections 4 --rate 2
+    python campaign.py status 1
+"""
+import argparse
+import logging
+import queue
+import smtplib
+import sys
+import threading
+import time
+from datetime import datetime
+
+import metrics
+from bounces import is_suppressed, record_smtp_failure
+from breaker import CircuitOpenError
+from db import get_db, shard_for_id
+from email_utils import build_message, list_unsubscribe_headers, open_smtp, send_message, unsubscribe_url
+from migrations import check_schema
+from storage import all_shards, iter_subscribers
+from validation import validate_many
+
+log = logging.getLogger(__name__)
+
+PAGE_SIZE = 1000
+# A connection that fails this many times in a row stops the whole run; it can be resumed later
+MAX_CONNECTION_FAILURES = 3
+
+
+def create_campaign(subject, body):
+    db = get_db()
+    try:
+        cur = db.execute(
+            "INSERT INTO campaigns (subject, body, status, created_at) VALUES (?, ?, 'draft', ?)",
+            (subject, body, datetime.utcnow().isoformat()),
+        )
+        db.commit()
+        return cur.lastrowid
+    finally:
+        db.close()
+
+
+def campaign_progress(campaign_id):
+    """Return the campaign row plus a count of deliveries per status, summed over the shards."""
+    db = get_db()
+    try:
+        campaign = db.execute("SELECT * FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        if not campaign:
+            return None
+    finally:
+        db.close()
+    counts = {}
+    with all_shards() as conns:
+        for conn in conns:
+            for status, count in conn.execute(
+                "SELECT status, COUNT(*) FROM campaign_deliveries WHERE campaign_id = ? GROUP BY status",
+                (campaign_id,),
+            ):
+                counts[status] = counts.get(status, 0) + count
+    return {"campaign": dict(campaign), "deliveries": counts}
+
+
+def iter_recipients(campaign_id, page_size=PAGE_SIZE, retry_unknown=False, retry_failed=False):
+    """Yield (id, email) for subscribers that still need this campaign, across every shard in id order.
+
+    Uses keyset pagination on id so memory stays flat and no read transaction is held while sending.
+    Recipients left in 'sending' by a crash are skipped unless ``retry_unknown`` is set, because
+    we cannot tell whether the server accepted them. Addresses that fail validation are marked failed.
+    """
+    redo = []
+    if retry_unknown:
+        redo.append("sending")
+    if retry_failed:
+        redo.append("failed")
+    redo_sql = ""
+    if redo:
+        redo_sql = " AND d.status NOT IN (%s)" % ", ".join("?" for _ in redo)
+
+    where = f"""
+        s.send = 1 AND s.verified = 1
+        AND NOT EXISTS (
+            SELECT 1 FROM campaign_deliveries d
+            WHERE d.campaign_id = ? AND d.subscriber_id = s.id{redo_sql}
+        )
+    """
+    page = []
+    for row in iter_subscribers("s.id, s.email", where, (campaign_id, *redo), page_size):
+        page.append((row["id"], row["email"]))
+        if len(page) >= page_size:
+            yield from _checked(campaign_id, page)
+    yield from _checked(campaign_id, page)
+
+
+def _checked(campaign_id, page):
+    """Yield the page's recipients that still pass validation; record the rest as failed, never sent."""
+    blocked = {}
+    for (subscriber_id, email), result in zip(page, validate_many(email for _, email in page)):
+        if result.reason:
+            # e.g. the domain was added to the blocklist after they signed up
+            blocked.setdefault(shard_for_id(subscriber_id), []).append(subscriber_id)
+        else:
+            yield subscriber_id, email
+    page.clear()
+    now = datetime.utcnow().isoformat()
+    for shard, ids in blocked.items():
+        db = get_db(shard)
+        try:
+            db.executemany("""
+                INSERT INTO campaign_deliveries (campaign_id, subscriber_id, status, error, updated_at)
+                VALUES (?, ?, 'failed', 'blocked address', ?)
+                ON CONFLICT (campaign_id, subscriber_id) DO UPDATE
+                SET status = excluded.status, error = excluded.error, updated_at = excluded.updated_at
+            """, [(campaign_id, subscriber_id, now) for subscriber_id in ids])
+            db.commit()
+        finally:
+            db.close()
+
+
+def _record(db, campaign_id, subscriber_id, status, error=None):
+    db.execute("""
+        INSERT INTO campaign_deliveries (campaign_id, subscriber_id, status, error, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (campaign_id, subscriber_id) DO UPDATE
+        SET status = excluded.status, error = excluded.error, updated_at = excluded.updated_at
+    """, (campaign_id, subscriber_id, status, error, datetime.utcnow().isoformat()))
+    db.commit()
+
+
+class _Sender(threading.Thread):
+    """One persistent SMTP connection, paced to at most ``rate`` messages per second."""
+
+    def __init__(self, index, campaign, work, abort, rate=None):
+        super().__init__(name=f"campaign-sender-{index}", daemon=True)
+        self.campaign = campaign
+        self.work = work
+        self.abort = abort
+        self.interval = 1.0 / rate if rate else 0.0
+        self.smtp = None
+        # Deliveries live next to their subscriber, so one connection per shard, opened on first use
+        self.dbs = {}
+        self.sent = 0
+        self.failed = 0
+
+    def _db(self, subscriber_id):
+        shard = shard_for_id(subscriber_id)
+        if shard not in self.dbs:
+            self.dbs[shard] = get_db(shard)
+        return self.dbs[shard]
+
+    def _connection(self):
+        if self.smtp is None:
+            self.smtp = open_smtp()
+        return self.smtp
+
+    def _disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+            self.smtp = None
+
+    def run(self):
+        campaign_id = self.campaign["id"]
+        failures = 0
+        next_slot = time.monotonic()
+        try:
+            while True:
+                item = self.work.get()
+                if item is None or self.abort.is_set():
+                    return
+                subscriber_id, email = item
+                db = self._db(subscriber_id)
+                # Checked here rather than when queueing, so a bounce that arrives mid-campaign counts
+                reason = is_suppressed(db, email)
+                if reason:
+                    metrics.inc("email_list_suppressed_total", sender="campaign")
+                    _record(db, campaign_id, subscriber_id, "failed", f"suppressed ({reason})")
+                    self.failed += 1
+                    continue
+
+                if self.interval:
+                    delay = next_slot - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_slot = max(next_slot, time.monotonic()) + self.interval
+
+                # Every recipient gets their own signed unsubscribe link, in the footer and the headers
+                unsubscribe = unsubscribe_url(email)
+                body = f"{self.campaign['body']}\n\n--\nUnsubscribe: {unsubscribe}\n"
+                msg = build_message(email, self.campaign["subject"], body, list_unsubscribe_headers(unsubscribe))
+                # Checkpoint before contacting SMTP so a crash mid-send is never silently resent
+                _record(db, campaign_id, subscriber_id, "sending")
+                while True:
+                    try:
+                        with metrics.timed("smtp", route="campaign"):
+                            send_message(self._connection(), msg)
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as e:
+                        metrics.inc("email_list_smtp_failures_total", sender="campaign", kind="refused")
+                        record_smtp_failure(db, email, e)
+                        _record(db, campaign_id, subscriber_id, "failed", str(e)[:500])
+                        self.failed += 1
+                        break
+                    except Exception as e:
+                        log.warning("Connection error sending campaign %s to %s: %s", campaign_id, email, e)
+                        metrics.inc("email_list_smtp_failures_total", sender="campaign", kind="error")
+                        self._disconnect()
+                        failures += 1
+                        if isinstance(e, CircuitOpenError):
+                            # Failing fast; give the breaker time to probe the server before the next try
+                            self.abort.wait(e.retry_after)
+                        if failures < MAX_CONNECTION_FAILURES and not self.abort.is_set():
+                            continue
+                        log.error("%s giving up after %d connection failures", self.name, failures)
+                        # Nothing was accepted, so forget the checkpoint and let a resume pick it up
+                        db.execute(
+                            "DELETE FROM campaign_deliveries WHERE campaign_id = ? AND subscriber_id = ?",
+                            (campaign_id, subscriber_id),
+                        )
+                        db.commit()
+                        self.abort.set()
+                        return
+                    failures = 0
+                    metrics.inc("email_list_smtp_sent_total", sender="campaign")
+                    _record(db, campaign_id, subscriber_id, "sent")
+                    self.sent += 1
+                    break
+        except Exception:
+            # E.g. the database is locked or gone. Stop the whole run rather than leave the producer waiting
+            # on a queue nobody drains; the campaign is paused and a resume picks up from the checkpoints
+            log.exception("%s failed", self.name)
+            self.abort.set()
+        finally:
+            self._disconnect()
+            for db in self.dbs.values():
+                db.close()
+
+
+def send_campaign(campaign_id, connections=4, rate=None, retry_unknown=False, retry_failed=False,
+                  progress_every=1000):
+    """Send (or resume) a campaign across ``connections`` SMTP sessions.
+
+    ``rate`` caps messages per second on each connection. Returns a dict with sent/failed counts
+    and whether the run completed.
+    """
+    db = get_db()
+    try:
+        campaign = db.execute("SELECT * FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        if not campaign:
+            raise ValueError(f"Campaign {campaign_id} does not exist")
+        campaign = dict(campaign)
+        db.execute(
+            "UPDATE campaigns SET status = 'sending', started_at = COALESCE(started_at, ?) WHERE id = ?",
+            (datetime.utcnow().isoformat(), campaign_id),
+        )
+        db.commit()
+    finally:
+        db.close()
+
+    work = queue.Queue(maxsize=connections * 100)
+    abort = threading.Event()
+    senders = [_Sender(i, campaign, work, abort, rate) for i in range(connections)]
+    for s in senders:
+        s.start()
+
+    queued = 0
+    started = time.monotonic()
+    try:
+        for item in iter_recipients(campaign_id, retry_unknown=retry_unknown, retry_failed=retry_failed):
+            while not abort.is_set():
+                try:
+                    work.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    if not abort.is_set() and not any(s.is_alive() for s in senders):
+                        log.error("Campaign %s: every sender has stopped", campaign_id)
+                        abort.set()
+            if abort.is_set():
+                break
+            queued += 1
+            if progress_every and queued % progress_every == 0:
+                elapsed = time.monotonic() - started
+                log.info("Campaign %s: %d queued, %.1f msg/s", campaign_id, queued, queued / elapsed if elapsed else 0)
+    finally:
+        for _ in senders:
+            while True:
+                try:
+                    work.put(None, timeout=0.5)
+                    break
+                except queue.Full:
+                    if not any(s.is_alive() for s in senders):
+                        abort.set()
+                    if abort.is_set():
+                        # Senders are exiting; drop what is still queued, it was never checkpointed
+                        _drain(work)
+        for s in senders:
+            s.join()
+
+    completed = not abort.is_set()
+    db = get_db()
+    try:
+        if completed:
+            db.execute(
+                "UPDATE campaigns SET status = 'done', finished_at = ? WHERE id = ?",
+                (datetime.utcnow().isoformat(), campaign_id),
+            )
+        else:
+            db.execute("UPDATE campaigns SET status = 'paused' WHERE id = ?", (campaign_id,))
+        db.commit()
+    finally:
+        db.close()
+
+    return {
+        "sent": sum(s.sent for s in senders),
+        "failed": sum(s.failed for s in senders),
+        "completed": completed,
+        "seconds": round(time.monotonic() - started, 2),
+    }
+
+
+def _drain(work):
+    try:
+        while True:
+            work.get_nowait()
+    except queue.Empty:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send a campaign to every verified, subscribed address.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_create = sub.add_parser("create", help="create a campaign")
+    p_create.add_argument("--subject", required=True)
+    p_create.add_argument("--body-file", required=True, help="plain-text body; '-' reads stdin")
+
+    p_send = sub.add_parser("send", help="send or resume a campaign")
+    p_send.add_argument("campaign_id", type=int)
+    p_send.add_argument("--connections", type=int, default=4, help="parallel SMTP connections")
+    p_send.add_argument("--rate", type=float, default=None, help="max messages per second per connection")
+    p_send.add_argument("--retry-unknown", action="store_true",
+                        help="resend recipients whose outcome was lost in a crash (may double-send)")
+    p_send.add_argument("--retry-failed", action="store_true", help="retry recipients the server refused")
+
+    p_status = sub.add_parser("status", help="show campaign progress")
+    p_status.add_argument("campaign_id", type=int)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    check_schema()
+
+    if args.command == "create":
+        if args.body_file == "-":
+            body = sys.stdin.read()
+        else:
+            with open(args.body_file, "r", encoding="utf-8") as f:
+                body = f.read()
+        print(create_campaign(args.subject, body))
+    elif args.command == "send":
+        result = send_campaign(args.campaign_id, args.connections, args.rate, args.retry_unknown, args.retry_failed)
+        print(result)
+        if not result["completed"]:
+            sys.exit(1)
+    elif args.command == "status":
+        progress = campaign_progress(args.campaign_id)
+        if progress is None:
+            print(f"Campaign {args.campaign_id} does not exist", file=sys.stderr)
+            sys.exit(1)
+        print(progress)
+
+
+if __name__ == "__main__":
+    main()
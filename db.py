@@ -1,66 +1,175 @@
-import logging
-import sqlite3
-import os
-
-log = logging.getLogger(__name__)
-DB_PATH = os.path.abspath("emails.db")
-
-
-def get_db():
-    # Use absolute path and a longer timeout to reduce 'database is locked' errors.
-    conn = sqlite3.connect(DB_PATH, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.row_factory = sqlite3.Row
-    try:
-        # attempt to enable WAL for better concurrency; ignore if not supported
-        conn.execute("PRAGMA journal_mode=WAL;")
-    except sqlite3.DatabaseError:
-        pass
-    return conn
-
-
-def init_db():
-    """Create the table if missing, keep 'time', and ensure the 'send' boolean (INTEGER) column exists.
-
-    If an older DB has an 'active' column, migrate its values into 'send'.
-    """
-    conn = None
-    try:
-        conn = get_db()
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS subscribers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE NOT NULL,
-                time TEXT,
-                send INTEGER DEFAULT 1
-            )
-        """)
-        # Inspect columns and add/repair as needed
-        cur = conn.execute("PRAGMA table_info(subscribers);")
-        cols = [row[1] for row in cur.fetchall()]
-        if "time" not in cols:
-            conn.execute("ALTER TABLE subscribers ADD COLUMN time TEXT")
-        if "send" not in cols:
-            # If an old 'active' column exists, add 'send' and populate from it
-            conn.execute("ALTER TABLE subscribers ADD COLUMN send INTEGER DEFAULT 1")
-            if "active" in cols:
-                conn.execute("UPDATE subscribers SET send = active WHERE active IS NOT NULL")
-            conn.execute("UPDATE subscribers SET send = 1 WHERE send IS NULL")
-
-        # Ensure verification-related columns exist for signup/verify flow
-        if "verified" not in cols:
-            conn.execute("ALTER TABLE subscribers ADD COLUMN verified INTEGER DEFAULT 0")
-            conn.execute("UPDATE subscribers SET verified = 0 WHERE verified IS NULL")
-        if "verification_code" not in cols:
-            conn.execute("ALTER TABLE subscribers ADD COLUMN verification_code TEXT")
-        if "code_expires_at" not in cols:
-            conn.execute("ALTER TABLE subscribers ADD COLUMN code_expires_at TEXT")
-
-        # If send exists but active exists too, leave active untouched but prefer 'send'
-        conn.commit()
-    except Exception as e:
-        # Log the error so failures to initialize don't remain silent
-        log.exception("Failed to initialize the database: %s", e)
-        raise
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+import hashlib
+import logging
+import queue
+import sqlite3
+import os
+import time
+
+import metrics
+
+log = logging.getLogger(__name__)
+DB_PATH = os.path.abspath("emails.db")
+
+# Number of SQLite files subscribers are spread over (change it with reshard.py); 1 keeps everything in DB_PATH
+SHARDS = int(os.getenv("DB_SHARDS", "1"))
+# Subscriber ids on shard i start above i << ID_SHARD_BITS, so an id alone says which file holds the row
+ID_SHARD_BITS = 40
+
+# Idle connections kept per process; extra ones are closed when returned
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# Prepared statements cached per connection, reused for as long as the connection lives
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_KB", "16384"))
+MMAP_SIZE = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "30000"))
+
+
+
+def shard_paths(count=SHARDS, base=DB_PATH):
+    """Database files for a layout of ``count`` shards: just ``base`` for 1, else emails.0-of-4.db etc."""
+    if count == 1:
+        return [base]
+    root, ext = os.path.splitext(base)
+    return [f"{root}.{i}-of-{count}{ext}" for i in range(count)]
+
+
+DB_PATHS = shard_paths()
+
+
+def shard_for_email(canonical, count=SHARDS):
+    """Shard holding a subscriber, from the canonical address (so every variant lands on the same file)."""
+    if count == 1:
+        return 0
+    digest = hashlib.blake2b(canonical.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def shard_for_id(subscriber_id):
+    return subscriber_id >> ID_SHARD_BITS
+
+
+# One pool per database file
+_pools = {}
+_pool_pid = os.getpid()
+# Connections inherited from a parent process; referenced so they are never closed in the child
+_inherited_pools = []
+
+
+class PooledConnection(sqlite3.Connection):
+    """A connection whose close() hands it back to the pool instead of closing it.
+
+    Any uncommitted transaction is rolled back first, so the next user starts clean.
+    """
+
+    def close(self):
+        if getattr(self, "_pooled", False):
+            return
+        try:
+            if self.in_transaction:
+                self.rollback()
+        except sqlite3.ProgrammingError:
+            # Already closed for real
+            return
+        pool = _pools.get(self._path)
+        if self._pid != os.getpid() or pool is None:
+            self.close_for_real()
+            return
+        self._pooled = True
+        try:
+            pool.put_nowait(self)
+        except queue.Full:
+            self._pooled = False
+            self.close_for_real()
+
+    def close_for_real(self):
+        super().close()
+
+    # Statement calls are timed as the "db" phase of the current request and lock errors are counted
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        except sqlite3.OperationalError as e:
+            metrics.inc("email_list_db_errors_total", kind="locked" if "locked" in str(e) else "other")
+            raise
+        finally:
+            metrics.record_phase("db", time.perf_counter() - started)
+
+    def execute(self, *args):
+        return self._timed(super().execute, *args)
+
+    def executemany(self, *args):
+        return self._timed(super().executemany, *args)
+
+    def commit(self):
+        return self._timed(super().commit)
+
+
+def _connect(path=DB_PATH):
+    # Use absolute path and a longer timeout to reduce 'database is locked' errors.
+    conn = sqlite3.connect(
+        path,
+        timeout=30,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        factory=PooledConnection,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        # Pooled connections may be handed to a different thread, but only one uses them at a time
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    conn._pid = os.getpid()
+    conn._path = path
+    conn._pooled = False
+    # Lets maintenance.py hand free pages back. Only takes effect on a new, empty file, and has to come
+    # before switching to WAL; older files are converted with `python maintenance.py --enable-incremental-vacuum`.
+    # Setting it takes the write lock, so only try on an empty file
+    if conn.execute("PRAGMA page_count;").fetchone()[0] == 0:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    try:
+        # attempt to enable WAL for better concurrency; ignore if not supported
+        conn.execute("PRAGMA journal_mode=WAL;")
+    except sqlite3.DatabaseError:
+        pass
+    # Per-connection settings, applied once when the connection is created rather than per request.
+    # synchronous=NORMAL is durable across application crashes in WAL mode.
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB};")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE};")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS};")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    return conn
+
+
+def get_db(shard=0):
+    """Return a connection to ``shard`` from the per-process pool, opening one only if none is idle.
+
+    Callers must close() it on every exit path (try/finally); that returns it to the pool.
+    """
+    global _pools, _pool_pid
+    if _pool_pid != os.getpid():
+        # Forked (e.g. gunicorn workers): never share SQLite handles with the parent
+        _inherited_pools.append(_pools)
+        _pools = {}
+        _pool_pid = os.getpid()
+
+    path = DB_PATHS[shard]
+    pool = _pools.get(path)
+    if pool is None:
+        pool = _pools.setdefault(path, queue.LifoQueue(maxsize=POOL_SIZE))
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        return _connect(path)
+    conn._pooled = False
+    return conn
+
+
+def close_pool():
+    """Close every idle pooled connection in this process."""
+    for pool in list(_pools.values()):
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close_for_real()
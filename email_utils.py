@@ -1,44 +1,132 @@
-import logging
-import smtplib
-import os
-from email.message import EmailMessage
-
-log = logging.getLogger(__name__)
-
-GMAIL_USER = os.getenv("GMAIL_USER")
-GMAIL_APP_PASSWORD = os.getenv("GMAIL_APP_PASSWORD")
-
-
-def send_verification_email(to_email, code):
-    """Send a verification email via Gmail SMTP. Raises RuntimeError when credentials are missing and re-raises other exceptions so callers can react."""
-    if not GMAIL_USER or not GMAIL_APP_PASSWORD:
-        log.error("Email credentials not configured. Set GMAIL_USER and GMAIL_APP_PASSWORD environment variables.")
-        raise RuntimeError("Email credentials not configured")
-
-    msg = EmailMessage()
-    msg["From"] = GMAIL_USER
-    msg["To"] = to_email
-    msg["Subject"] = "Your Verification Code"
-
-    msg.set_content(f"""
-Hi!
-
-Your verification code is:
-
-{code}
-
-This code will expire in 10 minutes.
-
-If you did not request this, you can safely ignore this email.
-""")
-
-    try:
-        log.info("Sending verification email to %s", to_email)
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login(GMAIL_USER, GMAIL_APP_PASSWORD)
-            smtp.send_message(msg)
-        log.info("Verification email sent to %s", to_email)
-    except Exception:
-        log.exception("Failed to send verification email to %s", to_email)
-        raise
-    
\ No newline at end of file
+import hashlib
+import logging
+import secrets
+import smtplib
+import os
+from email.message import EmailMessage
+
+from breaker import Breaker
+from tokens import VERIFY_LINK_TTL_SECONDS, unsubscribe_token, verify_token
+
+log = logging.getLogger(__name__)
+
+GMAIL_USER = os.getenv("GMAIL_USER")
+GMAIL_APP_PASSWORD = os.getenv("GMAIL_APP_PASSWORD")
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+# Implicit TLS like Gmail's port 465; set SMTP_SSL=0 for a plain local server (e.g. the benchmark sink)
+SMTP_SSL = os.getenv("SMTP_SSL", "1") != "0"
+# Seconds to wait for the server to accept the connection (and log in), then per command while sending
+SMTP_CONNECT_TIMEOUT = float(os.getenv("SMTP_CONNECT_TIMEOUT", "10"))
+SMTP_SEND_TIMEOUT = float(os.getenv("SMTP_SEND_TIMEOUT", "30"))
+
+# Where the site is reachable from a mail client; used for the links in emails
+PUBLIC_URL = os.getenv("PUBLIC_URL", "http://127.0.0.1:5000").rstrip("/")
+
+VERIFICATION_SUBJECT = "Your Verification Code"
+CODE_TTL_MINUTES = 10
+
+
+def _is_outage(exc):
+    # A refused recipient, sender or message means the server is up and answering
+    return not isinstance(exc, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError))
+
+
+SMTP_BREAKER = Breaker("smtp", is_failure=_is_outage)
+
+
+def generate_code():
+    return f"{secrets.randbelow(1_000_000):06d}"
+
+
+def hash_code(code: str) -> str:
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+def verify_url(email, ttl_seconds=VERIFY_LINK_TTL_SECONDS):
+    return f"{PUBLIC_URL}/verify/{verify_token(email, ttl_seconds)}"
+
+
+def unsubscribe_url(email):
+    return f"{PUBLIC_URL}/unsubscribe/{unsubscribe_token(email)}"
+
+
+def list_unsubscribe_headers(url):
+    """RFC 2369/8058 headers for an unsubscribe_url(), so mail clients can offer a one-click button."""
+    return {
+        "List-Unsubscribe": f"<{url}>",
+        "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
+    }
+
+
+def verification_body(code, ttl_minutes=CODE_TTL_MINUTES, link=None):
+    link_text = f"""
+Or open this link to confirm:
+
+{link}
+""" if link else ""
+    return f"""
+Hi!
+
+Your verification code is:
+
+{code}
+
+This code will expire in {ttl_minutes} minutes.
+{link_text}
+If you did not request this, you can safely ignore this email.
+"""
+
+
+def build_message(to_email, subject, body, headers=None):
+    msg = EmailMessage()
+    msg["From"] = GMAIL_USER
+    msg["To"] = to_email
+    msg["Subject"] = subject
+    for name, value in (headers or {}).items():
+        msg[name] = value
+    msg.set_content(body)
+    return msg
+
+
+def open_smtp():
+    """Open and log in to an SMTP session. The caller owns the connection and should reuse it for several messages.
+
+    Raises CircuitOpenError without connecting while the SMTP breaker is open.
+    """
+    if not GMAIL_USER or not GMAIL_APP_PASSWORD:
+        log.error("Email credentials not configured. Set GMAIL_USER and GMAIL_APP_PASSWORD environment variables.")
+        raise RuntimeError("Email credentials not configured")
+
+    with SMTP_BREAKER.guard():
+        if SMTP_SSL:
+            smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_CONNECT_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_CONNECT_TIMEOUT)
+        try:
+            smtp.login(GMAIL_USER, GMAIL_APP_PASSWORD)
+            smtp.sock.settimeout(SMTP_SEND_TIMEOUT)
+        except Exception:
+            smtp.close()
+            raise
+    return smtp
+
+
+def send_message(smtp, msg):
+    """smtp.send_message(msg) through the SMTP breaker, so it fails fast with CircuitOpenError while the server is down."""
+    with SMTP_BREAKER.guard():
+        smtp.send_message(msg)
+
+
+def send_verification_email(to_email, code):
+    """Send a verification email via Gmail SMTP. Raises RuntimeError when credentials are missing and re-raises other exceptions so callers can react."""
+    msg = build_message(to_email, VERIFICATION_SUBJECT, verification_body(code))
+
+    try:
+        log.info("Sending verification email to %s", to_email)
+        with open_smtp() as smtp:
+            send_message(smtp, msg)
+        log.info("Verification email sent to %s", to_email)
+    except Exception:
+        log.exception("Failed to send verification email to %s", to_email)
+        raise
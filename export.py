@@ -0,0 +1,208 @@
+"""Stream the subscriber list out of the database as CSV or JSONL.
+
+    python export.py --format csv --verified 1 --send 1 -o list.csv
+    python export.py --format jsonl --since 2024-01-01 -o new.jsonl --resume
+
+The same export is served at ``/export`` when EXPORT_TOKEN is set (send it as
+``Authorization: Bearer <token>``), with the filters as query parameters:
+``format``, ``send``, ``verified``, ``since``, ``until`` (ISO times, until is exclusive),
+``after`` and ``limit``.
+
+Rows come out in id order through storage.iter_subscribers(), one keyset page at a time, so memory
+stays flat at any list size and each page is its own short read: nothing holds a snapshot open
+long enough to stall WAL checkpoints. Pages are also bounded to an id window (WINDOW_IDS), so a
+filter that matches few rows can't turn one page into a scan of most of the table. Every row
+carries its id, and ``after=<last id>`` (or ``--resume``) continues an interrupted export where it
+stopped.
+"""
+import argparse
+import csv
+import hmac
+import io
+import json
+import os
+import sys
+
+from flask import Blueprint, Response, abort, request
+
+from migrations import check_schema
+from storage import iter_subscribers
+
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+FIELDS = ("id", "email", "time", "send", "verified")
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+PAGE_SIZE = 2000
+# Most ids one page query may look at, whatever the filters
+WINDOW_IDS = 20 * PAGE_SIZE
+# Rows per chunk handed to the socket or file
+CHUNK_ROWS = 500
+
+export_bp = Blueprint("export", __name__)
+
+
+def _flag(value):
+    """'1'/'0' (also yes/no, true/false) -> 1/0; None or '' -> None (no filter)."""
+    if value is None or value == "":
+        return None
+    value = str(value).strip().lower()
+    if value in ("1", "yes", "true"):
+        return 1
+    if value in ("0", "no", "false"):
+        return 0
+    raise ValueError(f"expected 1 or 0, got {value!r}")
+
+
+def iter_rows(send=None, verified=None, since=None, until=None, after_id=0, limit=None, page_size=PAGE_SIZE):
+    """Yield subscriber rows matching the filters, in id order, starting after ``after_id``."""
+    clauses, params = [], []
+    if send is not None:
+        # Legacy rows may have NULL send; they count as subscribed, like everywhere else
+        clauses.append("COALESCE(s.send, 1) = ?")
+        params.append(send)
+    if verified is not None:
+        clauses.append("COALESCE(s.verified, 0) = ?")
+        params.append(verified)
+    if since:
+        clauses.append("s.time >= ?")
+        params.append(since)
+    if until:
+        clauses.append("s.time < ?")
+        params.append(until)
+    rows = iter_subscribers(
+        ", ".join(f"s.{field}" for field in FIELDS),
+        " AND ".join(clauses) or "1",
+        params,
+        page_size=page_size,
+        after_id=after_id,
+        window=max(WINDOW_IDS, page_size),
+    )
+    for n, row in enumerate(rows):
+        if limit is not None and n >= limit:
+            return
+        yield row
+
+
+def _record(row):
+    return {
+        "id": row["id"],
+        "email": row["email"],
+        "time": row["time"],
+        "send": 0 if row["send"] == 0 else 1,
+        "verified": 1 if row["verified"] else 0,
+    }
+
+
+def iter_export(rows, fmt="csv", header=True):
+    """Encode ``rows`` as CSV or JSONL text, yielding a chunk every CHUNK_ROWS rows."""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=FIELDS) if fmt == "csv" else None
+    if writer and header:
+        writer.writeheader()
+    n = 0
+    for row in rows:
+        record = _record(row)
+        if writer:
+            writer.writerow(record)
+        else:
+            buf.write(json.dumps(record))
+            buf.write("\n")
+        n += 1
+        if n % CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def _resume_point(path, fmt):
+    """(last id, size) for a previous export: the id of its last complete row (0 if none) and the
+    file size without any half-written line the interruption left behind."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        start = max(0, size - 64 * 1024)
+        f.seek(start)
+        tail = f.read()
+    if not tail.endswith(b"\n"):
+        cut = tail.rfind(b"\n") + 1
+        size = start + cut
+        tail = tail[:cut]
+    for line in reversed(tail.decode("utf-8", "replace").splitlines()):
+        try:
+            if fmt == "jsonl":
+                return int(json.loads(line)["id"]), size
+            return int(next(csv.reader([line]))[0]), size
+        except (ValueError, KeyError, IndexError, TypeError):
+            # the header, or the first line of the tail cut in half
+            continue
+    return 0, size
+
+
+@export_bp.route("/export")
+def export():
+    if not EXPORT_TOKEN:
+        abort(404)
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode("utf-8"), f"Bearer {EXPORT_TOKEN}".encode("utf-8")):
+        abort(401)
+
+    fmt = request.args.get("format", "csv")
+    if fmt not in FORMATS:
+        return f"format must be one of {', '.join(FORMATS)}", 400
+    try:
+        rows = iter_rows(
+            send=_flag(request.args.get("send")),
+            verified=_flag(request.args.get("verified")),
+            since=request.args.get("since") or None,
+            until=request.args.get("until") or None,
+            after_id=int(request.args.get("after", 0)),
+            limit=int(request.args["limit"]) if request.args.get("limit") else None,
+        )
+    except ValueError as e:
+        return f"Bad filter: {e}", 400
+    return Response(
+        iter_export(rows, fmt),
+        mimetype=FORMATS[fmt],
+        headers={
+            "Content-Disposition": f"attachment; filename=subscribers.{fmt}",
+            "Cache-Control": "no-store",
+        },
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export subscribers as CSV or JSONL.")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("--send", type=_flag, help="1 for subscribed, 0 for unsubscribed")
+    parser.add_argument("--verified", type=_flag, help="1 for verified, 0 for unverified")
+    parser.add_argument("--since", help="subscribed at or after this ISO time")
+    parser.add_argument("--until", help="subscribed before this ISO time")
+    parser.add_argument("--after", type=int, default=0, help="start after this subscriber id")
+    parser.add_argument("--limit", type=int, help="stop after this many rows")
+    parser.add_argument("-o", "--output", help="write here instead of stdout")
+    parser.add_argument("--resume", action="store_true",
+                        help="append to --output, continuing after the last id already in it")
+    args = parser.parse_args(argv)
+    if args.resume and not args.output:
+        parser.error("--resume needs --output")
+
+    check_schema()
+    after_id, header = args.after, True
+    if args.resume and os.path.exists(args.output) and os.path.getsize(args.output):
+        last_id, size = _resume_point(args.output, args.format)
+        os.truncate(args.output, size)
+        after_id, header = max(after_id, last_id), size == 0
+    rows = iter_rows(args.send, args.verified, args.since, args.until, after_id, args.limit)
+
+    out = open(args.output, "a" if args.resume else "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        for chunk in iter_export(rows, args.format, header):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Bulk import of subscriber lists from CSV or JSONL.
+
+    python importer.py contacts.csv --verified
+    python importer.py contacts.jsonl --queue-verification --rejects rejects.csv
+
+Addresses are validated a batch at a time with the same rules as the signup form (including the
+disposable-domain blocklist), deduplicated by canonical form within the file and against ``subscribers``, and inserted in large
+transactions. CSV input needs an ``email`` column (or has the address in the first column);
+JSONL lines are objects with an ``email`` key or bare JSON strings. An optional ``time``
+column/key is kept as the subscription time.
+"""
+import argparse
+import csv
+import json
+import logging
+import time as time_mod
+from datetime import datetime
+
+import journal
+from db import SHARDS, shard_for_email
+from email_utils import generate_code, hash_code
+from migrations import check_schema
+from outbox import enqueue_verification_email
+from storage import all_shards
+from subscriptions import append_subscriptions
+from validation import validate_many
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+# Stay well below SQLite's bound-parameter limit for the IN (...) lookups
+LOOKUP_CHUNK = 900
+# Imported codes wait behind the whole import in the outbox, so they get a longer lifetime
+IMPORT_CODE_TTL_MINUTES = 24 * 60
+
+
+def iter_records(path, fmt=None):
+    """Yield (line_number, email, time) from a CSV or JSONL file without loading it into memory."""
+    fmt = fmt or ("jsonl" if path.endswith((".jsonl", ".ndjson", ".json")) else "csv")
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if fmt == "jsonl":
+            for n, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError:
+                    yield n, None, None
+                    continue
+                if isinstance(obj, str):
+                    yield n, obj, None
+                elif isinstance(obj, dict):
+                    yield n, obj.get("email"), obj.get("time")
+                else:
+                    yield n, None, None
+            return
+
+        reader = csv.reader(f)
+        first = next(reader, None)
+        if first is None:
+            return
+        lowered = [c.strip().lower() for c in first]
+        if "email" in lowered:
+            email_col = lowered.index("email")
+            time_col = lowered.index("time") if "time" in lowered else None
+        else:
+            # No header: the address is in the first column
+            email_col, time_col = 0, None
+            yield 1, first[0] if first else None, None
+        for n, row in enumerate(reader, start=2):
+            email = row[email_col] if len(row) > email_col else None
+            t = row[time_col] if time_col is not None and len(row) > time_col else None
+            yield n, email, t
+
+
+def _existing(db, canonicals):
+    found = set()
+    for i in range(0, len(canonicals), LOOKUP_CHUNK):
+        chunk = canonicals[i:i + LOOKUP_CHUNK]
+        placeholders = ", ".join("?" for _ in chunk)
+        found.update(r[0] for r in db.execute(
+            f"SELECT canonical_email FROM subscribers WHERE canonical_email IN ({placeholders})", chunk
+        ))
+    return found
+
+
+def import_subscribers(path, fmt=None, verified=False, queue_verification=False, batch_size=BATCH_SIZE,
+                       on_reject=None, progress_every=50_000):
+    """Import a file of addresses and return a summary dict.
+
+    ``verified`` marks rows as already verified; ``queue_verification`` issues a code per row and
+    queues the verification email in the outbox. ``on_reject(line, email, reason)`` is called for
+    every skipped row.
+    """
+    if verified and queue_verification:
+        raise ValueError("Rows can be pre-verified or queued for verification, not both")
+
+    started = time_mod.monotonic()
+    summary = {"read": 0, "inserted": 0, "rejected": {}}
+    seen = set()
+    # Pending rows per shard, each flushed in its own transaction
+    batches = [[] for _ in range(SHARDS)]
+
+    def reject(line, email, reason):
+        summary["rejected"][reason] = summary["rejected"].get(reason, 0) + 1
+        if on_reject:
+            on_reject(line, email, reason)
+
+    def flush(db, batch):
+        if not batch:
+            return
+        already = _existing(db, [canonical for _, _, canonical, _ in batch])
+        now = datetime.utcnow()
+        expires_at = int(time_mod.time()) + IMPORT_CODE_TTL_MINUTES * 60
+        rows = []
+        for line, email, canonical, t in batch:
+            if canonical in already:
+                reject(line, email, "already_on_list")
+                continue
+            code = generate_code() if queue_verification else None
+            rows.append((line, code, (
+                email,
+                canonical,
+                t or now.isoformat(),
+                1 if verified else 0,
+                hash_code(code) if code else None,
+                expires_at if code else None,
+            )))
+        inserted, raced = [], []
+        try:
+            # One statement per row so each rowcount says whether that row went in: a concurrent signup can
+            # win the race for an address, and then it must get no code email, journal entry or CSV line
+            for line, code, row in rows:
+                if db.execute("""
+                    INSERT INTO subscribers
+                        (email, canonical_email, time, send, verified, verification_code, code_expires_epoch)
+                    VALUES (?, ?, ?, 1, ?, ?, ?)
+                    ON CONFLICT DO NOTHING
+                """, row).rowcount:
+                    inserted.append(row)
+                    if code:
+                        enqueue_verification_email(db, row[0], code, IMPORT_CODE_TTL_MINUTES)
+                else:
+                    raced.append((line, row[0]))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        for line, email in raced:
+            reject(line, email, "already_on_list")
+        summary["inserted"] += len(inserted)
+        journal.record_many("import", (
+            {"email": email, "canonical": canonical, "time": t, "send": 1, "verified": v}
+            for email, canonical, t, v, *_ in inserted
+        ))
+        append_subscriptions((t, email, True) for email, _, t, *_ in inserted)
+        batch.clear()
+
+    def check(records):
+        # One validate_many() call per chunk: each domain is looked up once, not once per row
+        for (line, raw, t), result in zip(records, validate_many(raw for _, raw, _ in records)):
+            if result.reason:
+                reject(line, raw, result.reason)
+            elif result.canonical in seen:
+                reject(line, raw, "duplicate_in_file")
+            else:
+                seen.add(result.canonical)
+                shard = shard_for_email(result.canonical)
+                batches[shard].append((line, result.email, result.canonical, t))
+                if len(batches[shard]) >= batch_size:
+                    flush(dbs[shard], batches[shard])
+        records.clear()
+
+    with all_shards() as dbs:
+        records = []
+        for record in iter_records(path, fmt):
+            summary["read"] += 1
+            records.append(record)
+            if len(records) >= batch_size:
+                check(records)
+
+            if progress_every and summary["read"] % progress_every == 0:
+                elapsed = time_mod.monotonic() - started
+                log.info("%d rows read, %d inserted, %.0f rows/s",
+                         summary["read"], summary["inserted"], summary["read"] / elapsed if elapsed else 0)
+        check(records)
+        for db, batch in zip(dbs, batches):
+            flush(db, batch)
+
+    elapsed = time_mod.monotonic() - started
+    summary["seconds"] = round(elapsed, 2)
+    summary["rows_per_sec"] = round(summary["read"] / elapsed) if elapsed else summary["read"]
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import subscribers from a CSV or JSONL file.")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="defaults to the file extension")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--verified", action="store_true", help="mark imported rows as already verified")
+    group.add_argument("--queue-verification", action="store_true",
+                       help="issue codes and queue verification emails in the outbox")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per transaction")
+    parser.add_argument("--rejects", help="write rejected rows to this CSV (line,email,reason)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    check_schema()
+
+    rejects_file = open(args.rejects, "w", encoding="utf-8", newline="") if args.rejects else None
+    try:
+        on_reject = None
+        if rejects_file:
+            writer = csv.writer(rejects_file)
+            writer.writerow(["line", "email", "reason"])
+            on_reject = lambda line, email, reason: writer.writerow([line, email, reason])  # noqa: E731
+        summary = import_subscribers(
+            args.path,
+            fmt=args.format,
+            verified=args.verified,
+            queue_verification=args.queue_verification,
+            batch_size=args.batch_size,
+            on_reject=on_reject,
+        )
+    finally:
+        if rejects_file:
+            rejects_file.close()
+
+    rejected = sum(summary["rejected"].values())
+    print(f"Read {summary['read']} rows, inserted {summary['inserted']}, rejected {rejected} "
+          f"in {summary['seconds']}s ({summary['rows_per_sec']} rows/s)")
+    for reason, count in sorted(summary["rejected"].items()):
+        print(f"  {reason}: {count}")
+
+
+if __name__ == "__main__":
+    main()
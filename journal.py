@@ -0,0 +1,429 @@
+"""Append-only JSONL journal of subscriber state changes, and the tool that replays it.
+
+Every signup, verification, unsubscribe, import and purge is recorded after it commits, one JSON object
+per line in events.jsonl (JOURNAL_PATH):
+
+    {"ts": 1729249200.123456, "op": "subscribe", "email": "a@example.com", "canonical": "a@example.com", "time": "..."}
+
+record() only appends to an in-memory buffer. A background thread writes the buffer every
+JOURNAL_FLUSH_MS (or as soon as JOURNAL_BUFFER_EVENTS are waiting) with one locked O_APPEND write,
+so several processes can share the file and requests never wait for the disk. Nothing is fsynced
+unless JOURNAL_FSYNC=1, and then once per batch, so a power cut can lose the last moments of
+events. Once the file passes JOURNAL_MAX_MB it is renamed to events.<utc time>.jsonl and a new one
+is started.
+
+    python journal.py snapshot                  # record the current database as the starting point
+    python journal.py rebuild --output rebuilt.db
+    python journal.py verify
+
+``rebuild`` replays every journal file into a fresh database (and CSV) in large transactions;
+``verify`` does the same into a scratch database and compares it with the live one.
+"""
+import argparse
+import atexit
+import csv
+import glob
+import heapq
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import metrics
+from db import SHARDS, _connect, shard_for_email, shard_paths
+from locks import file_lock
+from subscriptions import HEADER
+from validation import canonicalize, normalize
+
+log = logging.getLogger(__name__)
+
+JOURNAL_ENABLED = os.getenv("JOURNAL", "1") == "1"
+JOURNAL_PATH = os.path.abspath(os.getenv("JOURNAL_PATH", "events.jsonl"))
+LOCK_PATH = JOURNAL_PATH + ".lock"
+FLUSH_INTERVAL_SECONDS = float(os.getenv("JOURNAL_FLUSH_MS", "200")) / 1000
+MAX_BUFFER_EVENTS = int(os.getenv("JOURNAL_BUFFER_EVENTS", "1000"))
+MAX_FILE_BYTES = int(float(os.getenv("JOURNAL_MAX_MB", "64")) * 1024 * 1024)
+FSYNC = os.getenv("JOURNAL_FSYNC", "0") == "1"
+# Processes flush independently, so lines can be out of order by about one flush interval;
+# replay sorts within this window
+REORDER_WINDOW_SECONDS = 60
+REPLAY_BATCH = 20000
+
+OPS = ("subscribe", "verify", "unsubscribe", "import", "purge")
+
+_buffer = []
+_lock = threading.Lock()
+_wake = threading.Event()
+_flusher = {"pid": None}
+
+
+# --- writing ---------------------------------------------------------------------------------------
+
+def _ensure_flusher():
+    """Start the flush thread once per process (again after a fork, with the parent's buffer dropped)."""
+    pid = os.getpid()
+    if _flusher["pid"] == pid:
+        return
+    with _lock:
+        if _flusher["pid"] == pid:
+            return
+        if _flusher["pid"] is not None:
+            # Forked child: those events belong to the parent, which writes them itself
+            _buffer.clear()
+        _flusher["pid"] = pid
+        threading.Thread(target=_run_flusher, name="journal-flusher", daemon=True).start()
+
+
+def _run_flusher():
+    while True:
+        _wake.wait(FLUSH_INTERVAL_SECONDS)
+        _wake.clear()
+        try:
+            flush()
+        except Exception:
+            log.exception("Journal flush failed")
+
+
+def record(op, **fields):
+    """Queue one event for the journal. Call it after the change has committed."""
+    if not JOURNAL_ENABLED:
+        return
+    _ensure_flusher()
+    line = json.dumps({"ts": round(time.time(), 6), "op": op, **fields}, separators=(",", ":"))
+    with _lock:
+        _buffer.append(line)
+        full = len(_buffer) >= MAX_BUFFER_EVENTS
+    if full:
+        _wake.set()
+
+
+def record_many(op, rows):
+    """Queue one ``op`` event per dict in ``rows`` (bulk paths such as the importer)."""
+    for fields in rows:
+        record(op, **fields)
+
+
+def _rotated_name():
+    root, ext = os.path.splitext(JOURNAL_PATH)
+    return f"{root}.{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}{ext}"
+
+
+def flush():
+    """Write everything buffered in this process: one locked append, rotating the file first if it is full."""
+    with _lock:
+        if not _buffer:
+            return
+        lines = _buffer[:]
+        _buffer.clear()
+    data = ("\n".join(lines) + "\n").encode("utf-8")
+    with file_lock(LOCK_PATH):
+        try:
+            if os.path.getsize(JOURNAL_PATH) >= MAX_FILE_BYTES:
+                os.replace(JOURNAL_PATH, _rotated_name())
+        except FileNotFoundError:
+            pass
+        fd = os.open(JOURNAL_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            if FSYNC:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+    metrics.inc("email_list_journal_batches_total")
+    metrics.inc("email_list_journal_events_total", len(lines))
+
+
+atexit.register(flush)
+
+
+# --- reading ---------------------------------------------------------------------------------------
+
+def journal_files(path=JOURNAL_PATH):
+    """Every journal file for ``path``, oldest first: the rotated ones, then the current one."""
+    root, ext = os.path.splitext(path)
+    stamp = re.compile(re.escape(root) + r"\.\d{8}T\d{12}" + re.escape(ext) + "$")
+    files = sorted(p for p in glob.glob(f"{glob.escape(root)}.*{ext}") if stamp.match(p))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def iter_events(files, stats=None):
+    """Yield events from ``files`` in timestamp order, holding only REORDER_WINDOW_SECONDS of them in memory."""
+    stats = stats if stats is not None else {}
+    stats.setdefault("events", 0)
+    stats.setdefault("bad_lines", 0)
+    heap = []
+    seq = 0
+    for path in files:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                    ts = float(event["ts"])
+                    if event["op"] not in OPS:
+                        raise ValueError(event["op"])
+                except (ValueError, KeyError, TypeError):
+                    # A line torn by a crash mid-write, or not ours
+                    stats["bad_lines"] += 1
+                    continue
+                seq += 1
+                heapq.heappush(heap, (ts, seq, event))
+                while heap[0][0] < ts - REORDER_WINDOW_SECONDS:
+                    stats["events"] += 1
+                    yield heapq.heappop(heap)[2]
+    while heap:
+        stats["events"] += 1
+        yield heapq.heappop(heap)[2]
+
+
+# --- replay ----------------------------------------------------------------------------------------
+
+_APPLY = {
+    "subscribe": ("""
+        INSERT INTO subscribers (email, canonical_email, time, send, verified) VALUES (?, ?, ?, 1, 0)
+        ON CONFLICT (canonical_email) DO UPDATE SET send = 1, time = excluded.time
+    """, lambda e: (e["email"], e.get("canonical"), e.get("time"))),
+    # Like the importer itself: an address that is already there is left alone
+    "import": ("""
+        INSERT OR IGNORE INTO subscribers (email, canonical_email, time, send, verified) VALUES (?, ?, ?, ?, ?)
+    """, lambda e: (e["email"], e.get("canonical"), e.get("time"), e.get("send", 1), e.get("verified", 0))),
+    "verify": (
+        "UPDATE subscribers SET verified = 1 WHERE canonical_email = ?",
+        lambda e: (e["canonical"],),
+    ),
+    "unsubscribe": (
+        "UPDATE subscribers SET send = 0 WHERE canonical_email = ? OR email = ?",
+        lambda e: (e.get("canonical"), e.get("email")),
+    ),
+    "purge": (
+        "DELETE FROM subscribers WHERE email = ?",
+        lambda e: (e["email"],),
+    ),
+}
+
+
+def _shard_of(event, count):
+    return shard_for_email(event.get("canonical") or canonicalize(normalize(event.get("email") or "")), count)
+
+
+def _apply_batch(conn, batch):
+    """Apply (op, params) pairs in order, one executemany per run of the same op."""
+    conn.execute("BEGIN")
+    start = 0
+    while start < len(batch):
+        op = batch[start][0]
+        end = start
+        while end < len(batch) and batch[end][0] == op:
+            end += 1
+        conn.executemany(_APPLY[op][0], [params for _, params in batch[start:end]])
+        start = end
+    conn.commit()
+
+
+def replay(files, target_paths):
+    """Replay journal ``files`` into freshly migrated databases at ``target_paths``. Returns counts."""
+    import migrations
+
+    migrations.migrate(paths=target_paths)
+    conns = [_connect(path) for path in target_paths]
+    stats = {}
+    try:
+        for conn in conns:
+            # A rebuild can simply be run again, so skip the durability work
+            conn.execute("PRAGMA synchronous=OFF")
+        batches = [[] for _ in conns]
+        pending = 0
+        for event in iter_events(files, stats):
+            op = event["op"]
+            try:
+                params = _APPLY[op][1](event)
+            except KeyError:
+                stats["bad_lines"] += 1
+                continue
+            batches[_shard_of(event, len(conns))].append((op, params))
+            pending += 1
+            if pending >= REPLAY_BATCH:
+                for conn, batch in zip(conns, batches):
+                    if batch:
+                        _apply_batch(conn, batch)
+                        batch.clear()
+                pending = 0
+        for conn, batch in zip(conns, batches):
+            if batch:
+                _apply_batch(conn, batch)
+    finally:
+        for conn in conns:
+            conn.close_for_real()
+    return stats
+
+
+def _iter_by_id(conns, columns, page_size=5000):
+    def scan(conn):
+        last_id = -1
+        while True:
+            rows = conn.execute(
+                f"SELECT id, {columns} FROM subscribers WHERE id > ? ORDER BY id LIMIT ?", (last_id, page_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1]["id"]
+    return heapq.merge(*(scan(conn) for conn in conns), key=lambda row: row["id"])
+
+
+def write_csv(paths, csv_path):
+    """Write an emails.csv equivalent of the databases at ``paths``."""
+    conns = [_connect(path) for path in paths]
+    try:
+        tmp_path = csv_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADER)
+            for row in _iter_by_id(conns, "time, email, send"):
+                writer.writerow([row["time"], row["email"], "No" if row["send"] == 0 else "Yes"])
+        os.replace(tmp_path, csv_path)
+    finally:
+        for conn in conns:
+            conn.close_for_real()
+
+
+def _iter_state(conns):
+    """(key, email, time, send, verified) for every subscriber, ordered by key across all ``conns``."""
+    def scan(conn):
+        for row in conn.execute("""
+            SELECT COALESCE(canonical_email, email) AS key, email, time,
+                   COALESCE(send, 1) AS send, COALESCE(verified, 0) AS verified
+            FROM subscribers ORDER BY key
+        """):
+            yield tuple(row)
+    return heapq.merge(*(scan(conn) for conn in conns))
+
+
+def compare(expected_paths, actual_paths, examples=10):
+    """Compare subscribers in two sets of databases. Returns counts and a few examples of each difference."""
+    expected_conns = [_connect(path) for path in expected_paths]
+    actual_conns = [_connect(path) for path in actual_paths]
+    result = {"matching": 0, "missing": 0, "extra": 0, "different": 0, "examples": []}
+    fields = ("email", "time", "send", "verified")
+
+    def note(kind, text):
+        result[kind] += 1
+        if len(result["examples"]) < examples:
+            result["examples"].append(f"{kind}: {text}")
+
+    try:
+        expected, actual = _iter_state(expected_conns), _iter_state(actual_conns)
+        e, a = next(expected, None), next(actual, None)
+        while e is not None or a is not None:
+            if a is None or (e is not None and e[0] < a[0]):
+                note("missing", f"{e[1]} is in the journal but not in the database")
+                e = next(expected, None)
+            elif e is None or a[0] < e[0]:
+                note("extra", f"{a[1]} is in the database but not in the journal")
+                a = next(actual, None)
+            else:
+                diffs = [f"{name} {ev!r} != {av!r}" for name, ev, av in zip(fields, e[1:], a[1:]) if ev != av]
+                if diffs:
+                    note("different", f"{a[1]}: " + ", ".join(diffs))
+                else:
+                    result["matching"] += 1
+                e, a = next(expected, None), next(actual, None)
+    finally:
+        for conn in expected_conns + actual_conns:
+            conn.close_for_real()
+    return result
+
+
+def snapshot():
+    """Append an "import" event for every current subscriber, so the journal starts from today's state."""
+    from db import DB_PATHS
+
+    conns = [_connect(path) for path in DB_PATHS]
+    count = 0
+    try:
+        for row in _iter_by_id(conns, "email, canonical_email, time, send, verified"):
+            record(
+                "import", email=row["email"], canonical=row["canonical_email"], time=row["time"],
+                send=0 if row["send"] == 0 else 1, verified=1 if row["verified"] else 0,
+            )
+            count += 1
+            if count % MAX_BUFFER_EVENTS == 0:
+                flush()
+        flush()
+    finally:
+        for conn in conns:
+            conn.close_for_real()
+    return count
+
+
+def main(argv=None):
+    from db import DB_PATHS, DB_PATH
+    from migrations import check_schema
+
+    parser = argparse.ArgumentParser(description="Rebuild or check emails.db from the event journal.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("snapshot", help="record every current subscriber as the journal's starting point")
+    p = sub.add_parser("rebuild", help="replay the journal into a new database")
+    p.add_argument("--output", default=os.path.splitext(DB_PATH)[0] + ".rebuilt.db",
+                   help="database to create (one file per shard with DB_SHARDS)")
+    p.add_argument("--csv", help="also write an emails.csv for the rebuilt list here")
+    p = sub.add_parser("verify", help="replay the journal and compare it with the live database")
+    p.add_argument("--examples", type=int, default=10, help="differences to print")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    files = journal_files()
+
+    if args.command == "snapshot":
+        check_schema()
+        print(f"Recorded {snapshot()} subscribers in {JOURNAL_PATH}")
+        return 0
+
+    if not files:
+        print(f"No journal files at {JOURNAL_PATH}", file=sys.stderr)
+        return 1
+
+    if args.command == "rebuild":
+        targets = shard_paths(SHARDS, os.path.abspath(args.output))
+        existing = [path for path in targets if os.path.exists(path)]
+        if existing:
+            print(f"{', '.join(existing)} already exists; move it away first", file=sys.stderr)
+            return 1
+        started = time.perf_counter()
+        stats = replay(files, targets)
+        seconds = time.perf_counter() - started
+        print(f"Replayed {stats['events']} events from {len(files)} file(s) in {seconds:.1f}s "
+              f"({stats['events'] / seconds if seconds else 0:.0f} events/s), {stats['bad_lines']} bad lines")
+        for path in targets:
+            print(f"wrote {path}")
+        if args.csv:
+            write_csv(targets, args.csv)
+            print(f"wrote {args.csv}")
+        return 0
+
+    check_schema()
+    scratch = tempfile.mkdtemp(prefix="journal_verify_")
+    try:
+        expected = [os.path.join(scratch, "expected.db")]
+        stats = replay(files, expected)
+        result = compare(expected, DB_PATHS, args.examples)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    print(f"{stats['events']} events: {result['matching']} subscribers match, {result['missing']} missing from "
+          f"the database, {result['extra']} not in the journal, {result['different']} different")
+    for line in result["examples"]:
+        print(f"  {line}")
+    return 0 if not (result["missing"] or result["extra"] or result["different"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
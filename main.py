@@ -1,151 +1,397 @@
-import tkinter as tk
-from tkinter import ttk
-from db import get_db
-import sqlite3
-
-REFRESH_INTERVAL_SECONDS = 5
-
-def fetch_rows():
-    conn = None
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        # Include verification-related columns so the GUI can display code/status/expiry
-        cursor.execute("SELECT id, email, time, send, verified, verification_code, code_expires_at FROM subscribers ORDER BY id")
-        return cursor.fetchall()
-    except sqlite3.OperationalError as e:
-        print("Database error:", e)
-        return []
-    finally:
-        if conn:
-            conn.close()
-
-
-# How often to auto-refresh (seconds). Change this variable to adjust behavior.
-
-rows = fetch_rows()
-
-window = tk.Tk()
-window.title("Subscribers")
-window.geometry("900x420")
-
-# Top frame for controls
-controls = ttk.Frame(window)
-controls.pack(fill="x", padx=10, pady=(10, 0))
-
-refresh_btn = ttk.Button(controls, text="Refresh")
-refresh_btn.pack(side="left")
-
-interval_label = ttk.Label(controls, text=f"Auto-refresh every {REFRESH_INTERVAL_SECONDS}s")
-interval_label.pack(side="left", padx=(8, 0))
-
-frame = ttk.Frame(window)
-frame.pack(fill="both", expand=True, padx=10, pady=10)
-
-columns = ("id", "email", "time", "send", "verified", "verification_code", "code_expires_at")
-tree = ttk.Treeview(frame, columns=columns, show="headings")
-tree.heading("id", text="ID")
-tree.heading("email", text="Email")
-tree.heading("time", text="Time")
-tree.heading("send", text="Send")
-tree.heading("verified", text="Verified?")
-tree.heading("verification_code", text="V. Code")
-tree.heading("code_expires_at", text="Code Expires")
-tree.column("id", width=60, anchor="center")
-tree.column("email", width=200, anchor="w")
-tree.column("time", width=140, anchor="center")
-tree.column("send", width=80, anchor="center")
-tree.column("verified", width=80, anchor="center")
-tree.column("verification_code", width=120, anchor="center")
-tree.column("code_expires_at", width=120, anchor="center")
-
-vsb = ttk.Scrollbar(frame, orient="vertical", command=tree.yview)
-tree.configure(yscrollcommand=vsb.set)
-tree.grid(row=0, column=0, sticky="nsew")
-vsb.grid(row=0, column=1, sticky="ns")
-
-frame.rowconfigure(0, weight=1)
-frame.columnconfigure(0, weight=1)
-
-from datetime import datetime
-
-# Keep track of the scheduled auto-refresh job so we can cancel it on exit
-_refresh_job_id = None
-
-
-def populate_tree(rows):
-    # Clear existing rows
-    for item in tree.get_children():
-        tree.delete(item)
-
-    if not rows:
-        tree.insert("", "end", values=("", "No subscribers yet.", "", "", "", "", ""))
-        return
-
-    for r in rows:
-        send_display = "Yes" if r["send"] in (1, "1", True) else "No"
-        verified_display = "Yes" if r["verified"] in (1, "1", True) else "No"
-        time_display = r["time"] or ""
-
-        # verification_code stored is a hash; show a short/truncated fingerprint for inspection
-        code_raw = r["verification_code"]
-        if code_raw:
-            code_display = (code_raw[:8] + "...") if len(code_raw) > 8 else code_raw
-        else:
-            code_display = ""
-
-        # compute time until expiry in minutes/seconds
-        expires_raw = r["code_expires_at"]
-        if expires_raw:
-            try:
-                expires_dt = datetime.fromisoformat(expires_raw)
-                now = datetime.utcnow()
-                delta = expires_dt - now
-                secs = int(delta.total_seconds())
-                if secs <= 0:
-                    expires_display = "Expired"
-                else:
-                    mins = secs // 60
-                    rem = secs % 60
-                    expires_display = f"{mins}m {rem}s"
-            except Exception:
-                expires_display = expires_raw
-        else:
-            expires_display = ""
-
-        tree.insert("", "end", values=(r["id"], r["email"], time_display, send_display, verified_display, code_display, expires_display))
-
-
-def refresh_rows():
-    """Fetch rows and populate the tree. This function also schedules the next auto-refresh."""
-    global _refresh_job_id
-    rows = fetch_rows()
-    populate_tree(rows)
-
-    # Schedule next refresh
-    try:
-        _refresh_job_id = window.after(REFRESH_INTERVAL_SECONDS * 1000, refresh_rows)
-    except Exception:
-        _refresh_job_id = None
-
-
-# Bind the refresh button to an immediate refresh
-refresh_btn.configure(command=refresh_rows)
-
-
-# Cancel scheduled job and exit cleanly
-def on_close():
-    global _refresh_job_id
-    if _refresh_job_id is not None:
-        try:
-            window.after_cancel(_refresh_job_id)
-        except Exception:
-            pass
-    window.destroy()
-
-window.protocol("WM_DELETE_WINDOW", on_close)
-
-# Start initial population and auto-refresh
-refresh_rows()
-
-window.mainloop()
\ No newline at end of file
+import queue
+import threading
+import tkinter as tk
+from tkinter import ttk
+from db import SHARDS, get_db
+from migrations import check_schema
+from search import NO_FILTERS, PAGE_ROWS, Filters, fetch_page
+from stats import get_stats
+
+REFRESH_INTERVAL_SECONDS = 5
+# How often the Tk loop picks up finished queries
+POLL_MS = 50
+
+check_schema()
+
+
+class DbWorker(threading.Thread):
+    """Runs every query off the Tk thread. Results come back through a queue the Tk loop polls."""
+
+    def __init__(self):
+        super().__init__(name="viewer-db", daemon=True)
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+
+    def run(self):
+        # One connection per shard for the life of the viewer: PRAGMA data_version only changes when
+        # *other* connections commit
+        conns = [get_db(shard) for shard in range(SHARDS)]
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                fn, callback = job
+                try:
+                    self.results.put((callback, fn(conns), None))
+                except Exception as e:
+                    self.results.put((callback, None, e))
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def submit(self, fn, callback):
+        self.jobs.put((fn, callback))
+
+    def stop(self):
+        self.jobs.put(None)
+
+
+worker = DbWorker()
+
+window = tk.Tk()
+window.title("Subscribers")
+window.geometry("980x480")
+
+# Top frame for controls
+controls = ttk.Frame(window)
+controls.pack(fill="x", padx=10, pady=(10, 0))
+
+refresh_btn = ttk.Button(controls, text="Refresh")
+refresh_btn.pack(side="left")
+
+interval_label = ttk.Label(controls, text=f"Auto-refresh every {REFRESH_INTERVAL_SECONDS}s")
+interval_label.pack(side="left", padx=(8, 0))
+
+# Header bar with list totals (read from trigger-maintained counters, so it costs the same at any size)
+stats_label = ttk.Label(controls, text="")
+stats_label.pack(side="right")
+
+# Search and filters, all applied in SQL
+filters_bar = ttk.Frame(window)
+filters_bar.pack(fill="x", padx=10, pady=(8, 0))
+
+search_var = tk.StringVar()
+mode_var = tk.StringVar(value="contains")
+verified_var = tk.StringVar(value="any")
+send_var = tk.StringVar(value="any")
+since_var = tk.StringVar()
+until_var = tk.StringVar()
+
+ttk.Label(filters_bar, text="Email").pack(side="left")
+search_entry = ttk.Entry(filters_bar, textvariable=search_var, width=24)
+search_entry.pack(side="left", padx=(4, 4))
+ttk.Combobox(filters_bar, textvariable=mode_var, values=("contains", "starts with"), width=10,
+             state="readonly").pack(side="left")
+ttk.Label(filters_bar, text="Verified").pack(side="left", padx=(10, 4))
+ttk.Combobox(filters_bar, textvariable=verified_var, values=("any", "yes", "no"), width=5,
+             state="readonly").pack(side="left")
+ttk.Label(filters_bar, text="Send").pack(side="left", padx=(10, 4))
+ttk.Combobox(filters_bar, textvariable=send_var, values=("any", "yes", "no"), width=5,
+             state="readonly").pack(side="left")
+ttk.Label(filters_bar, text="From").pack(side="left", padx=(10, 4))
+since_entry = ttk.Entry(filters_bar, textvariable=since_var, width=11)
+since_entry.pack(side="left")
+ttk.Label(filters_bar, text="To").pack(side="left", padx=(6, 4))
+until_entry = ttk.Entry(filters_bar, textvariable=until_var, width=11)
+until_entry.pack(side="left")
+search_btn = ttk.Button(filters_bar, text="Search")
+search_btn.pack(side="left", padx=(10, 0))
+clear_btn = ttk.Button(filters_bar, text="Clear")
+clear_btn.pack(side="left", padx=(4, 0))
+
+frame = ttk.Frame(window)
+frame.pack(fill="both", expand=True, padx=10, pady=10)
+
+columns = ("id", "email", "time", "send", "verified", "verification_code", "code_expires")
+tree = ttk.Treeview(frame, columns=columns, show="headings")
+tree.heading("id", text="ID")
+tree.heading("email", text="Email")
+tree.heading("time", text="Time")
+tree.heading("send", text="Send")
+tree.heading("verified", text="Verified?")
+tree.heading("verification_code", text="V. Code")
+tree.heading("code_expires", text="Code Expires")
+tree.column("id", width=60, anchor="center")
+tree.column("email", width=200, anchor="w")
+tree.column("time", width=140, anchor="center")
+tree.column("send", width=80, anchor="center")
+tree.column("verified", width=80, anchor="center")
+tree.column("verification_code", width=120, anchor="center")
+tree.column("code_expires", width=120, anchor="center")
+
+vsb = ttk.Scrollbar(frame, orient="vertical", command=tree.yview)
+tree.configure(yscrollcommand=vsb.set)
+tree.grid(row=0, column=0, sticky="nsew")
+vsb.grid(row=0, column=1, sticky="ns")
+
+frame.rowconfigure(0, weight=1)
+frame.columnconfigure(0, weight=1)
+
+# Paging: the tree only ever holds one page of PAGE_ROWS rows
+pager = ttk.Frame(window)
+pager.pack(fill="x", padx=10, pady=(0, 10))
+prev_btn = ttk.Button(pager, text="< Prev", state="disabled")
+prev_btn.pack(side="left")
+page_label = ttk.Label(pager, text="Page 1")
+page_label.pack(side="left", padx=8)
+next_btn = ttk.Button(pager, text="Next >", state="disabled")
+next_btn.pack(side="left")
+status_label = ttk.Label(pager, text="")
+status_label.pack(side="right")
+
+import time
+
+# Keep track of the scheduled auto-refresh job so we can cancel it on exit
+_refresh_job_id = None
+_poll_job_id = None
+
+EMPTY_IID = "empty"
+# What the tree shows: the filters, the id each visited page starts after (a stack, so Prev is a pop),
+# expiry times still counting down, and the database version it was read at.
+# ``generation`` changes whenever the view does, so results of superseded queries are dropped.
+_expiries = {}
+_state = {
+    "filters": NO_FILTERS,
+    "pages": [-1],
+    "has_next": False,
+    "data_version": None,
+    "generation": 0,
+    "busy": False,
+}
+
+
+def format_expiry(expires_epoch, now):
+    secs = expires_epoch - now
+    if secs <= 0:
+        return "Expired"
+    mins = secs // 60
+    rem = secs % 60
+    return f"{mins}m {rem}s"
+
+
+def row_values(r, now):
+    """Build the Treeview values for one row and remember its expiry for the in-place countdown."""
+    send_display = "Yes" if r["send"] in (1, "1", True) else "No"
+    verified_display = "Yes" if r["verified"] in (1, "1", True) else "No"
+    time_display = r["time"] or ""
+
+    # verification_code stored is a hash; show a short/truncated fingerprint for inspection
+    code_raw = r["verification_code"]
+    if code_raw:
+        code_display = (code_raw[:8] + "...") if len(code_raw) > 8 else code_raw
+    else:
+        code_display = ""
+
+    # compute time until expiry in minutes/seconds
+    iid = str(r["id"])
+    _expiries.pop(iid, None)
+    expires_epoch = r["code_expires_epoch"]
+    if expires_epoch is not None:
+        expires_display = format_expiry(expires_epoch, now)
+        if expires_display != "Expired":
+            _expiries[iid] = expires_epoch
+    else:
+        expires_display = ""
+
+    return (r["id"], r["email"], time_display, send_display, verified_display, code_display, expires_display)
+
+
+def populate_tree(rows):
+    """Show one page of rows, reusing the Treeview items that are still on it."""
+    now = int(time.time())
+    keep = {str(r["id"]) for r in rows}
+    stale = [iid for iid in tree.get_children() if iid not in keep]
+    if stale:
+        tree.delete(*stale)
+    for iid in list(_expiries):
+        if iid not in keep:
+            del _expiries[iid]
+
+    for pos, r in enumerate(rows):
+        iid = str(r["id"])
+        if tree.exists(iid):
+            tree.item(iid, values=row_values(r, now))
+            tree.move(iid, "", pos)
+        else:
+            tree.insert("", pos, iid=iid, values=row_values(r, now))
+    if not rows:
+        text = "No subscribers yet." if _state["filters"] == NO_FILTERS else "No matches."
+        tree.insert("", "end", iid=EMPTY_IID, values=("", text, "", "", "", "", ""))
+
+
+def update_countdowns():
+    """Recompute the expiry column in place for rows whose code has not expired yet."""
+    now = int(time.time())
+    for iid, expires_epoch in list(_expiries.items()):
+        display = format_expiry(expires_epoch, now)
+        if not tree.exists(iid):
+            del _expiries[iid]
+            continue
+        tree.set(iid, "code_expires", display)
+        if display == "Expired":
+            del _expiries[iid]
+
+
+def update_stats(s):
+    stats_label.configure(text=(
+        f"Total: {s['total']}   Verified: {s['verified']}   Pending: {s['pending']}   "
+        f"Unsubscribed: {s['unsubscribed']}   Signups this hour: {s['signups_this_hour']}"
+    ))
+
+
+def update_pager():
+    page_label.configure(text=f"Page {len(_state['pages'])}")
+    prev_btn.configure(state="normal" if len(_state["pages"]) > 1 else "disabled")
+    next_btn.configure(state="normal" if _state["has_next"] else "disabled")
+
+
+def load_page(force=False):
+    """Ask the worker for the current page. Unless ``force``, it skips the query when nothing was committed."""
+    if _state["busy"] and not force:
+        return
+    _state["busy"] = True
+    status_label.configure(text="Loading...")
+    generation = _state["generation"]
+    filters = _state["filters"]
+    after_id = _state["pages"][-1]
+    known_version = None if force else _state["data_version"]
+
+    def query(conns):
+        version = tuple(conn.execute("PRAGMA data_version").fetchone()[0] for conn in conns)
+        if version == known_version:
+            return version, None, None
+        # One row past the page tells us whether there is a next one
+        rows = fetch_page(conns[0], filters, after_id, PAGE_ROWS + 1)
+        return version, rows, get_stats(*conns)
+
+    def done(result, error):
+        if generation != _state["generation"]:
+            # The view changed while this ran; the newer request is already queued
+            return
+        _state["busy"] = False
+        status_label.configure(text="")
+        if error is not None:
+            print("Database error:", error)
+            status_label.configure(text="Database error, see console")
+            return
+        version, rows, stats = result
+        _state["data_version"] = version
+        if rows is not None:
+            _state["has_next"] = len(rows) > PAGE_ROWS
+            populate_tree(rows[:PAGE_ROWS])
+            update_stats(stats)
+            update_pager()
+
+    worker.submit(query, done)
+
+
+def change_view(pages=None, filters=None):
+    """Switch page or filters; bumps the generation so in-flight results for the old view are ignored."""
+    if filters is not None:
+        _state["filters"] = filters
+    if pages is not None:
+        _state["pages"] = pages
+    _state["generation"] += 1
+    _state["busy"] = False
+    tree.yview_moveto(0)
+    load_page(force=True)
+
+
+def _flag(value):
+    return {"yes": 1, "no": 0}.get(value)
+
+
+def apply_filters(event=None):
+    filters = Filters(
+        text=search_var.get(),
+        mode="prefix" if mode_var.get() == "starts with" else "contains",
+        verified=_flag(verified_var.get()),
+        send=_flag(send_var.get()),
+        since=since_var.get().strip(),
+        until=until_var.get().strip(),
+    )
+    change_view(pages=[-1], filters=filters)
+
+
+def clear_filters():
+    search_var.set("")
+    mode_var.set("contains")
+    verified_var.set("any")
+    send_var.set("any")
+    since_var.set("")
+    until_var.set("")
+    change_view(pages=[-1], filters=NO_FILTERS)
+
+
+def next_page():
+    ids = [int(iid) for iid in tree.get_children() if iid != EMPTY_IID]
+    if _state["has_next"] and ids:
+        change_view(pages=_state["pages"] + [ids[-1]])
+
+
+def prev_page():
+    if len(_state["pages"]) > 1:
+        change_view(pages=_state["pages"][:-1])
+
+
+def poll_results():
+    """Run the callbacks of finished queries on the Tk thread."""
+    global _poll_job_id
+    while True:
+        try:
+            callback, result, error = worker.results.get_nowait()
+        except queue.Empty:
+            break
+        callback(result, error)
+    _poll_job_id = window.after(POLL_MS, poll_results)
+
+
+def refresh_rows(force=False):
+    """Reload the current page if the database changed. This function also schedules the next auto-refresh."""
+    global _refresh_job_id
+    if _refresh_job_id is not None:
+        # A manual refresh replaces the pending automatic one instead of starting a second loop
+        window.after_cancel(_refresh_job_id)
+        _refresh_job_id = None
+
+    load_page(force)
+    update_countdowns()
+
+    # Schedule next refresh
+    try:
+        _refresh_job_id = window.after(REFRESH_INTERVAL_SECONDS * 1000, refresh_rows)
+    except Exception:
+        _refresh_job_id = None
+
+
+# Bind the buttons; Enter in any filter field runs the search
+refresh_btn.configure(command=lambda: refresh_rows(force=True))
+search_btn.configure(command=apply_filters)
+clear_btn.configure(command=clear_filters)
+prev_btn.configure(command=prev_page)
+next_btn.configure(command=next_page)
+for entry in (search_entry, since_entry, until_entry):
+    entry.bind("<Return>", apply_filters)
+
+
+# Cancel scheduled jobs and exit cleanly
+def on_close():
+    for job in (_refresh_job_id, _poll_job_id):
+        if job is not None:
+            try:
+                window.after_cancel(job)
+            except Exception:
+                pass
+    worker.stop()
+    window.destroy()
+
+window.protocol("WM_DELETE_WINDOW", on_close)
+
+if __name__ == "__main__":
+    # Start the query thread, initial population and auto-refresh
+    worker.start()
+    poll_results()
+    refresh_rows()
+
+    window.mainloop()
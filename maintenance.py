@@ -0,0 +1,261 @@
+"""SQLite housekeeping: WAL checkpoints, planner statistics, incremental vacuum and outbox pruning.
+
+    python maintenance.py                               # one pass over every shard, with a report
+    python maintenance.py --analyze                     # the same plus a full ANALYZE
+    python maintenance.py --every 600                   # keep running a pass every 10 minutes
+    python maintenance.py --enable-incremental-vacuum   # one-off VACUUM of databases created before it
+
+SQLite's automatic checkpoints are PASSIVE, so they stop at the oldest open read and a busy server
+(or the viewer's long reads) lets the -wal file grow. A pass checkpoints each shard: PASSIVE once
+the WAL passes MAINTENANCE_WAL_PASSIVE_MB, TRUNCATE (which waits briefly for readers, then resets
+the file to zero bytes) past MAINTENANCE_WAL_TRUNCATE_MB. It also runs ``PRAGMA optimize`` to
+refresh planner statistics where they are stale, returns free pages to the filesystem with
+``PRAGMA incremental_vacuum`` and deletes sent or failed outbox rows older than
+OUTBOX_RETENTION_DAYS. The server runs a pass every MAINTENANCE_INTERVAL seconds when that is set;
+a file lock keeps gunicorn workers from doing it at the same time.
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import metrics
+from db import DB_PATH, DB_PATHS, _connect
+from locks import file_lock
+
+log = logging.getLogger(__name__)
+
+MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_INTERVAL", "0"))
+WAL_PASSIVE_BYTES = int(float(os.getenv("MAINTENANCE_WAL_PASSIVE_MB", "4")) * 1024 * 1024)
+WAL_TRUNCATE_BYTES = int(float(os.getenv("MAINTENANCE_WAL_TRUNCATE_MB", "64")) * 1024 * 1024)
+# A TRUNCATE checkpoint holds off writers while it waits for readers; give up after this long
+CHECKPOINT_BUSY_MS = int(os.getenv("MAINTENANCE_CHECKPOINT_BUSY_MS", "2000"))
+# Bound the rows ANALYZE samples per index, so optimize stays quick on big tables
+ANALYSIS_LIMIT = 1000
+VACUUM_MIN_FREE_PAGES = int(os.getenv("MAINTENANCE_VACUUM_MIN_FREE_PAGES", "1000"))
+VACUUM_PAGES_PER_PASS = int(os.getenv("MAINTENANCE_VACUUM_PAGES", "5000"))
+# Keep delivered and given-up outbox messages this long; 0 keeps them forever
+OUTBOX_RETENTION_DAYS = float(os.getenv("OUTBOX_RETENTION_DAYS", "30"))
+PRUNE_BATCH_SIZE = 1000
+LOCK_PATH = DB_PATH + ".maintenance.lock"
+
+
+def wal_size(path):
+    try:
+        return os.path.getsize(path + "-wal")
+    except OSError:
+        return 0
+
+
+def _timed(task, fn):
+    started = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - started
+    metrics.observe("email_list_maintenance_seconds", seconds, task=task)
+    return result, seconds
+
+
+def checkpoint(conn, path, mode=None):
+    """Checkpoint if the WAL is big enough for it (or always, in ``mode``). Returns a report dict."""
+    size = wal_size(path)
+    if mode is None:
+        mode = "TRUNCATE" if size >= WAL_TRUNCATE_BYTES else "PASSIVE" if size >= WAL_PASSIVE_BYTES else None
+    report = {"wal_before": size, "wal_after": size, "checkpoint": mode}
+    if mode is None:
+        return report
+    (busy, frames, done), seconds = _timed(
+        "checkpoint", lambda: conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    )
+    report.update(
+        wal_after=wal_size(path), checkpoint_seconds=seconds, busy=bool(busy), frames=frames, checkpointed=done,
+    )
+    if busy:
+        log.warning("%s checkpoint of %s stopped at an open read (%s of %s frames copied)", mode, path, done, frames)
+    return report
+
+
+def optimize(conn, full=False):
+    """Refresh planner statistics: a full ANALYZE, or PRAGMA optimize (only what has changed a lot)."""
+    if full:
+        _, seconds = _timed("analyze", lambda: conn.execute("ANALYZE"))
+    else:
+        conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+        _, seconds = _timed("optimize", lambda: conn.execute("PRAGMA optimize").fetchall())
+    return {"analyze" if full else "optimize": seconds}
+
+
+def incremental_vacuum(conn):
+    """Give up to VACUUM_PAGES_PER_PASS free pages back to the filesystem, once enough have piled up."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return {"vacuum": "off"}
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if free < VACUUM_MIN_FREE_PAGES:
+        return {"vacuum_freed": 0}
+    # The pragma frees one page per step, and the sqlite3 module only steps a row-less statement once;
+    # executescript() runs it to completion
+    _, seconds = _timed("vacuum", lambda: conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_PASS});"))
+    return {"vacuum_freed": free - conn.execute("PRAGMA freelist_count").fetchone()[0], "vacuum_seconds": seconds}
+
+
+def prune_outbox(conn, retention_days=OUTBOX_RETENTION_DAYS, batch_size=PRUNE_BATCH_SIZE):
+    """Delete sent and failed outbox messages created more than ``retention_days`` ago. Returns the count."""
+    if not retention_days:
+        return 0
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).isoformat()
+    pruned = 0
+    while True:
+        # Oldest first by id, so each batch stops scanning as soon as it has enough
+        cur = conn.execute("""
+            DELETE FROM outbox WHERE id IN (
+                SELECT id FROM outbox
+                WHERE status IN ('sent', 'failed') AND created_at < ?
+                ORDER BY id
+                LIMIT ?
+            )
+        """, (cutoff, batch_size))
+        conn.commit()
+        pruned += cur.rowcount
+        if cur.rowcount < batch_size:
+            return pruned
+
+
+def database_stats(conn, path):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    return {
+        "path": path,
+        "page_size": page_size,
+        "pages": pages,
+        "free_pages": conn.execute("PRAGMA freelist_count").fetchone()[0],
+        "db_bytes": page_size * pages,
+    }
+
+
+def maintain(path, analyze=False, retention_days=OUTBOX_RETENTION_DAYS, checkpoint_mode=None):
+    """One maintenance pass over the database at ``path``. Returns a report dict."""
+    conn = _connect(path)
+    try:
+        conn.execute(f"PRAGMA busy_timeout={CHECKPOINT_BUSY_MS}")
+        report = {"pruned": prune_outbox(conn, retention_days)}
+        report.update(optimize(conn, analyze))
+        report.update(incremental_vacuum(conn))
+        # Last, so the pages written above are folded into the database file too
+        report.update(checkpoint(conn, path, checkpoint_mode))
+        report.update(database_stats(conn, path))
+    finally:
+        conn.close_for_real()
+    return report
+
+
+def run_pass(paths=DB_PATHS, analyze=False, retention_days=OUTBOX_RETENTION_DAYS, checkpoint_mode=None,
+             blocking=True):
+    """Maintain every shard. Returns the reports, or None if another process holds the lock (``blocking`` off)."""
+    with file_lock(LOCK_PATH, blocking=blocking) as locked:
+        if not locked:
+            return None
+        reports = []
+        for path in paths:
+            try:
+                reports.append(maintain(path, analyze, retention_days, checkpoint_mode))
+            except Exception:
+                log.exception("Maintenance of %s failed", path)
+        return reports
+
+
+def format_report(report):
+    mb = 1024 * 1024
+    parts = [
+        f"{report['path']}: {report['pages']} pages x {report['page_size']} B "
+        f"({report['db_bytes'] / mb:.1f} MB, {report['free_pages']} free)",
+    ]
+    wal = f"WAL {report['wal_before'] / mb:.1f} MB"
+    if report["checkpoint"]:
+        wal += f" -> {report['wal_after'] / mb:.1f} MB ({report['checkpoint']}, {report['checkpoint_seconds'] * 1000:.0f} ms"
+        wal += ", blocked by a reader)" if report["busy"] else ")"
+    parts.append(wal)
+    if "analyze" in report:
+        parts.append(f"analyze {report['analyze'] * 1000:.0f} ms")
+    else:
+        parts.append(f"optimize {report['optimize'] * 1000:.0f} ms")
+    if report.get("vacuum") == "off":
+        parts.append("incremental vacuum off")
+    else:
+        parts.append(f"vacuum freed {report['vacuum_freed']} pages")
+    parts.append(f"pruned {report['pruned']} outbox rows")
+    return "; ".join(parts)
+
+
+def start_maintenance(interval=MAINTENANCE_INTERVAL_SECONDS):
+    """Run a pass every ``interval`` seconds in a daemon thread. Returns the stop event, or None if disabled."""
+    if interval <= 0:
+        return None
+    stop_event = threading.Event()
+
+    def _run():
+        while not stop_event.wait(interval):
+            try:
+                # Another worker already doing it is as good as doing it here
+                reports = run_pass(blocking=False)
+                for report in reports or ():
+                    log.info("Maintenance: %s", format_report(report))
+            except Exception:
+                log.exception("Database maintenance failed")
+
+    threading.Thread(target=_run, name="db-maintenance", daemon=True).start()
+    return stop_event
+
+
+def enable_incremental_vacuum(path):
+    """Switch an existing database to auto_vacuum=INCREMENTAL. Rewrites the whole file, so run it when quiet."""
+    conn = _connect(path)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close_for_real()
+
+
+def main(argv=None):
+    from migrations import check_schema
+
+    parser = argparse.ArgumentParser(description="Checkpoint, analyze and vacuum emails.db.")
+    parser.add_argument("--analyze", action="store_true", help="run a full ANALYZE instead of PRAGMA optimize")
+    parser.add_argument("--checkpoint", choices=["passive", "truncate"],
+                        help="checkpoint in this mode whatever the WAL size")
+    parser.add_argument("--retention-days", type=float, default=OUTBOX_RETENTION_DAYS,
+                        help="delete sent/failed outbox rows older than this (0 keeps them)")
+    parser.add_argument("--every", type=float, metavar="SECONDS", help="keep running a pass this often")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="VACUUM databases created before incremental vacuum was on, so it can work")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    check_schema()
+
+    if args.enable_incremental_vacuum:
+        for path in DB_PATHS:
+            started = time.perf_counter()
+            changed = enable_incremental_vacuum(path)
+            print(f"{path}: " + (f"vacuumed in {time.perf_counter() - started:.1f}s" if changed else "already on"))
+        return 0
+
+    mode = args.checkpoint.upper() if args.checkpoint else None
+    while True:
+        for report in run_pass(analyze=args.analyze, retention_days=args.retention_days, checkpoint_mode=mode):
+            print(format_report(report), flush=True)
+        if not args.every:
+            return 0
+        try:
+            time.sleep(args.every)
+        except KeyboardInterrupt:
+            return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
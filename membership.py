@@ -0,0 +1,210 @@
+"""Per-process Bloom filter of the addresses on the list.
+
+Most signups are for new addresses and most unsubscribe attempts for addresses we have never had,
+so asking the filter first lets those skip the lookup: a "definitely not there" answer sends a
+signup straight to its INSERT and an unsubscribe straight to "not on our list". A "maybe" answer
+does the normal query.
+
+Each process builds the filter with one streaming scan of every shard (stored and canonical
+address). It is sized for twice the current list, at least MIN_CAPACITY keys: at the default 1%
+false-positive rate that is about 2.4 MB per million subscribers (1.2 MB per million keys). A
+background thread then catches up every MEMBERSHIP_REFRESH_SECONDS with ``id > last seen id`` (ids
+only grow, see AUTOINCREMENT), so signups handled by other workers show up within that interval.
+Deletions can't be taken out of a Bloom filter; they only cost false positives until the full
+rebuild every MEMBERSHIP_REBUILD_SECONDS. Negative answers are only given while the filter has
+caught up within MEMBERSHIP_MAX_STALE_SECONDS, otherwise every lookup goes to the database.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import nullcontext
+from hashlib import blake2b
+
+import metrics
+from db import DB_PATHS, _connect
+
+log = logging.getLogger(__name__)
+
+MEMBERSHIP_FILTER = os.getenv("MEMBERSHIP_FILTER", "1") != "0"
+FALSE_POSITIVE_RATE = float(os.getenv("MEMBERSHIP_FP_RATE", "0.01"))
+REFRESH_SECONDS = float(os.getenv("MEMBERSHIP_REFRESH_SECONDS", "2"))
+REBUILD_SECONDS = float(os.getenv("MEMBERSHIP_REBUILD_SECONDS", "3600"))
+MAX_STALE_SECONDS = float(os.getenv("MEMBERSHIP_MAX_STALE_SECONDS", "10"))
+# Room to grow before the false-positive rate drifts up and forces an early rebuild
+MIN_CAPACITY = 100_000
+SCAN_PAGE = 10_000
+
+
+class BloomFilter:
+    """A plain Bloom filter over strings, sized for ``capacity`` keys at ``fp_rate``."""
+
+    def __init__(self, capacity, fp_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from the two halves of one 128-bit digest
+        digest = blake2b(key.encode("utf-8"), digest_size=16).digest()
+        size = self.size
+        pos = int.from_bytes(digest[:8], "little") % size
+        step = (int.from_bytes(digest[8:], "little") | 1) % size
+        for _ in range(self.hashes):
+            yield pos
+            pos = (pos + step) % size
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class _Membership:
+    def __init__(self, paths=DB_PATHS):
+        self.paths = list(paths)
+        self.lock = threading.Lock()
+        self.add_lock = threading.Lock()
+        self.filter = None
+        self.last_ids = [-1] * len(self.paths)
+        self.synced_at = 0.0
+        self.built_at = 0.0
+        # One read connection per shard, opened and used only by the membership thread
+        self.conns = [None] * len(self.paths)
+
+    def _conn(self, shard):
+        if self.conns[shard] is None:
+            self.conns[shard] = _connect(self.paths[shard])
+        return self.conns[shard]
+
+    def _close(self):
+        for shard, conn in enumerate(self.conns):
+            if conn is not None:
+                self.conns[shard] = None
+                try:
+                    conn.close_for_real()
+                except Exception:
+                    pass
+
+    def _scan(self, bloom, last_ids, lock=None):
+        """Add every row above ``last_ids`` (per shard) to ``bloom``; returns the new last ids.
+
+        Setting a bit is a read-modify-write of its byte, so adds to a filter in use hold ``lock``.
+        """
+        lock = lock or nullcontext()
+        last_ids = list(last_ids)
+        for shard in range(len(self.paths)):
+            conn = self._conn(shard)
+            while True:
+                rows = conn.execute(
+                    "SELECT id, email, canonical_email FROM subscribers WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_ids[shard], SCAN_PAGE),
+                ).fetchall()
+                if not rows:
+                    break
+                with lock:
+                    for row_id, email, canonical in rows:
+                        bloom.add(email)
+                        if canonical and canonical != email:
+                            bloom.add(canonical)
+                last_ids[shard] = rows[-1][0]
+        return last_ids
+
+    def build(self):
+        started = time.monotonic()
+        total = 0
+        for shard in range(len(self.paths)):
+            total += self._conn(shard).execute("SELECT COUNT(*) FROM subscribers").fetchone()[0]
+        # Usually one key per row (two when the stored address isn't canonical); room to double
+        bloom = BloomFilter(max(MIN_CAPACITY, total * 2), FALSE_POSITIVE_RATE)
+        last_ids = self._scan(bloom, [-1] * len(self.paths))
+        with self.lock:
+            self.filter = bloom
+            self.last_ids = last_ids
+            self.synced_at = started
+            self.built_at = started
+        log.info("Membership filter built: %d subscribers, %.1f MB, %.2fs",
+                 total, len(bloom.bits) / 1e6, time.monotonic() - started)
+
+    def refresh(self):
+        started = time.monotonic()
+        with self.lock:
+            bloom, last_ids = self.filter, self.last_ids
+        new_ids = self._scan(bloom, last_ids, self.add_lock)
+        with self.lock:
+            if self.filter is bloom:
+                self.last_ids = new_ids
+                self.synced_at = started
+        return bloom.count > bloom.capacity
+
+    def run(self):
+        while True:
+            try:
+                if self.filter is None or time.monotonic() - self.built_at > REBUILD_SECONDS:
+                    self.build()
+                elif self.refresh():
+                    log.info("Membership filter is full, rebuilding")
+                    self.build()
+            except Exception:
+                log.exception("Membership filter refresh failed")
+                # Start over with fresh connections in case one of them is what broke
+                self._close()
+            time.sleep(REFRESH_SECONDS)
+
+    def definitely_absent(self, *keys):
+        bloom = self.filter
+        if bloom is None or time.monotonic() - self.synced_at > MAX_STALE_SECONDS:
+            metrics.inc("email_list_membership_lookups_total", result="unavailable")
+            return False
+        absent = not any(key and key in bloom for key in keys)
+        metrics.inc("email_list_membership_lookups_total", result="absent" if absent else "maybe")
+        return absent
+
+    def add(self, *keys):
+        bloom = self.filter
+        if bloom is not None:
+            with self.add_lock:
+                for key in keys:
+                    if key:
+                        bloom.add(key)
+
+
+_state = {"pid": None, "membership": None}
+_start_lock = threading.Lock()
+
+
+def start():
+    """Build the filter in a background thread (once per process, again after a fork)."""
+    if not MEMBERSHIP_FILTER or _state["pid"] == os.getpid():
+        return _state["membership"]
+    with _start_lock:
+        if _state["pid"] != os.getpid():
+            membership = _Membership()
+            threading.Thread(target=membership.run, name="membership-filter", daemon=True).start()
+            _state["membership"] = membership
+            _state["pid"] = os.getpid()
+    return _state["membership"]
+
+
+def definitely_absent(canonical, email=None):
+    """True only if neither address can be on the list; False means "maybe", so query the database."""
+    membership = start()
+    return membership is not None and membership.definitely_absent(canonical, email)
+
+
+def add(canonical, email=None):
+    """Record a just-inserted subscriber so this process sees it before the next catch-up."""
+    membership = start()
+    if membership is not None:
+        membership.add(canonical, email)
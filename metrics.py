@@ -0,0 +1,343 @@
+"""Built-in instrumentation with a Prometheus text-format exporter.
+
+Each process keeps its own counters and histograms in memory and snapshots them to
+``METRICS_DIR/<pid>-<token>.json`` every few seconds. The /metrics endpoint sums every
+snapshot in the directory, so numbers stay correct across gunicorn workers and include the
+outbox worker and campaign sender processes. When a scrape finds snapshots of processes that have
+exited, it adds them into ``retired.json`` and deletes them, so counters stay monotonic while the
+directory stays small; clear the directory when redeploying if you want them reset.
+
+Request handlers don't time phases by hand: the pooled DB connection reports "db", the CSV
+change log reports "csv", template rendering reports "render" and mail delivery reports "smtp".
+Inside a request the time is attributed to that route.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from flask import g, has_request_context, request
+
+from locks import file_lock
+
+log = logging.getLogger(__name__)
+
+METRICS_DIR = os.path.abspath(os.getenv("METRICS_DIR", "metrics"))
+FLUSH_INTERVAL_SECONDS = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "email_list_request_seconds": ("histogram", "Request latency by route, method and status."),
+    "email_list_phase_seconds": ("histogram", "Time spent per phase (db, csv, smtp, render) by route."),
+    "email_list_db_errors_total": ("counter", "SQLite OperationalErrors, e.g. 'database is locked'."),
+    "email_list_smtp_failures_total": ("counter", "Failed SMTP deliveries by sender and kind."),
+    "email_list_smtp_sent_total": ("counter", "Messages accepted by the SMTP server by sender."),
+    "email_list_outbox_queue_depth": ("gauge", "Outbox messages pending or being sent."),
+    "email_list_write_batches_total": ("counter", "Write-behind transactions committed."),
+    "email_list_write_batch_jobs_total": ("counter", "Request writes committed by write-behind batches."),
+    "email_list_bounces_total": ("counter", "Bounces and complaints recorded, by kind (hard, soft, complaint)."),
+    "email_list_suppressed_total": ("counter", "Sends skipped because the address is suppressed, by sender."),
+    "email_list_journal_events_total": ("counter", "Events appended to the journal (events.jsonl)."),
+    "email_list_journal_batches_total": ("counter", "Buffered writes to the journal file."),
+    "email_list_breaker_transitions_total": ("counter", "Circuit breaker state changes, by breaker and new state."),
+    "email_list_smtp_breaker_state": ("gauge", "SMTP circuit breaker: 0 closed, 1 half-open (probing), 2 open."),
+    "email_list_smtp_breaker_failures": ("gauge", "SMTP failures in a row counted by the circuit breaker."),
+    "email_list_maintenance_seconds": ("histogram", "Maintenance steps by task (checkpoint, optimize, analyze, vacuum)."),
+    "email_list_wal_bytes": ("gauge", "Size of the -wal files of every shard."),
+    "email_list_membership_lookups_total": ("counter", "Membership filter answers: absent, maybe, or unavailable."),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_process = {"pid": None, "path": None}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _ensure_process():
+    """Start the snapshot thread once per process (again after a fork)."""
+    pid = os.getpid()
+    if _process["pid"] == pid:
+        return
+    with _lock:
+        if _process["pid"] == pid:
+            return
+        if _process["pid"] is not None:
+            # Forked child: the parent's numbers are already in the parent's snapshot
+            _counters.clear()
+            _histograms.clear()
+        _process["pid"] = pid
+        _process["path"] = os.path.join(METRICS_DIR, f"{pid}-{uuid.uuid4().hex[:8]}.json")
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+def inc(name, amount=1, **labels):
+    _ensure_process()
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    _ensure_process()
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            # One count per bucket plus +Inf, then sum
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+                break
+        else:
+            hist[len(BUCKETS)] += 1
+        hist[-1] += seconds
+
+
+def record_phase(phase, seconds, route=None):
+    """Attribute ``seconds`` of ``phase`` to the current request, or observe it directly for ``route``.
+
+    Without a request or an explicit route (CLI tools, the GUI) nothing is recorded.
+    """
+    if route is not None:
+        observe("email_list_phase_seconds", seconds, route=route, phase=phase)
+    elif has_request_context():
+        phases = g.setdefault("_metrics_phases", {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+class timed:
+    """Context manager: ``with metrics.timed("smtp", route="outbox"):``"""
+
+    def __init__(self, phase, route=None):
+        self.phase = phase
+        self.route = route
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_phase(self.phase, time.perf_counter() - self.started, self.route)
+        return False
+
+
+def init_app(app):
+    """Time every request and flush its per-phase totals when it finishes."""
+    from flask import before_render_template, template_rendered
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _metrics_finish(response):
+        started = g.pop("_metrics_started", None)
+        if started is not None:
+            route = request.endpoint or "unknown"
+            observe("email_list_request_seconds", time.perf_counter() - started,
+                    route=route, method=request.method, status=str(response.status_code))
+            for phase, seconds in g.pop("_metrics_phases", {}).items():
+                observe("email_list_phase_seconds", seconds, route=route, phase=phase)
+        return response
+
+    def _render_start(sender, template, context, **extra):
+        g._metrics_render_started = time.perf_counter()
+
+    def _render_done(sender, template, context, **extra):
+        started = g.pop("_metrics_render_started", None)
+        if started is not None:
+            record_phase("render", time.perf_counter() - started)
+
+    before_render_template.connect(_render_start, app, weak=False)
+    template_rendered.connect(_render_done, app, weak=False)
+
+
+def _snapshot():
+    with _lock:
+        return {
+            "counters": [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+            "histograms": [[name, dict(labels), list(values)] for (name, labels), values in _histograms.items()],
+        }
+
+
+def flush():
+    """Write this process's numbers to its snapshot file (atomically)."""
+    path = _process["path"]
+    if path is None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(_snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def _flush_loop():
+    pid = os.getpid()
+    while _process["pid"] == pid:
+        time.sleep(FLUSH_INTERVAL_SECONDS)
+        try:
+            flush()
+        except OSError:
+            log.exception("Failed to write metrics snapshot")
+
+
+atexit.register(lambda: _process["path"] and flush())
+
+
+RETIRED_NAME = "retired.json"
+
+
+def _merge(counters, histograms, data):
+    for name, labels, value in data.get("counters", []):
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in data.get("histograms", []):
+        key = _key(name, labels)
+        total = histograms.setdefault(key, [0] * len(values))
+        for i, v in enumerate(values):
+            total[i] += v
+
+
+def _load(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # EPERM: it exists, it just isn't ours
+        return True
+    return True
+
+
+def _retire(names):
+    """Fold snapshots of exited processes into RETIRED_NAME and delete them. Returns the retired totals.
+
+    retired.json lists the files it has absorbed until they are gone, so a crash between writing it
+    and deleting them never counts anything twice.
+    """
+    retired_path = os.path.join(METRICS_DIR, RETIRED_NAME)
+    with file_lock(os.path.join(METRICS_DIR, ".retire.lock"), blocking=False) as locked:
+        retired = _load(retired_path) or {}
+        if not locked:
+            # Another scrape is doing it; use the totals as they were
+            return retired
+        for fname in retired.get("folded", []):
+            try:
+                os.remove(os.path.join(METRICS_DIR, fname))
+            except FileNotFoundError:
+                pass
+        dead = []
+        for fname in names:
+            pid = fname.split("-", 1)[0]
+            if fname != RETIRED_NAME and pid.isdigit() and not _pid_alive(int(pid)):
+                dead.append(fname)
+        if not dead and not retired.get("folded"):
+            return retired
+        counters, histograms = {}, {}
+        _merge(counters, histograms, retired)
+        for fname in dead:
+            data = _load(os.path.join(METRICS_DIR, fname))
+            if data is not None:
+                _merge(counters, histograms, data)
+        retired = {
+            "counters": [[name, dict(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [[name, dict(labels), values] for (name, labels), values in histograms.items()],
+            "folded": dead,
+        }
+        tmp_path = retired_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(retired, f)
+        os.replace(tmp_path, retired_path)
+        for fname in dead:
+            try:
+                os.remove(os.path.join(METRICS_DIR, fname))
+            except FileNotFoundError:
+                pass
+        return retired
+
+
+def _collect():
+    """Sum every process snapshot in METRICS_DIR, after folding those of exited processes into one file."""
+    counters, histograms = {}, {}
+    try:
+        names = [fname for fname in os.listdir(METRICS_DIR) if fname.endswith(".json")]
+    except FileNotFoundError:
+        names = []
+    retired = {}
+    if names and os.name == "posix":
+        try:
+            retired = _retire(names)
+        except OSError:
+            log.exception("Failed to fold old metrics snapshots")
+    _merge(counters, histograms, retired)
+    skip = set(retired.get("folded", [])) | {RETIRED_NAME}
+    for fname in names:
+        if fname in skip:
+            continue
+        data = _load(os.path.join(METRICS_DIR, fname))
+        if data is not None:
+            _merge(counters, histograms, data)
+    return counters, histograms
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _fmt_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def render(gauges=None):
+    """Prometheus text exposition of all processes' metrics plus ``gauges`` ({name: value})."""
+    if _process["path"] is not None:
+        flush()
+    counters, histograms = _collect()
+    lines = []
+    described = set()
+
+    def describe(name):
+        if name in described:
+            return
+        described.add(name)
+        kind, text = HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name)
+        lines.append(f"{name}{_fmt_labels(labels)} {value}")
+    for (name, labels), values in sorted(histograms.items()):
+        describe(name)
+        cumulative = 0
+        for bound, count in zip(BUCKETS, values):
+            cumulative += count
+            lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', repr(bound))])} {cumulative}")
+        cumulative += values[len(BUCKETS)]
+        lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {cumulative}")
+        lines.append(f"{name}_sum{_fmt_labels(labels)} {values[-1]}")
+        lines.append(f"{name}_count{_fmt_labels(labels)} {cumulative}")
+    for name, value in (gauges or {}).items():
+        describe(name)
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,495 @@
+"""Versioned schema migrations, tracked with ``PRAGMA user_version``.
+
+Each entry in MIGRATIONS moves the database up one version. They run in order, each in its own
+transaction together with the version bump, and are written to be idempotent so databases created
+before versioning existed (user_version 0, but with some of the schema already in place) upgrade
+cleanly. Run them explicitly before starting the app or after deploying new code:
+
+    python migrations.py migrate
+    python migrations.py status
+
+Processes that only use the database call check_schema() at startup, which reads the version once
+per shard and refuses to start on an out-of-date database instead of altering it. With DB_SHARDS
+above 1 every shard file gets the same schema.
+"""
+import argparse
+import logging
+import sqlite3
+
+from db import DB_PATHS, ID_SHARD_BITS, _connect
+from subscriptions import ensure_csv_has_header
+from validation import canonicalize
+
+log = logging.getLogger(__name__)
+
+# Entries kept in subscriber_changes; a reader that falls further behind reloads everything
+CHANGE_LOG_KEEP = 10000
+
+# 0/1 expressions for the counters in subscriber_stats; {row} is NEW, OLD or a table name
+_IS_VERIFIED = "(IFNULL({row}.verified, 0) = 1)"
+_IS_UNSUBSCRIBED = "(IFNULL({row}.send, 1) = 0)"
+_IS_PENDING = "(IFNULL({row}.verified, 0) != 1 AND IFNULL({row}.send, 1) != 0)"
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table});").fetchall()]
+
+
+def _subscribers(conn):
+    """Create the table if missing, keep 'time', and ensure the 'send' and verification columns exist.
+
+    If an older DB has an 'active' column, migrate its values into 'send'.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscribers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            time TEXT,
+            send INTEGER DEFAULT 1
+        )
+    """)
+    cols = _columns(conn, "subscribers")
+    if "time" not in cols:
+        conn.execute("ALTER TABLE subscribers ADD COLUMN time TEXT")
+    if "send" not in cols:
+        # If an old 'active' column exists, add 'send' and populate from it
+        conn.execute("ALTER TABLE subscribers ADD COLUMN send INTEGER DEFAULT 1")
+        if "active" in cols:
+            conn.execute("UPDATE subscribers SET send = active WHERE active IS NOT NULL")
+        conn.execute("UPDATE subscribers SET send = 1 WHERE send IS NULL")
+    if "verified" not in cols:
+        conn.execute("ALTER TABLE subscribers ADD COLUMN verified INTEGER DEFAULT 0")
+        conn.execute("UPDATE subscribers SET verified = 0 WHERE verified IS NULL")
+    if "verification_code" not in cols:
+        conn.execute("ALTER TABLE subscribers ADD COLUMN verification_code TEXT")
+    if "code_expires_at" not in cols:
+        conn.execute("ALTER TABLE subscribers ADD COLUMN code_expires_at TEXT")
+
+
+def _code_expiry_epoch(conn):
+    """Expiry as integer epoch seconds, plus partial indexes for the expiry and stale-signup sweeps.
+
+    The old ISO column is converted and then left unused.
+    """
+    if "code_expires_epoch" not in _columns(conn, "subscribers"):
+        conn.execute("ALTER TABLE subscribers ADD COLUMN code_expires_epoch INTEGER")
+        conn.execute("""
+            UPDATE subscribers
+            SET code_expires_epoch = CAST(strftime('%s', code_expires_at) AS INTEGER),
+                code_expires_at = NULL
+            WHERE code_expires_at IS NOT NULL
+        """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_subscribers_code_expires
+        ON subscribers(code_expires_epoch) WHERE code_expires_epoch IS NOT NULL
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscribers_unverified_time ON subscribers(time) WHERE verified = 0")
+
+
+def _change_feed(conn):
+    """Triggers log every touched subscriber id so main.py can refresh only what changed.
+
+    The log trims itself to the newest CHANGE_LOG_KEEP entries.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscriber_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            subscriber_id INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_subscribers_log_insert AFTER INSERT ON subscribers
+        BEGIN
+            INSERT INTO subscriber_changes (subscriber_id) VALUES (NEW.id);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_subscribers_log_update AFTER UPDATE ON subscribers
+        BEGIN
+            INSERT INTO subscriber_changes (subscriber_id) VALUES (NEW.id);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_subscribers_log_delete AFTER DELETE ON subscribers
+        BEGIN
+            INSERT INTO subscriber_changes (subscriber_id) VALUES (OLD.id);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_subscriber_changes_trim AFTER INSERT ON subscriber_changes
+        BEGIN
+            DELETE FROM subscriber_changes WHERE seq <= NEW.seq - {CHANGE_LOG_KEEP};
+        END
+    """)
+
+
+def _stats_counters(conn):
+    """Aggregate counters kept current by triggers so stats.py answers in O(1) at any list size."""
+    stats_exist = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'subscriber_stats'"
+    ).fetchone()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscriber_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS signups_hourly (
+            hour TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    if not stats_exist:
+        # Seed the counters from the current rows
+        conn.execute(f"""
+            INSERT INTO subscriber_stats (name, value)
+            SELECT 'total', COUNT(*) FROM subscribers
+            UNION ALL SELECT 'verified', COALESCE(SUM({_IS_VERIFIED.format(row="subscribers")}), 0) FROM subscribers
+            UNION ALL SELECT 'unsubscribed', COALESCE(SUM({_IS_UNSUBSCRIBED.format(row="subscribers")}), 0) FROM subscribers
+            UNION ALL SELECT 'pending', COALESCE(SUM({_IS_PENDING.format(row="subscribers")}), 0) FROM subscribers
+        """)
+        conn.execute("""
+            INSERT INTO signups_hourly (hour, count)
+            SELECT substr(time, 1, 13) || ':00', COUNT(*) FROM subscribers
+            WHERE time IS NOT NULL
+            GROUP BY substr(time, 1, 13)
+        """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_subscribers_stats_insert AFTER INSERT ON subscribers
+        BEGIN
+            UPDATE subscriber_stats SET value = value + CASE name
+                WHEN 'total' THEN 1
+                WHEN 'verified' THEN {_IS_VERIFIED.format(row="NEW")}
+                WHEN 'unsubscribed' THEN {_IS_UNSUBSCRIBED.format(row="NEW")}
+                WHEN 'pending' THEN {_IS_PENDING.format(row="NEW")}
+                ELSE 0 END;
+            INSERT INTO signups_hourly (hour, count) VALUES (strftime('%Y-%m-%dT%H:00', 'now'), 1)
+                ON CONFLICT (hour) DO UPDATE SET count = count + 1;
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_subscribers_stats_update AFTER UPDATE OF send, verified ON subscribers
+        BEGIN
+            UPDATE subscriber_stats SET value = value + CASE name
+                WHEN 'verified' THEN {_IS_VERIFIED.format(row="NEW")} - {_IS_VERIFIED.format(row="OLD")}
+                WHEN 'unsubscribed' THEN {_IS_UNSUBSCRIBED.format(row="NEW")} - {_IS_UNSUBSCRIBED.format(row="OLD")}
+                WHEN 'pending' THEN {_IS_PENDING.format(row="NEW")} - {_IS_PENDING.format(row="OLD")}
+                ELSE 0 END
+            WHERE name != 'total';
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_subscribers_stats_delete AFTER DELETE ON subscribers
+        BEGIN
+            UPDATE subscriber_stats SET value = value - CASE name
+                WHEN 'total' THEN 1
+                WHEN 'verified' THEN {_IS_VERIFIED.format(row="OLD")}
+                WHEN 'unsubscribed' THEN {_IS_UNSUBSCRIBED.format(row="OLD")}
+                WHEN 'pending' THEN {_IS_PENDING.format(row="OLD")}
+                ELSE 0 END;
+        END
+    """)
+
+
+def _outbox(conn):
+    """Outgoing mail waits here until outbox.py delivers it, so requests never block on SMTP."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            to_email TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            sent_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+
+
+def _campaigns(conn):
+    """Bulk campaigns; campaign_deliveries is the per-recipient checkpoint that makes sends resumable."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'draft',
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS campaign_deliveries (
+            campaign_id INTEGER NOT NULL,
+            subscriber_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (campaign_id, subscriber_id)
+        ) WITHOUT ROWID
+    """)
+
+
+def _canonical_email(conn, batch_size=5000):
+    """canonical_email with a unique index, so Gmail dot/plus variants count as the same subscriber.
+
+    Existing rows are backfilled in id order. If several older rows share a canonical form, the
+    oldest keeps it and the rest stay NULL; verification and /unsubscribe still find those by their exact
+    address.
+    """
+    if "canonical_email" not in _columns(conn, "subscribers"):
+        conn.execute("ALTER TABLE subscribers ADD COLUMN canonical_email TEXT")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_subscribers_canonical ON subscribers(canonical_email)")
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, email FROM subscribers WHERE id > ? AND canonical_email IS NULL ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+        conn.executemany(
+            "UPDATE OR IGNORE subscribers SET canonical_email = ? WHERE id = ?",
+            [(canonicalize(email.strip().lower()), row_id) for row_id, email in rows],
+        )
+        last_id = rows[-1][0]
+    collisions = conn.execute("SELECT COUNT(*) FROM subscribers WHERE canonical_email IS NULL").fetchone()[0]
+    if collisions:
+        log.warning("%d subscribers share a canonical address with an older row; left without one", collisions)
+
+
+def _email_search(conn):
+    """A trigram FTS5 index over email for substring search in main.py, and an index on time for date filters.
+
+    The index is external-content (it stores only the trigrams, not a second copy of each address) and
+    kept in step by triggers. SQLite builds without FTS5 or older than 3.34 (no trigram tokenizer) skip
+    it; main.py then falls back to a LIKE scan.
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscribers_time ON subscribers(time)")
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS subscribers_fts
+            USING fts5(email, content='subscribers', content_rowid='id', tokenize='trigram')
+        """)
+    except sqlite3.OperationalError as e:
+        log.warning("Email search index not available in this SQLite build (%s); search will scan", e)
+        return
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_subscribers_fts_insert AFTER INSERT ON subscribers
+        BEGIN
+            INSERT INTO subscribers_fts (rowid, email) VALUES (NEW.id, NEW.email);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_subscribers_fts_delete AFTER DELETE ON subscribers
+        BEGIN
+            INSERT INTO subscribers_fts (subscribers_fts, rowid, email) VALUES ('delete', OLD.id, OLD.email);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_subscribers_fts_update AFTER UPDATE OF email ON subscribers
+        BEGIN
+            INSERT INTO subscribers_fts (subscribers_fts, rowid, email) VALUES ('delete', OLD.id, OLD.email);
+            INSERT INTO subscribers_fts (rowid, email) VALUES (NEW.id, NEW.email);
+        END
+    """)
+    conn.execute("INSERT INTO subscribers_fts (subscribers_fts) VALUES ('rebuild')")
+
+
+def _suppressions(conn):
+    """Addresses that must not be mailed (hard bounces, complaints, repeated soft bounces), keyed on the
+    canonical address so every send path checks them with one primary-key lookup.
+
+    Each shard holds the rows for its own addresses. bounce_sources remembers how far bounces.py has
+    read each mbox (used on shard 0 only).
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS suppressions (
+            canonical_email TEXT PRIMARY KEY,
+            reason TEXT NOT NULL,
+            detail TEXT,
+            created_at TEXT NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS soft_bounces (
+            canonical_email TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            first_at TEXT NOT NULL,
+            last_at TEXT NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bounce_sources (
+            path TEXT PRIMARY KEY,
+            offset INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def _drop_change_feed(conn):
+    """The viewer pages through the database itself now (see search.py) and nothing reads
+    subscriber_changes, so stop paying for its triggers on every subscriber write."""
+    for trigger in (
+        "trg_subscribers_log_insert",
+        "trg_subscribers_log_update",
+        "trg_subscribers_log_delete",
+        "trg_subscriber_changes_trim",
+    ):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute("DROP TABLE IF EXISTS subscriber_changes")
+
+
+def _signups_by_row_time(conn):
+    """Count each signup in the hour of its own ``time`` rather than the hour it was inserted, so an
+    import (which keeps the source file's times) doesn't all land in the current hour of /stats."""
+    conn.execute("DROP TRIGGER IF EXISTS trg_subscribers_stats_insert")
+    conn.execute(f"""
+        CREATE TRIGGER trg_subscribers_stats_insert AFTER INSERT ON subscribers
+        BEGIN
+            UPDATE subscriber_stats SET value = value + CASE name
+                WHEN 'total' THEN 1
+                WHEN 'verified' THEN {_IS_VERIFIED.format(row="NEW")}
+                WHEN 'unsubscribed' THEN {_IS_UNSUBSCRIBED.format(row="NEW")}
+                WHEN 'pending' THEN {_IS_PENDING.format(row="NEW")}
+                ELSE 0 END;
+            INSERT INTO signups_hourly (hour, count)
+                VALUES (COALESCE(substr(NEW.time, 1, 13) || ':00', strftime('%Y-%m-%dT%H:00', 'now')), 1)
+                ON CONFLICT (hour) DO UPDATE SET count = count + 1;
+        END
+    """)
+    # Imports so far were counted in the hour they ran
+    conn.execute("DELETE FROM signups_hourly")
+    conn.execute("""
+        INSERT INTO signups_hourly (hour, count)
+        SELECT substr(time, 1, 13) || ':00', COUNT(*) FROM subscribers
+        WHERE time IS NOT NULL
+        GROUP BY substr(time, 1, 13)
+    """)
+
+
+# Append only: a migration's position is its version number, so never reorder or remove entries
+MIGRATIONS = [
+    _subscribers,
+    _code_expiry_epoch,
+    _change_feed,
+    _stats_counters,
+    _outbox,
+    _campaigns,
+    _canonical_email,
+    _email_search,
+    _suppressions,
+    _drop_change_feed,
+    _signups_by_row_time,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def _reserve_id_range(conn, shard):
+    """Start AUTOINCREMENT ids on shard ``shard`` at shard << ID_SHARD_BITS so ids are unique across shards."""
+    base = shard << ID_SHARD_BITS
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'subscribers'").fetchone()
+        if row is None:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('subscribers', ?)", (base,))
+        elif row[0] < base:
+            conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'subscribers'", (base,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _migrate_file(path, shard, target):
+    # A dedicated connection: migrations run before gunicorn forks, and pooled handles must not cross a fork
+    conn = _connect(path)
+    try:
+        start = schema_version(conn)
+        version = start
+        while version < target:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = schema_version(conn)
+                if version >= target:
+                    conn.rollback()
+                    break
+                step = MIGRATIONS[version]
+                log.info("Migrating %s to version %d (%s)", path, version + 1, step.__name__.strip("_"))
+                step(conn)
+                version += 1
+                # PRAGMA does not take bound parameters; version is always an int here
+                conn.execute(f"PRAGMA user_version = {version};")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                log.exception("Migration of %s to version %d failed", path, version + 1)
+                raise
+        if shard:
+            _reserve_id_range(conn, shard)
+        return start, version
+    finally:
+        conn.close_for_real()
+
+
+def migrate(target=SCHEMA_VERSION, paths=None):
+    """Apply every migration above each shard's version, up to ``target``. Returns {path: (old, new)}.
+
+    Each step holds the write lock for its own transaction, so two concurrent runs never apply the same one.
+    """
+    paths = DB_PATHS if paths is None else paths
+    return {path: _migrate_file(path, shard, target) for shard, path in enumerate(paths)}
+
+
+def check_schema():
+    """Startup check: one read of user_version per shard. Raises RuntimeError if migrations are pending."""
+    for path in DB_PATHS:
+        conn = _connect(path)
+        try:
+            version = schema_version(conn)
+        finally:
+            conn.close_for_real()
+        if version < SCHEMA_VERSION:
+            raise RuntimeError(
+                f"{path} is at schema version {version}, this code needs {SCHEMA_VERSION}. "
+                "Run `python migrations.py migrate` first."
+            )
+        if version > SCHEMA_VERSION:
+            log.warning("%s is at schema version %d, newer than this code (%d)", path, version, SCHEMA_VERSION)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upgrade the emails.db schema.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="apply pending migrations and upgrade old emails.csv files")
+    sub.add_parser("status", help="show the current and latest schema version")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "migrate":
+        for path, (old, new) in migrate().items():
+            print(f"{path}: schema version {old} -> {new}" if new != old else f"{path}: already at version {new}")
+        # Older emails.csv files have no 'send' column; rewrite them once here rather than on startup
+        ensure_csv_has_header()
+    else:
+        for path in DB_PATHS:
+            conn = _connect(path)
+            try:
+                version = schema_version(conn)
+            finally:
+                conn.close_for_real()
+            print(f"{path}: schema version {version} (latest {SCHEMA_VERSION})")
+
+
+if __name__ == "__main__":
+    main()
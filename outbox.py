@@ -0,0 +1,260 @@
+"""SQLite-backed outbox for outgoing mail.
+
+Request handlers call enqueue_*() inside their own transaction and return right away.
+A worker (``python outbox.py``) drains the queue over long-lived SMTP sessions and
+records attempts, errors and delivery status on each message.
+"""
+import argparse
+import logging
+import os
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+
+import metrics
+from bounces import SOFT, is_suppressed, record_smtp_failure
+from breaker import CircuitOpenError
+from db import SHARDS, get_db
+from email_utils import (
+    CODE_TTL_MINUTES, VERIFICATION_SUBJECT, build_message, open_smtp, send_message, verification_body, verify_url,
+)
+from migrations import check_schema
+from tokens import VERIFY_LINK_TTL_SECONDS
+
+log = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+# A claimed message is leased to its worker for this long; if the worker dies it becomes due again
+LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+POLL_INTERVAL_SECONDS = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+# Close the SMTP session after this long without work; servers drop idle connections anyway
+SMTP_IDLE_SECONDS = float(os.getenv("OUTBOX_SMTP_IDLE_SECONDS", "60"))
+
+
+def _now():
+    return datetime.utcnow()
+
+
+def enqueue_email(conn, to_email, subject, body):
+    """Queue a message using the caller's connection. The caller commits, so the message is only
+    sent if the surrounding transaction (e.g. the subscriber insert) succeeds."""
+    now = _now().isoformat()
+    cur = conn.execute("""
+        INSERT INTO outbox (to_email, subject, body, status, next_attempt_at, created_at)
+        VALUES (?, ?, ?, 'pending', ?, ?)
+    """, (to_email, subject, body, now, now))
+    return cur.lastrowid
+
+
+def enqueue_verification_email(conn, to_email, code, ttl_minutes=CODE_TTL_MINUTES):
+    """The email carries both the code for the form and a signed verification link.
+
+    The link stays valid for VERIFY_LINK_TTL_HOURS, or ``ttl_minutes`` if that is longer.
+    """
+    link = verify_url(to_email, max(VERIFY_LINK_TTL_SECONDS, ttl_minutes * 60))
+    return enqueue_email(conn, to_email, VERIFICATION_SUBJECT, verification_body(code, ttl_minutes, link))
+
+
+def claim_batch(conn, limit=BATCH_SIZE):
+    """Atomically lease up to ``limit`` due messages. Safe to call from several threads or processes."""
+    now = _now()
+    lease_until = (now + timedelta(seconds=LEASE_SECONDS)).isoformat()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute("""
+            SELECT id, to_email, subject, body, attempts
+            FROM outbox
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+            ORDER BY next_attempt_at
+            LIMIT ?
+        """, (now.isoformat(), limit)).fetchall()
+        conn.executemany(
+            "UPDATE outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+            [(lease_until, r["id"]) for r in rows],
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
+
+
+def mark_sent(conn, message_id):
+    # Drop the body once delivered: verification bodies carry the plaintext code
+    conn.execute(
+        "UPDATE outbox SET status = 'sent', sent_at = ?, body = NULL, last_error = NULL WHERE id = ?",
+        (_now().isoformat(), message_id),
+    )
+    conn.commit()
+
+
+def mark_failed(conn, message_id, attempts, error, permanent=False):
+    """Schedule a retry with exponential backoff, or give up after MAX_ATTEMPTS."""
+    if permanent or attempts >= MAX_ATTEMPTS:
+        conn.execute(
+            "UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?",
+            (str(error)[:500], message_id),
+        )
+    else:
+        delay = min(30 * 2 ** (attempts - 1), 3600)
+        retry_at = (_now() + timedelta(seconds=delay)).isoformat()
+        conn.execute(
+            "UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (retry_at, str(error)[:500], message_id),
+        )
+    conn.commit()
+
+
+def defer(conn, message_ids, seconds, error):
+    """Hand claimed messages back for a retry in ``seconds`` without using up an attempt."""
+    retry_at = (_now() + timedelta(seconds=seconds)).isoformat()
+    conn.executemany(
+        "UPDATE outbox SET status = 'pending', attempts = attempts - 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+        [(retry_at, str(error)[:500], message_id) for message_id in message_ids],
+    )
+    conn.commit()
+
+
+def queue_depth(conn):
+    return conn.execute("SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+
+
+class _Session:
+    """Lazily opened SMTP connection that is reused across messages and reopened after errors."""
+
+    def __init__(self):
+        self.smtp = None
+        self.last_used = 0.0
+
+    def get(self):
+        if self.smtp is not None and time.monotonic() - self.last_used > SMTP_IDLE_SECONDS:
+            self.close()
+        if self.smtp is None:
+            self.smtp = open_smtp()
+        self.last_used = time.monotonic()
+        return self.smtp
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+            self.smtp = None
+
+
+def _deliver(conn, session, row):
+    reason = is_suppressed(conn, row["to_email"])
+    if reason:
+        log.info("Not sending outbox message %s: %s is suppressed (%s)", row["id"], row["to_email"], reason)
+        metrics.inc("email_list_suppressed_total", sender="outbox")
+        mark_failed(conn, row["id"], row["attempts"] + 1, f"suppressed ({reason})", permanent=True)
+        return False
+    msg = build_message(row["to_email"], row["subject"], row["body"] or "")
+    try:
+        with metrics.timed("smtp", route="outbox"):
+            send_message(session.get(), msg)
+    except CircuitOpenError:
+        raise
+    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as e:
+        # The server refused the address or the message. A temporary refusal (e.g. greylisting) is
+        # retried; a permanent one will not improve. Either way it counts as a bounce.
+        log.warning("Recipient refused for outbox message %s: %s", row["id"], e)
+        metrics.inc("email_list_smtp_failures_total", sender="outbox", kind="refused")
+        kind = record_smtp_failure(conn, row["to_email"], e)
+        mark_failed(conn, row["id"], row["attempts"] + 1, e, permanent=kind != SOFT)
+        return False
+    except Exception as e:
+        log.exception("Failed to deliver outbox message %s", row["id"])
+        metrics.inc("email_list_smtp_failures_total", sender="outbox", kind="error")
+        session.close()
+        mark_failed(conn, row["id"], row["attempts"] + 1, e)
+        return False
+    metrics.inc("email_list_smtp_sent_total", sender="outbox")
+    mark_sent(conn, row["id"])
+    log.info("Delivered outbox message %s to %s", row["id"], row["to_email"])
+    return True
+
+
+def drain(conn, session, limit=BATCH_SIZE):
+    """Deliver one batch of due messages. Returns the number of messages claimed."""
+    rows = claim_batch(conn, limit)
+    for i, row in enumerate(rows):
+        try:
+            _deliver(conn, session, row)
+        except CircuitOpenError as e:
+            # The server is known to be down: give the rest of the batch back until the breaker probes it
+            metrics.inc("email_list_smtp_failures_total", sender="outbox", kind="circuit_open")
+            defer(conn, [r["id"] for r in rows[i:]], e.retry_after, e)
+            raise
+    return len(rows)
+
+
+def run_worker(stop_event=None, once=False):
+    """Poll the outbox and deliver messages until ``stop_event`` is set (or after one pass with ``once``)."""
+    stop_event = stop_event or threading.Event()
+    session = _Session()
+    # Each shard has its own outbox, filled in the same transaction as its subscribers
+    conns = [get_db(shard) for shard in range(SHARDS)]
+    try:
+        while not stop_event.is_set():
+            claimed = 0
+            pause = 0.0
+            for conn in conns:
+                try:
+                    claimed += drain(conn, session)
+                except CircuitOpenError as e:
+                    log.info("SMTP circuit is open, pausing delivery for %.0fs", e.retry_after)
+                    session.close()
+                    pause = max(e.retry_after, POLL_INTERVAL_SECONDS)
+                    break
+                except Exception:
+                    log.exception("Outbox worker iteration failed")
+            if once:
+                break
+            if pause or claimed == 0:
+                stop_event.wait(pause or POLL_INTERVAL_SECONDS)
+    finally:
+        session.close()
+        for conn in conns:
+            conn.close()
+
+
+def start_worker_threads(count=1):
+    """Run ``count`` workers as daemon threads in this process. Returns the event that stops them."""
+    stop_event = threading.Event()
+    for i in range(count):
+        t = threading.Thread(target=run_worker, args=(stop_event,), name=f"outbox-worker-{i}", daemon=True)
+        t.start()
+    return stop_event
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deliver queued emails from the outbox.")
+    parser.add_argument("--threads", type=int, default=1, help="number of worker threads (one SMTP session each)")
+    parser.add_argument("--once", action="store_true", help="deliver one batch per thread and exit")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    check_schema()
+
+    if args.once:
+        threads = [threading.Thread(target=run_worker, kwargs={"once": True}) for _ in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return
+
+    stop_event = start_worker_threads(args.threads)
+    try:
+        while not stop_event.is_set():
+            stop_event.wait(1)
+    except KeyboardInterrupt:
+        stop_event.set()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Token-bucket rate limiting for the public POST routes.
+
+Each route has a bucket per client IP and per submitted email. Requests over the limit get a
+plain 429 before any database or SMTP work happens. Buckets live in a bounded in-memory LRU by
+default (per worker); set RATE_LIMIT_BACKEND=sqlite to share them across gunicorn workers through
+a small separate database file.
+"""
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+
+from validation import canonicalize, normalize
+
+log = logging.getLogger(__name__)
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_DB_PATH = os.path.abspath(os.getenv("RATE_LIMIT_DB", "ratelimit.db"))
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") != "0"
+# Use the first X-Forwarded-For address as the client IP; only safe behind a proxy that sets it
+TRUST_PROXY = os.getenv("TRUST_PROXY", "0") == "1"
+MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# (burst capacity, tokens refilled per second) per route and key type
+LIMITS = {
+    "signup": {"ip": (10, 10 / 60), "email": (3, 1 / 300)},
+    "verify": {"ip": (20, 20 / 60), "email": (5, 5 / 600)},
+    "unsubscribe": {"ip": (10, 10 / 60), "email": (5, 5 / 600)},
+}
+
+
+def _refill(tokens, updated, now, capacity, rate):
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+class MemoryStore:
+    """Buckets in an LRU dict. Old entries are evicted; a bucket idle long enough to refill
+    completely is dropped too, since a missing bucket and a full one behave the same."""
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now=None):
+        """Spend one token. Returns 0 if allowed, otherwise seconds until a token is available."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.buckets.pop(key, None)
+            tokens = capacity if entry is None else _refill(entry[0], entry[1], now, capacity, rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            if tokens < capacity:
+                self.buckets[key] = (tokens, now)
+                while len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            return wait
+
+
+class SQLiteStore:
+    """Buckets shared by every process on the host, in a database file separate from emails.db."""
+
+    def __init__(self, path=RATE_LIMIT_DB_PATH):
+        self.path = path
+        self.local = threading.local()
+        self.calls = 0
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None or getattr(self.local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            # Limiter state is disposable; losing the last writes in a power cut is fine
+            conn.execute("PRAGMA synchronous=OFF;")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def take(self, key, capacity, rate, now=None):
+        # Wall clock, not monotonic: the value is compared across processes
+        now = time.time() if now is None else now
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else _refill(row[0], row[1], now, capacity, rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+            self.calls += 1
+            if self.calls % 1000 == 0:
+                # Anything idle for an hour has refilled under every configured limit
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 3600,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = SQLiteStore() if RATE_LIMIT_BACKEND == "sqlite" else MemoryStore()
+    return _store
+
+
+def client_ip():
+    if TRUST_PROXY and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr or "unknown"
+
+
+def check(name, ip, email=None):
+    """Return seconds to wait if the request is over any limit for route ``name``, else 0."""
+    limits = LIMITS[name]
+    store = get_store()
+    try:
+        capacity, rate = limits["ip"]
+        wait = store.take(f"{name}:ip:{ip}", capacity, rate)
+        if not wait and email:
+            capacity, rate = limits["email"]
+            wait = store.take(f"{name}:email:{email}", capacity, rate)
+    except sqlite3.Error:
+        # Fail open: a broken limiter must not take signups down with it
+        log.exception("Rate limiter store failed")
+        return 0
+    return wait
+
+
+def rate_limited(name):
+    """Decorator for a route: shed POSTs over the limits for ``name`` with a fast 429."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if RATE_LIMIT_ENABLED and request.method == "POST":
+                # Keyed on the canonical form so dot/plus variants share one bucket
+                email = canonicalize(normalize(request.form.get("email", "")))
+                wait = check(name, client_ip(), email)
+                if wait:
+                    retry_after = max(1, int(wait + 0.999))
+                    return "Too many requests. Please try again later.", 429, {
+                        "Retry-After": str(retry_after),
+                        "Content-Type": "text/plain; charset=utf-8",
+                    }
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,179 @@
+"""Copy the subscriber database into a different number of shards.
+
+    python reshard.py 4
+
+Reads every shard of the current layout (DB_SHARDS) and writes a fresh set of files for the new one,
+placing each subscriber by the hash of their canonical address. Subscribers get new ids in their
+shard's range; campaign deliveries follow them by address, and pending outbox mail and
+suppressions follow their recipient. The old files are left untouched, so stop the server and
+workers first, then point DB_SHARDS at the new count (or move the old files away and back) once it
+finishes.
+"""
+import argparse
+import logging
+import os
+import sys
+
+import migrations
+from db import DB_PATHS, SHARDS, _connect, shard_for_email, shard_paths
+from validation import canonicalize, normalize
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+SUBSCRIBER_COLUMNS = (
+    "email", "canonical_email", "time", "send", "verified",
+    "verification_code", "code_expires_at", "code_expires_epoch",
+)
+OUTBOX_COLUMNS = (
+    "to_email", "subject", "body", "status", "attempts", "next_attempt_at", "last_error", "created_at", "sent_at",
+)
+
+
+def _insert_many(conn, table, columns, rows):
+    placeholders = ", ".join("?" for _ in columns)
+    conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+def _route(email, canonical, count):
+    return shard_for_email(canonical or canonicalize(normalize(email)), count)
+
+
+def _copy_subscribers(source, targets):
+    count = len(targets)
+    batches = [[] for _ in targets]
+    copied = 0
+    last_id = -1
+    while True:
+        rows = source.execute(
+            f"SELECT id, {', '.join(SUBSCRIBER_COLUMNS)} FROM subscribers WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, BATCH_SIZE),
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        for row in rows:
+            batches[_route(row["email"], row["canonical_email"], count)].append(
+                tuple(row[c] for c in SUBSCRIBER_COLUMNS)
+            )
+        for conn, batch in zip(targets, batches):
+            if batch:
+                _insert_many(conn, "subscribers", SUBSCRIBER_COLUMNS, batch)
+                batch.clear()
+        copied += len(rows)
+    return copied
+
+
+def _copy_deliveries(source, targets):
+    count = len(targets)
+    batches = [[] for _ in targets]
+    for row in source.execute("""
+        SELECT d.campaign_id, d.status, d.error, d.updated_at, s.email, s.canonical_email
+        FROM campaign_deliveries d JOIN subscribers s ON s.id = d.subscriber_id
+    """):
+        batches[_route(row["email"], row["canonical_email"], count)].append(
+            (row["campaign_id"], row["status"], row["error"], row["updated_at"], row["email"])
+        )
+    for conn, batch in zip(targets, batches):
+        # The subscriber's new id is only known on its target shard, so look it up there by address
+        conn.executemany("""
+            INSERT INTO campaign_deliveries (campaign_id, subscriber_id, status, error, updated_at)
+            SELECT ?, id, ?, ?, ? FROM subscribers WHERE email = ?
+        """, batch)
+
+
+def _copy_outbox(source, targets):
+    count = len(targets)
+    batches = [[] for _ in targets]
+    for row in source.execute(f"SELECT {', '.join(OUTBOX_COLUMNS)} FROM outbox ORDER BY id"):
+        batches[_route(row["to_email"], None, count)].append(tuple(row[c] for c in OUTBOX_COLUMNS))
+    for conn, batch in zip(targets, batches):
+        _insert_many(conn, "outbox", OUTBOX_COLUMNS, batch)
+
+
+def _copy_suppressions(source, targets):
+    count = len(targets)
+    for table, columns in (
+        ("suppressions", ("canonical_email", "reason", "detail", "created_at")),
+        ("soft_bounces", ("canonical_email", "count", "first_at", "last_at")),
+    ):
+        batches = [[] for _ in targets]
+        for row in source.execute(f"SELECT {', '.join(columns)} FROM {table}"):
+            batches[shard_for_email(row["canonical_email"], count)].append(tuple(row))
+        for conn, batch in zip(targets, batches):
+            _insert_many(conn, table, columns, batch)
+
+
+def reshard(count, source_paths=DB_PATHS):
+    """Write the data in ``source_paths`` into ``count`` new shard files. Returns the new paths."""
+    target_paths = shard_paths(count)
+    if target_paths == list(source_paths):
+        raise ValueError(f"The database is already in {count} shard(s)")
+    existing = [path for path in target_paths if os.path.exists(path)]
+    if existing:
+        raise ValueError(f"{', '.join(existing)} already exists; move it away first")
+
+    migrations.migrate(paths=target_paths)
+    targets = [_connect(path) for path in target_paths]
+    try:
+        for conn in targets:
+            conn.execute("BEGIN IMMEDIATE")
+        for shard, path in enumerate(source_paths):
+            source = _connect(path)
+            try:
+                log.info("Copying %s", path)
+                copied = _copy_subscribers(source, targets)
+                _copy_deliveries(source, targets)
+                _copy_outbox(source, targets)
+                _copy_suppressions(source, targets)
+                if shard == 0:
+                    # Campaign metadata lives on shard 0 in every layout and keeps its ids
+                    targets[0].executemany(
+                        "INSERT INTO campaigns (id, subject, body, status, created_at, started_at, finished_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [tuple(row) for row in source.execute(
+                            "SELECT id, subject, body, status, created_at, started_at, finished_at FROM campaigns"
+                        )],
+                    )
+                    targets[0].executemany(
+                        "INSERT INTO bounce_sources (path, offset) VALUES (?, ?)",
+                        [tuple(row) for row in source.execute("SELECT path, offset FROM bounce_sources")],
+                    )
+                log.info("Copied %d subscribers from %s", copied, path)
+            finally:
+                source.close_for_real()
+        for conn in targets:
+            conn.commit()
+    except Exception:
+        for conn in targets:
+            if conn.in_transaction:
+                conn.rollback()
+        raise
+    finally:
+        for conn in targets:
+            conn.close_for_real()
+    return target_paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copy emails.db into a different number of shards.")
+    parser.add_argument("shards", type=int, help="number of shard files to write")
+    args = parser.parse_args(argv)
+    if args.shards < 1:
+        parser.error("shards must be at least 1")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    migrations.check_schema()
+    try:
+        paths = reshard(args.shards)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for path in paths:
+        print(f"wrote {path}")
+    print(f"Stop the server and workers, then restart them with DB_SHARDS={args.shards} (was {SHARDS}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
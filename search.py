@@ -0,0 +1,77 @@
+"""Filtered, paged subscriber queries for the GUI viewer.
+
+Text filters become SQL against indexes: "contains" searches go through the trigram index
+``subscribers_fts`` (terms of three characters or more; shorter ones, or databases without the
+index, use LIKE) and "starts with" is a range on the unique email index. Pages are keyset pages on
+id, so page 1000 costs the same as page 1. Date, verified and send filters are checked on the rows
+the id walk visits; they don't use an index, so a filter that matches little scans further per page.
+"""
+from collections import namedtuple
+from itertools import islice
+
+from storage import iter_subscribers
+
+COLUMNS = "s.id, s.email, s.time, s.send, s.verified, s.verification_code, s.code_expires_epoch"
+PAGE_ROWS = 200
+# The trigram tokenizer cannot match anything shorter
+MIN_TRIGRAM_LENGTH = 3
+
+Filters = namedtuple("Filters", ["text", "mode", "verified", "send", "since", "until"])
+"""``mode`` is "contains" or "prefix"; ``verified`` and ``send`` are 1, 0 or None (any);
+``since``/``until`` are ISO dates or times, until exclusive. Empty strings mean no filter."""
+NO_FILTERS = Filters("", "contains", None, None, "", "")
+
+_has_fts = {}
+
+
+def _fts_available(conn):
+    path = conn._path
+    if path not in _has_fts:
+        _has_fts[path] = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'subscribers_fts'"
+        ).fetchone() is not None
+    return _has_fts[path]
+
+
+def _like_escape(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def build_where(filters, use_fts=True):
+    """Turn Filters into a WHERE clause over ``subscribers s`` and its parameters."""
+    clauses, params = [], []
+    text = filters.text.strip().lower()
+    if text and filters.mode == "prefix":
+        # A range on the email index; the upper bound is the prefix with its last character bumped.
+        # As a subquery, because next to "s.id > ?" the planner would otherwise walk the table by id
+        clauses.append("s.id IN (SELECT id FROM subscribers WHERE email >= ? AND email < ?)")
+        params += [text, text[:-1] + chr(ord(text[-1]) + 1)]
+    elif text and use_fts and len(text) >= MIN_TRIGRAM_LENGTH:
+        clauses.append("s.id IN (SELECT rowid FROM subscribers_fts WHERE subscribers_fts MATCH ?)")
+        # Quoted as one phrase, so the trigram index matches it as a plain substring
+        params.append('"%s"' % text.replace('"', '""'))
+    elif text:
+        clauses.append("s.email LIKE ? ESCAPE '\\'")
+        params.append(f"%{_like_escape(text)}%")
+    if filters.verified is not None:
+        clauses.append("COALESCE(s.verified, 0) = ?")
+        params.append(filters.verified)
+    if filters.send is not None:
+        clauses.append("COALESCE(s.send, 1) = ?")
+        params.append(filters.send)
+    if filters.since:
+        clauses.append("s.time >= ?")
+        params.append(filters.since)
+    if filters.until:
+        clauses.append("s.time < ?")
+        params.append(filters.until)
+    return " AND ".join(clauses) or "1", params
+
+
+def fetch_page(conn, filters=NO_FILTERS, after_id=-1, limit=PAGE_ROWS):
+    """Up to ``limit`` matching rows with ids above ``after_id``, in id order, from every shard.
+
+    ``conn`` is any shard's connection, used to see whether the search index exists.
+    """
+    where, params = build_where(filters, _fts_available(conn))
+    return list(islice(iter_subscribers(COLUMNS, where, params, page_size=limit, after_id=after_id), limit))
@@ -0,0 +1,30 @@
+"""Subscriber counts read from the trigger-maintained subscriber_stats/signups_hourly tables."""
+from datetime import datetime, timedelta
+
+STAT_NAMES = ("total", "verified", "unsubscribed", "pending")
+
+
+def get_stats(*conns):
+    """Return the list counters plus recent hourly signups, summed over the given shard connections.
+
+    Cost does not depend on list size.
+    """
+    stats = {name: 0 for name in STAT_NAMES}
+    buckets = {}
+
+    now = datetime.utcnow()
+    this_hour = now.strftime("%Y-%m-%dT%H:00")
+    previous_hour = (now - timedelta(hours=1)).strftime("%Y-%m-%dT%H:00")
+    day_ago = (now - timedelta(hours=23)).strftime("%Y-%m-%dT%H:00")
+    for conn in conns:
+        for name, value in conn.execute("SELECT name, value FROM subscriber_stats"):
+            stats[name] = stats.get(name, 0) + value
+        for hour, count in conn.execute("SELECT hour, count FROM signups_hourly WHERE hour >= ?", (day_ago,)):
+            buckets[hour] = buckets.get(hour, 0) + count
+    buckets = dict(sorted(buckets.items()))
+
+    stats["signups_this_hour"] = buckets.get(this_hour, 0)
+    stats["signups_previous_hour"] = buckets.get(previous_hour, 0)
+    stats["signups_last_24h"] = sum(buckets.values())
+    stats["signups_by_hour"] = buckets
+    return stats
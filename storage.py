@@ -0,0 +1,72 @@
+"""Cross-shard helpers on top of db.py.
+
+Single-subscriber work goes straight to one shard: ``get_db(shard_for_email(canonical))`` or, for an
+id, ``get_db(shard_for_id(id))``. Anything that looks at the whole list (the GUI, campaigns,
+exports, stats) uses these helpers instead, so it works the same with one file or many.
+"""
+import heapq
+from contextlib import contextmanager
+
+from db import SHARDS, get_db
+
+PAGE_SIZE = 1000
+MAX_ID = (1 << 63) - 1
+
+
+@contextmanager
+def all_shards():
+    """A connection to every shard, in shard order, all returned to the pool on exit."""
+    conns = []
+    try:
+        for shard in range(SHARDS):
+            conns.append(get_db(shard))
+        yield conns
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def _scan_shard(shard, columns, where, params, page_size, after_id, window):
+    db = get_db(shard)
+    try:
+        last_id, upper = after_id, MAX_ID
+        while True:
+            if window and (upper == MAX_ID or last_id >= upper):
+                # Start each window at the next row that exists, so gaps (and the shard's id base) cost nothing
+                first = db.execute("SELECT MIN(id) FROM subscribers WHERE id > ?", (last_id,)).fetchone()[0]
+                if first is None:
+                    return
+                upper = first + window - 1
+            rows = db.execute(f"""
+                SELECT {columns}
+                FROM subscribers s
+                WHERE s.id > ? AND s.id <= ? AND ({where})
+                ORDER BY s.id
+                LIMIT ?
+            """, (last_id, upper, *params, page_size)).fetchall()
+            yield from rows
+            if len(rows) == page_size:
+                last_id = rows[-1]["id"]
+            elif window:
+                last_id = upper
+            else:
+                return
+    finally:
+        db.close()
+
+
+def iter_subscribers(columns="s.id, s.email", where="1", params=(), page_size=PAGE_SIZE, after_id=-1, window=None):
+    """Yield subscriber rows from every shard, merged into one ascending id order.
+
+    ``columns`` must include the id; ``where`` may refer to the table as ``s``. Only ids above
+    ``after_id`` are returned, so a scan can resume from the last id it produced. Each shard is read in
+    keyset pages, so memory stays flat and no read transaction is held between pages. With a selective
+    ``where`` a page can still scan far ahead to fill up; ``window`` caps every page query to that many
+    ids, so it examines at most ``window`` rows however few of them match.
+    """
+    if SHARDS == 1:
+        return _scan_shard(0, columns, where, params, page_size, after_id, window)
+    return heapq.merge(
+        *(_scan_shard(shard, columns, where, params, page_size, after_id, window) for shard in range(SHARDS)),
+        key=lambda row: row["id"],
+    )
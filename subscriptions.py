@@ -1,84 +1,190 @@
-import csv
-import os
-
-CSV_PATH = os.path.abspath("emails.csv")
-
-
-def ensure_csv_has_header():
-    """Ensure the CSV exists and has a 'send' column. Migrate old two-column files by adding 'Yes'."""
-    if not os.path.exists(CSV_PATH):
-        with open(CSV_PATH, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["time", "email", "send"])
-        return
-
-    # Read existing content
-    with open(CSV_PATH, "r", encoding="utf-8", newline="") as f:
-        rows = list(csv.reader(f))
-
-    if not rows:
-        with open(CSV_PATH, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["time", "email", "send"])
-        return
-
-    header = rows[0]
-    # If header already contains send and looks correct, nothing to do
-    if "send" in header and header[0:2] == ["time", "email"]:
-        return
-
-    # Determine data rows (if first row is header or not)
-    if header == ["time", "email"] or header == ["time", "email", "send"]:
-        data_rows = rows[1:]
-    else:
-        data_rows = rows
-
-    new_rows = [["time", "email", "send"]]
-    for r in data_rows:
-        if len(r) >= 2:
-            t = r[0]
-            e = r[1]
-            s = r[2] if len(r) > 2 else "Yes"
-            new_rows.append([t, e, s])
-
-    with open(CSV_PATH, "w", encoding="utf-8", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerows(new_rows)
-
-
-def append_subscription(time, email, send=True):
-    ensure_csv_has_header()
-    with open(CSV_PATH, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow([time, email, "Yes" if send else "No"])
-
-
-def update_send_in_csv(email, send):
-    """Update all rows with matching email to set send to Yes/No."""
-    if not os.path.exists(CSV_PATH):
-        return
-    with open(CSV_PATH, "r", encoding="utf-8", newline="") as f:
-        rows = list(csv.reader(f))
-    if not rows:
-        return
-    header = rows[0]
-    if "send" not in header:
-        ensure_csv_has_header()
-        with open(CSV_PATH, "r", encoding="utf-8", newline="") as f:
-            rows = list(csv.reader(f))
-        header = rows[0]
-
-    updated = False
-    for i, row in enumerate(rows[1:], start=1):
-        if len(row) >= 2 and row[1].strip().lower() == email.strip().lower():
-            # Ensure row has at least 3 columns
-            while len(row) < 3:
-                row.append("Yes")
-            row[2] = "Yes" if send else "No"
-            rows[i] = row
-            updated = True
-
-    if updated:
-        with open(CSV_PATH, "w", encoding="utf-8", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerows(rows)
\ No newline at end of file
+import csv
+import io
+import logging
+import os
+import threading
+
+import metrics
+from locks import file_lock
+
+log = logging.getLogger(__name__)
+
+CSV_PATH = os.path.abspath("emails.csv")
+# Every subscribe/unsubscribe appends one line here; compact_csv() folds it into CSV_PATH
+LOG_PATH = CSV_PATH + ".log"
+LOCK_PATH = CSV_PATH + ".lock"
+COMPACT_LOCK_PATH = CSV_PATH + ".compact.lock"
+COMPACT_INTERVAL_SECONDS = float(os.getenv("CSV_COMPACT_INTERVAL", "60"))
+
+HEADER = ["time", "email", "send"]
+
+
+def _write_header(path):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+
+
+def ensure_csv_has_header():
+    """Ensure the CSV exists and has a 'send' column. Migrate old two-column files by adding 'Yes'."""
+    if not os.path.exists(CSV_PATH):
+        _write_header(CSV_PATH)
+        return
+
+    # Only the first line decides whether a migration is needed
+    with open(CSV_PATH, "r", encoding="utf-8", newline="") as f:
+        header = next(csv.reader(f), None)
+
+    if header is None:
+        _write_header(CSV_PATH)
+        return
+
+    # If header already contains send and looks correct, nothing to do
+    if "send" in header and header[0:2] == ["time", "email"]:
+        return
+
+    with open(CSV_PATH, "r", encoding="utf-8", newline="") as f:
+        rows = list(csv.reader(f))
+
+    # Determine data rows (if first row is header or not)
+    if header == ["time", "email"] or header == ["time", "email", "send"]:
+        data_rows = rows[1:]
+    else:
+        data_rows = rows
+
+    new_rows = [HEADER]
+    for r in data_rows:
+        if len(r) >= 2:
+            t = r[0]
+            e = r[1]
+            s = r[2] if len(r) > 2 else "Yes"
+            new_rows.append([t, e, s])
+
+    tmp_path = CSV_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerows(new_rows)
+    os.replace(tmp_path, CSV_PATH)
+
+
+def _append_events(events):
+    """Append changes to the log: a single locked O_APPEND write, independent of list size."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for op, time, email, send in events:
+        writer.writerow([op, time, email, "Yes" if send else "No"])
+    data = buf.getvalue().encode("utf-8")
+    if not data:
+        return
+    with metrics.timed("csv"), file_lock(LOCK_PATH):
+        fd = os.open(LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+def append_subscription(time, email, send=True):
+    _append_events([("add", time, email, send)])
+
+
+def append_subscriptions(rows):
+    """Bulk variant of append_subscription for (time, email, send) tuples; one write for the whole batch."""
+    _append_events(("add", time, email, send) for time, email, send in rows)
+
+
+def update_send_in_csv(email, send):
+    """Record that all rows with matching email should have send set to Yes/No (applied on compaction)."""
+    _append_events([("set", "", email, send)])
+
+
+def remove_from_csv(emails):
+    """Record that rows for these addresses should be dropped (applied on compaction)."""
+    _append_events(("del", "", email, False) for email in emails)
+
+
+def _apply_events(rows, path):
+    """Replay one log file onto the snapshot rows (header excluded), in order."""
+    by_email = {}
+    for i, row in enumerate(rows):
+        if len(row) >= 2:
+            by_email.setdefault(row[1].strip().lower(), []).append(i)
+
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for event in csv.reader(f):
+            if len(event) < 4:
+                # Torn line from a process killed mid-write; skip it
+                continue
+            op, time, email, send = event[:4]
+            key = email.strip().lower()
+            if op == "add":
+                by_email.setdefault(key, []).append(len(rows))
+                rows.append([time, email, send])
+            elif op == "set":
+                for i in by_email.get(key, ()):
+                    row = rows[i]
+                    # Ensure row has at least 3 columns
+                    while len(row) < 3:
+                        row.append("Yes")
+                    row[2] = send
+            elif op == "del":
+                for i in by_email.pop(key, ()):
+                    rows[i] = None
+    rows[:] = [row for row in rows if row is not None]
+
+
+def compact_csv():
+    """Fold the change log into a fresh emails.csv snapshot. Returns the number of log files applied.
+
+    Writers are blocked only for the rename of the log; the snapshot is rebuilt outside the lock
+    and swapped in atomically, so readers never see a half-written file.
+    """
+    pending = LOG_PATH + ".compacting"
+    with file_lock(COMPACT_LOCK_PATH, blocking=False) as acquired:
+        if not acquired:
+            return 0
+
+        applied = 0
+        while True:
+            # A previous compaction may have crashed after the rename; its events come first
+            if not os.path.exists(pending):
+                with file_lock(LOCK_PATH):
+                    if not os.path.exists(LOG_PATH) or os.path.getsize(LOG_PATH) == 0:
+                        return applied
+                    os.replace(LOG_PATH, pending)
+
+            ensure_csv_has_header()
+            with open(CSV_PATH, "r", encoding="utf-8", newline="") as f:
+                rows = list(csv.reader(f))[1:]
+            _apply_events(rows, pending)
+
+            tmp_path = CSV_PATH + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(HEADER)
+                writer.writerows(rows)
+            os.replace(tmp_path, CSV_PATH)
+            os.remove(pending)
+            applied += 1
+
+
+def start_compactor(interval=COMPACT_INTERVAL_SECONDS):
+    """Compact the CSV every ``interval`` seconds in a daemon thread. Returns the stop event, or None if disabled."""
+    if interval <= 0:
+        return None
+    stop_event = threading.Event()
+
+    def _run():
+        while not stop_event.wait(interval):
+            try:
+                compact_csv()
+            except Exception:
+                log.exception("CSV compaction failed")
+
+    threading.Thread(target=_run, name="csv-compactor", daemon=True).start()
+    return stop_event
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(f"Applied {compact_csv()} change log file(s) to {CSV_PATH}")
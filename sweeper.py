@@ -0,0 +1,147 @@
+"""Periodic cleanup of verification state.
+
+Clears expired verification codes and, optionally, deletes signups that were never verified.
+Both run in small batches over partial indexes, so each pass only touches the rows it changes.
+Every server process starts a sweeper thread; a file lock lets only one of them sweep at a time.
+
+    python sweeper.py --once --purge-unverified-hours 72
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import journal
+from db import DB_PATH, SHARDS, get_db
+from locks import file_lock
+from migrations import check_schema
+from subscriptions import remove_from_csv
+
+log = logging.getLogger(__name__)
+
+SWEEP_INTERVAL_SECONDS = float(os.getenv("SWEEP_INTERVAL", "300"))
+# Delete signups still unverified after this many hours; 0 keeps them forever
+PURGE_UNVERIFIED_HOURS = float(os.getenv("PURGE_UNVERIFIED_HOURS", "0"))
+BATCH_SIZE = 500
+LOCK_PATH = DB_PATH + ".sweeper.lock"
+
+
+def clear_expired_codes(now=None, batch_size=BATCH_SIZE):
+    """Null out verification codes whose expiry has passed. Returns the number of rows cleared."""
+    now = int(now if now is not None else time.time())
+    cleared = 0
+    for shard in range(SHARDS):
+        db = get_db(shard)
+        try:
+            while True:
+                cur = db.execute("""
+                    UPDATE subscribers
+                    SET verification_code = NULL, code_expires_epoch = NULL
+                    WHERE id IN (
+                        SELECT id FROM subscribers
+                        WHERE code_expires_epoch IS NOT NULL AND code_expires_epoch <= ?
+                        LIMIT ?
+                    )
+                """, (now, batch_size))
+                db.commit()
+                cleared += cur.rowcount
+                if cur.rowcount < batch_size:
+                    break
+        finally:
+            db.close()
+    return cleared
+
+
+def purge_unverified(max_age_hours, batch_size=BATCH_SIZE, now=None):
+    """Delete never-verified signups whose last signup attempt is older than ``max_age_hours``.
+
+    Rows holding a code that hasn't expired yet are kept whatever their ``time``: imports keep the
+    source file's time, so a fresh import can look old while its verification mail is on the way.
+    """
+    now = int(now if now is not None else time.time())
+    cutoff = (datetime.utcnow() - timedelta(hours=max_age_hours)).isoformat()
+    purged = 0
+    for shard in range(SHARDS):
+        db = get_db(shard)
+        try:
+            while True:
+                emails = [r[0] for r in db.execute("""
+                    DELETE FROM subscribers
+                    WHERE id IN (
+                        SELECT id FROM subscribers
+                        WHERE verified = 0 AND time < ?
+                          AND (code_expires_epoch IS NULL OR code_expires_epoch <= ?)
+                        LIMIT ?
+                    )
+                    RETURNING email
+                """, (cutoff, now, batch_size)).fetchall()]
+                db.commit()
+                if emails:
+                    journal.record_many("purge", ({"email": email} for email in emails))
+                    remove_from_csv(emails)
+                purged += len(emails)
+                if len(emails) < batch_size:
+                    break
+        finally:
+            db.close()
+    return purged
+
+
+def sweep_once(purge_unverified_hours=PURGE_UNVERIFIED_HOURS, blocking=True):
+    """One sweep. Returns the counts, or None if another process holds the lock (``blocking`` off)."""
+    with file_lock(LOCK_PATH, blocking=blocking) as locked:
+        if not locked:
+            return None
+        result = {"codes_cleared": clear_expired_codes()}
+        if purge_unverified_hours > 0:
+            result["unverified_purged"] = purge_unverified(purge_unverified_hours)
+        return result
+
+
+def start_sweeper(interval=SWEEP_INTERVAL_SECONDS, purge_unverified_hours=PURGE_UNVERIFIED_HOURS):
+    """Sweep every ``interval`` seconds in a daemon thread. Returns the stop event, or None if disabled."""
+    if interval <= 0:
+        return None
+    stop_event = threading.Event()
+
+    def _run():
+        while not stop_event.wait(interval):
+            try:
+                # Every gunicorn worker runs this thread; one of them sweeping is enough
+                result = sweep_once(purge_unverified_hours, blocking=False)
+                if result and any(result.values()):
+                    log.info("Sweep: %s", result)
+            except Exception:
+                log.exception("Verification sweep failed")
+
+    threading.Thread(target=_run, name="verification-sweeper", daemon=True).start()
+    return stop_event
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clear expired verification codes and stale signups.")
+    parser.add_argument("--once", action="store_true", help="sweep once and exit")
+    parser.add_argument("--interval", type=float, default=SWEEP_INTERVAL_SECONDS, help="seconds between sweeps")
+    parser.add_argument("--purge-unverified-hours", type=float, default=PURGE_UNVERIFIED_HOURS,
+                        help="delete signups unverified for this long (0 disables)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    check_schema()
+
+    if args.once:
+        print(sweep_once(args.purge_unverified_hours))
+        return
+
+    stop_event = start_sweeper(args.interval, args.purge_unverified_hours)
+    try:
+        while stop_event and not stop_event.is_set():
+            stop_event.wait(1)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Signed, expiring tokens for the one-click verify and unsubscribe links in emails.
+
+A token is ``<payload>.<signature>``, both base64url: the payload names the purpose, the expiry
+(epoch seconds) and the address; the signature is an HMAC-SHA256 of the payload. Checking one needs
+only the secret, no database lookup, so the link routes go straight to a single conditional UPDATE.
+
+The secret comes from LINK_SECRET, or from link_secret.key (created on first use) so every worker
+process and the outbox/campaign senders share it. Rotating it invalidates every link already sent.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+LINK_SECRET_PATH = os.path.abspath(os.getenv("LINK_SECRET_FILE", "link_secret.key"))
+VERIFY_LINK_TTL_SECONDS = int(os.getenv("VERIFY_LINK_TTL_HOURS", "24")) * 3600
+UNSUBSCRIBE_LINK_TTL_SECONDS = int(os.getenv("UNSUBSCRIBE_LINK_TTL_DAYS", "365")) * 86400
+SIGNATURE_BYTES = 16
+
+_secret = None
+
+
+def _load_secret():
+    env = os.getenv("LINK_SECRET")
+    if env:
+        return env.encode("utf-8")
+    try:
+        with open(LINK_SECRET_PATH, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    # Write to a temporary name and hard-link it into place: if two processes race, one link fails
+    # and that process reads the winner's key instead of overwriting it
+    tmp_path = f"{LINK_SECRET_PATH}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(fd, secrets.token_bytes(32))
+    finally:
+        os.close(fd)
+    try:
+        os.link(tmp_path, LINK_SECRET_PATH)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(LINK_SECRET_PATH, "rb") as f:
+        return f.read()
+
+
+def _key():
+    global _secret
+    if _secret is None:
+        _secret = _load_secret()
+    return _secret
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(payload):
+    return hmac.new(_key(), payload, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def make_token(purpose, email, ttl_seconds, now=None):
+    expires = int(now if now is not None else time.time()) + ttl_seconds
+    payload = f"{purpose}|{expires}|{email}".encode("utf-8")
+    return f"{_b64encode(payload)}.{_b64encode(_sign(payload))}"
+
+
+def read_token(purpose, token, now=None):
+    """Return the address in ``token`` if it is genuine, unexpired and for ``purpose``; otherwise None."""
+    try:
+        payload_part, signature_part = token.split(".")
+        payload = _b64decode(payload_part)
+        signature = _b64decode(signature_part)
+    except (ValueError, binascii.Error):
+        return None
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    try:
+        token_purpose, expires, email = payload.decode("utf-8").split("|", 2)
+        expires = int(expires)
+    except ValueError:
+        return None
+    if token_purpose != purpose or expires < int(now if now is not None else time.time()):
+        return None
+    return email
+
+
+def verify_token(email, ttl_seconds=VERIFY_LINK_TTL_SECONDS):
+    return make_token("verify", email, ttl_seconds)
+
+
+def unsubscribe_token(email, ttl_seconds=UNSUBSCRIBE_LINK_TTL_SECONDS):
+    return make_token("unsubscribe", email, ttl_seconds)
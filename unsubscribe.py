@@ -1,46 +1,104 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
-import re
-import sqlite3
-from db import get_db
-from subscriptions import update_send_in_csv
-
-unsubscribe_bp = Blueprint("unsubscribe", __name__)
-
-EMAIL_REGEX = r"^[^@]+@[^@]+\.[^@]+$"
-
-
-@unsubscribe_bp.route("/unsubscribe", methods=["GET", "POST"])
-def unsubscribe():
-    if request.method == "POST":
-        email = request.form.get("email", "").strip().lower()
-        if not email:
-            flash("Email is required.", "error")
-            return redirect(url_for("unsubscribe.unsubscribe"))
-        if not re.match(EMAIL_REGEX, email):
-            flash("Please enter a valid email address.", "error")
-            return redirect(url_for("unsubscribe.unsubscribe"))
-
-        db = None
-        try:
-            db = get_db()
-            # Get the row including the 'send' status
-            cur = db.execute("SELECT id, send FROM subscribers WHERE email = ?", (email,))
-            row = cur.fetchone()
-            if not row:
-                flash("That email is not on our list.", "error")
-            elif row["send"] == 0:
-                flash("You're already unsubscribed.", "info")
-            else:
-                db.execute("UPDATE subscribers SET send = 0 WHERE email = ?", (email,))
-                db.commit()
-                update_send_in_csv(email, False)
-                flash("You're unsubscribed.", "success")
-        except sqlite3.DatabaseError:
-            # Catch broader DB errors
-            flash("Database error. Please try again later.", "error")
-        finally:
-            if db:
-                db.close()
-        return redirect(url_for("unsubscribe.unsubscribe"))
-
-    return render_template("unsubscribe.html")
+from flask import Blueprint, render_template, request, redirect, url_for, flash
+import sqlite3
+from assets import render_page
+import journal
+import membership
+from db import shard_for_email
+from subscriptions import update_send_in_csv
+from ratelimit import rate_limited
+from tokens import read_token
+from validation import canonicalize, validate
+from writebehind import run_write
+
+unsubscribe_bp = Blueprint("unsubscribe", __name__)
+
+
+@unsubscribe_bp.route("/unsubscribe", methods=["GET", "POST"])
+@rate_limited("unsubscribe")
+def unsubscribe():
+    if request.method == "POST":
+        email, canonical, reason = validate(request.form.get("email", ""))
+        if reason == "empty":
+            flash("Email is required.", "error")
+            return redirect(url_for("unsubscribe.unsubscribe"))
+        if reason == "invalid":
+            flash("Please enter a valid email address.", "error")
+            return redirect(url_for("unsubscribe.unsubscribe"))
+        if reason == "disposable":
+            # New signups from blocked domains are refused, but rows from before the blocklist must
+            # still be able to leave, so look them up like any other address
+            canonical = canonicalize(email)
+        if membership.definitely_absent(canonical, email):
+            flash("That email is not on our list.", "error")
+            return redirect(url_for("unsubscribe.unsubscribe"))
+
+        def write(db):
+            # Canonical match covers dot/plus variants; the exact match covers rows older than canonical_email
+            row = db.execute(
+                "SELECT id, send FROM subscribers WHERE canonical_email = ? OR email = ? ORDER BY send DESC",
+                (canonical, email),
+            ).fetchone()
+            if not row:
+                return "missing", []
+            if row["send"] == 0:
+                return "already", []
+            updated = db.execute(
+                "UPDATE subscribers SET send = 0 WHERE (canonical_email = ? OR email = ?) AND send != 0 RETURNING email",
+                (canonical, email),
+            ).fetchall()
+            return "unsubscribed", [stored for (stored,) in updated]
+
+        try:
+            outcome, stored_emails = run_write(write, shard_for_email(canonical))
+        except sqlite3.DatabaseError:
+            # Catch broader DB errors
+            flash("Database error. Please try again later.", "error")
+            return redirect(url_for("unsubscribe.unsubscribe"))
+
+        if outcome == "missing":
+            flash("That email is not on our list.", "error")
+        elif outcome == "already":
+            flash("You're already unsubscribed.", "info")
+        else:
+            journal.record("unsubscribe", email=email, canonical=canonical)
+            for stored in stored_emails:
+                update_send_in_csv(stored, False)
+            flash("You're unsubscribed.", "success")
+        return redirect(url_for("unsubscribe.unsubscribe"))
+
+    return render_page("unsubscribe.html")
+
+
+@unsubscribe_bp.route("/unsubscribe/<token>", methods=["GET", "POST"])
+def unsubscribe_link(token):
+    """Signed unsubscribe link from an email. GET asks for confirmation (link scanners follow GETs);
+    POST, from the button or a mail client's RFC 8058 one-click request, unsubscribes with one UPDATE."""
+    email = read_token("unsubscribe", token)
+    if email is None:
+        flash("This unsubscribe link is invalid or has expired. Enter your email below instead.", "error")
+        return redirect(url_for("unsubscribe.unsubscribe"))
+    canonical = canonicalize(email)
+
+    if request.method == "GET":
+        return render_template("unsubscribe.html", email=email, token=token)
+
+    def write(db):
+        return [stored for (stored,) in db.execute(
+            "UPDATE subscribers SET send = 0 WHERE canonical_email = ? AND send != 0 RETURNING email",
+            (canonical,),
+        ).fetchall()]
+
+    stored_emails = run_write(write, shard_for_email(canonical))
+    if stored_emails:
+        journal.record("unsubscribe", email=email, canonical=canonical)
+    for stored in stored_emails:
+        update_send_in_csv(stored, False)
+
+    if request.form.get("List-Unsubscribe") == "One-Click":
+        # Sent by the mail provider, not a browser: no page to show
+        return "", 204
+    if stored_emails:
+        flash("You're unsubscribed.", "success")
+    else:
+        flash("You're already unsubscribed.", "info")
+    return redirect(url_for("unsubscribe.unsubscribe"))
@@ -0,0 +1,141 @@
+"""Email address validation and canonicalization, shared by the routes, the importer and campaigns.
+
+validate() is the single-address path used by request handlers; validate_many() checks a whole
+batch at once and looks each domain up only once per batch, for imports and bulk sends.
+
+Canonical forms fold the address variants a provider delivers to the same mailbox (Gmail ignores
+dots and anything after "+", googlemail.com is gmail.com, ...), so duplicate detection works on
+``subscribers.canonical_email`` rather than on what was typed. Mail is still sent to the typed address.
+
+Domains in disposable_domains.txt (and in the file named by BLOCKED_DOMAINS_FILE, if set) are
+refused, including their subdomains. The list is read once per process into a frozenset.
+"""
+import os
+import re
+from collections import namedtuple
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+DISPOSABLE_DOMAINS_PATH = os.path.join(BASE_DIR, "disposable_domains.txt")
+# Optional site-specific blocklist, same format: one domain per line, '#' starts a comment
+BLOCKED_DOMAINS_FILE = os.getenv("BLOCKED_DOMAINS_FILE")
+
+MAX_LENGTH = 254
+MAX_LOCAL_LENGTH = 64
+EMAIL_REGEX = (
+    r"^[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,61}[a-z0-9]$"
+)
+_email_re = re.compile(EMAIL_REGEX)
+
+# domain -> (canonical domain, ignore dots in the local part, tag separator or None)
+PROVIDERS = {
+    "gmail.com": ("gmail.com", True, "+"),
+    "googlemail.com": ("gmail.com", True, "+"),
+    "outlook.com": ("outlook.com", False, "+"),
+    "hotmail.com": ("hotmail.com", False, "+"),
+    "live.com": ("live.com", False, "+"),
+    "msn.com": ("msn.com", False, "+"),
+    "icloud.com": ("icloud.com", False, "+"),
+    "me.com": ("me.com", False, "+"),
+    "mac.com": ("mac.com", False, "+"),
+    "fastmail.com": ("fastmail.com", False, "+"),
+    "proton.me": ("proton.me", False, "+"),
+    "protonmail.com": ("proton.me", False, "+"),
+    "protonmail.ch": ("proton.me", False, "+"),
+    "pm.me": ("proton.me", False, "+"),
+    # Yahoo's disposable addresses are base-keyword@; base names cannot contain '-'
+    "yahoo.com": ("yahoo.com", False, "-"),
+}
+
+Validation = namedtuple("Validation", ["email", "canonical", "reason"])
+"""``email`` is the normalized input, ``reason`` is None when the address is accepted,
+otherwise one of "empty", "invalid" or "disposable"."""
+
+_blocked = None
+
+
+def _read_domains(path):
+    domains = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip().lower()
+            if line:
+                domains.add(line)
+    return domains
+
+
+def blocked_domains():
+    """The disposable/blocked domain set, loaded on first use."""
+    global _blocked
+    if _blocked is None:
+        domains = set()
+        if os.path.exists(DISPOSABLE_DOMAINS_PATH):
+            domains |= _read_domains(DISPOSABLE_DOMAINS_PATH)
+        if BLOCKED_DOMAINS_FILE:
+            domains |= _read_domains(BLOCKED_DOMAINS_FILE)
+        _blocked = frozenset(domains)
+    return _blocked
+
+
+def is_blocked_domain(domain, blocked=None):
+    """True if ``domain`` or any parent domain is on the blocklist (mx.mailinator.com counts)."""
+    blocked = blocked_domains() if blocked is None else blocked
+    while True:
+        if domain in blocked:
+            return True
+        dot = domain.find(".")
+        if dot < 0:
+            return False
+        domain = domain[dot + 1:]
+
+
+def normalize(email):
+    return email.strip().lower() if isinstance(email, str) else ""
+
+
+def canonicalize(email):
+    """Canonical form of a normalized address. Unknown providers keep the address as typed."""
+    local, sep, domain = email.rpartition("@")
+    if not sep:
+        return email
+    rule = PROVIDERS.get(domain)
+    if rule is None:
+        return email
+    domain, strip_dots, tag = rule
+    if tag:
+        local = local.split(tag, 1)[0]
+    if strip_dots:
+        local = local.replace(".", "")
+    return f"{local}@{domain}"
+
+
+def _check(email, blocked, domain_cache):
+    if not email:
+        return Validation(email, None, "empty")
+    if len(email) > MAX_LENGTH or not _email_re.match(email):
+        return Validation(email, None, "invalid")
+    local, _, domain = email.rpartition("@")
+    if len(local) > MAX_LOCAL_LENGTH:
+        return Validation(email, None, "invalid")
+    is_blocked = domain_cache.get(domain)
+    if is_blocked is None:
+        is_blocked = domain_cache[domain] = is_blocked_domain(domain, blocked)
+    if is_blocked:
+        return Validation(email, None, "disposable")
+    canonical = canonicalize(email)
+    if not canonical.partition("@")[0]:
+        # e.g. "+tag@gmail.com" or "...@gmail.com": nothing left of the mailbox name
+        return Validation(email, None, "invalid")
+    return Validation(email, canonical, None)
+
+
+def validate(email):
+    """Validate and canonicalize one address (raw user input)."""
+    return _check(normalize(email), blocked_domains(), {})
+
+
+def validate_many(emails):
+    """Validate a batch of raw addresses; returns one Validation per input, in order."""
+    blocked = blocked_domains()
+    domain_cache = {}
+    return [_check(normalize(email), blocked, domain_cache) for email in emails]
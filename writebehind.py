@@ -0,0 +1,163 @@
+"""Group commit for request writes.
+
+Request handlers put their database work in a function ``write(db)`` and call run_write(write).
+By default that runs on a pooled connection and commits, as before. With WRITE_BEHIND=1 the
+function is handed to a writer thread instead (one per shard in each process): the writer takes
+everything queued (waiting up to WRITE_BEHIND_MAX_DELAY_MS for more), runs each job inside its own
+SAVEPOINT of one shared transaction and commits once. Every caller waits for the commit and gets its own
+return value or exception, so a failing job never affects the others in its batch.
+
+This pays off when one process serves concurrent requests (e.g. gunicorn ``--threads``): N
+signups then cost one fsync and one trip through SQLite's writer lock instead of N.
+
+``write`` must not commit or roll back itself, and should keep reads that decide what to write
+inside the function so they run in the same transaction.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+from db import DB_PATHS, _connect, get_db
+
+log = logging.getLogger(__name__)
+
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+MAX_DELAY_SECONDS = float(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", "2")) / 1000
+MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "256"))
+# A caller gives up after this long; its job may still commit later
+RESULT_TIMEOUT_SECONDS = 60
+
+# One writer thread per shard in this process
+_writers = {"pid": None, "threads": {}}
+_writer_lock = threading.Lock()
+
+
+class _Writer(threading.Thread):
+    def __init__(self, shard):
+        super().__init__(name=f"write-behind-{shard}", daemon=True)
+        self.shard = shard
+        self.jobs = queue.Queue()
+
+    def run(self):
+        # Its own connection for the life of the thread, never returned to the pool
+        conn = _connect(DB_PATHS[self.shard])
+        while True:
+            batch = [self.jobs.get()]
+            try:
+                self._collect(batch)
+                self._commit(conn, batch)
+            except Exception as e:
+                # E.g. the rollback itself failed. Keep the thread alive: answer everyone and start over on a
+                # fresh connection, since this one may be unusable
+                log.exception("Write-behind writer for shard %d failed", self.shard)
+                _fail(batch, e)
+                try:
+                    conn.close_for_real()
+                except Exception:
+                    pass
+                conn = _connect(DB_PATHS[self.shard])
+
+    def _collect(self, batch):
+        deadline = time.monotonic() + MAX_DELAY_SECONDS
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(self.jobs.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                batch.append(self.jobs.get(timeout=remaining))
+            except queue.Empty:
+                return
+
+    def _commit(self, conn, batch):
+        done = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT job")
+                try:
+                    value = fn(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    done.append((future, None, e))
+                else:
+                    conn.execute("RELEASE job")
+                    done.append((future, value, None))
+            conn.commit()
+        except Exception as e:
+            # Nothing in the batch was committed; every caller sees the same error
+            log.exception("Write-behind batch of %d failed", len(batch))
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            finally:
+                _fail(batch, e)
+            return
+        metrics.inc("email_list_write_batches_total")
+        metrics.inc("email_list_write_batch_jobs_total", len(done))
+        for future, value, error in done:
+            if error is None:
+                future.set_result(value)
+            else:
+                future.set_exception(error)
+
+
+def _fail(batch, error):
+    """Resolve every job in ``batch`` not already answered with ``error``, including ones never started."""
+    for fn, future in batch:
+        if future.done():
+            continue
+        if not future.running() and not future.set_running_or_notify_cancel():
+            continue
+        future.set_exception(error)
+
+
+def _get_writer(shard):
+    pid = os.getpid()
+    thread = _writers["threads"].get(shard) if _writers["pid"] == pid else None
+    if thread is None:
+        with _writer_lock:
+            if _writers["pid"] != pid:
+                # After a fork the parent's threads do not exist in the child; start fresh ones
+                _writers["pid"], _writers["threads"] = pid, {}
+            thread = _writers["threads"].get(shard)
+            if thread is None:
+                thread = _writers["threads"][shard] = _Writer(shard)
+                thread.start()
+    return thread
+
+
+def submit(fn, shard=0):
+    """Queue ``fn(db)`` for the next group commit on ``shard``. Returns a Future resolved after the commit."""
+    future = Future()
+    _get_writer(shard).jobs.put((fn, future))
+    return future
+
+
+def run_write(fn, shard=0):
+    """Run ``fn(db)`` in a transaction on ``shard`` and commit it; returns what ``fn`` returned.
+
+    Exceptions raised by ``fn`` (or by the commit) propagate to the caller.
+    """
+    if WRITE_BEHIND:
+        with metrics.timed("db"):
+            return submit(fn, shard).result(RESULT_TIMEOUT_SECONDS)
+    db = get_db(shard)
+    try:
+        result = fn(db)
+        db.commit()
+        return result
+    finally:
+        # close() rolls back anything left uncommitted by an exception
+        db.close()